@@ -0,0 +1,219 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+'''Benchmarks of treelog's hot paths.
+
+Every benchmark is run against every sink, and the time per operation is
+written as one JSON object per line, for example::
+
+  {"benchmark": "write", "sink": "HtmlLog", "build": "python", ...}
+
+The timed section of a run includes closing the sink, such that output that
+is buffered by the sink is accounted for, but not the preparation of the
+input of the benchmark, such as the recording that is replayed.
+
+Benchmarks and sinks can be selected by passing ``benchmark:sink`` glob
+patterns, e.g. ``python benchmark.py 'open*:HtmlLog' 'write:*'``. The ``build``
+field is ``mypyc`` if treelog was installed with ``TREELOG_USE_MYPYC=1`` and
+``python`` otherwise; to compare the two builds, run the benchmarks once
+against each installation (outside of the source directory) and combine the
+output.'''
+
+import treelog, argparse, collections, contextlib, fnmatch, json, logging, os, platform, statistics, sys, tempfile, time, typing
+
+info = treelog.proto.Level.info
+debug = treelog.proto.Level.debug
+
+# SINKS
+
+def _logginglog(tmpdir: str) -> treelog.proto.Log:
+  logger = logging.getLogger('treelog.benchmark')
+  logger.propagate = False
+  if not logger.handlers:
+    logger.addHandler(logging.StreamHandler(open(os.devnull, 'w')))
+  logger.setLevel(logging.DEBUG)
+  return treelog.LoggingLog('treelog.benchmark')
+
+SINKS = collections.OrderedDict([
+  ('NullLog', lambda tmpdir: treelog.NullLog()),
+  ('StdoutLog', lambda tmpdir: treelog.StdoutLog()),
+  ('RichOutputLog', lambda tmpdir: treelog.RichOutputLog()),
+  ('HtmlLog', lambda tmpdir: treelog.HtmlLog(tmpdir, title='benchmark')),
+  ('DataLog', lambda tmpdir: treelog.DataLog(tmpdir)),
+  ('RecordLog', lambda tmpdir: treelog.RecordLog()),
+  ('LoggingLog', _logginglog),
+  ('TimingLog', lambda tmpdir: treelog.TimingLog()),
+  ('TraceLog', lambda tmpdir: treelog.TraceLog(tmpdir)),
+  ('JsonLinesLog', lambda tmpdir: treelog.JsonLinesLog(tmpdir, title='benchmark')),
+  ('BinaryLog', lambda tmpdir: treelog.BinaryLog(tmpdir, title='benchmark')),
+  ('SqliteLog', lambda tmpdir: treelog.SqliteLog(tmpdir)),
+]) # type: typing.Dict[str, typing.Callable[[str], treelog.proto.Log]]
+
+# BENCHMARKS
+
+Benchmark = typing.Callable[[treelog.proto.Log, typing.Any], None]
+
+BENCHMARKS = collections.OrderedDict() # type: typing.Dict[str, typing.Tuple[int, typing.Callable[[int], typing.Any], Benchmark]]
+
+def benchmark(number: int, setup: typing.Callable[[int], typing.Any] = lambda number: number) -> typing.Callable[[Benchmark], Benchmark]:
+  '''Register benchmark with default number of operations per run.
+
+  The benchmark is called with the log and the return value of ``setup``,
+  which is called with the number of operations outside of the timed section,
+  and defaults to passing the number of operations itself.'''
+
+  def register(func: Benchmark) -> Benchmark:
+    BENCHMARKS[func.__name__] = number, setup, func
+    return func
+  return register
+
+@benchmark(number=10000)
+def write(log: treelog.proto.Log, number: int) -> None:
+  for i in range(number):
+    log.write('message', info)
+
+@benchmark(number=10000)
+def write_nested(log: treelog.proto.Log, number: int) -> None:
+  for title in 'abcde':
+    log.pushcontext(title)
+  for i in range(number):
+    log.write('message', info)
+  for title in 'abcde':
+    log.popcontext()
+
+@benchmark(number=10000)
+def pushpop(log: treelog.proto.Log, number: int) -> None:
+  for i in range(number):
+    log.pushcontext('context')
+    log.popcontext()
+
+@benchmark(number=10000)
+def recontext(log: treelog.proto.Log, number: int) -> None:
+  log.pushcontext('context')
+  for i in range(number):
+    log.recontext('context')
+  log.popcontext()
+
+@benchmark(number=10000)
+def fraction(log: treelog.proto.Log, number: int) -> None:
+  with treelog.set(log), treelog.iter.fraction('loop', range(number)) as items:
+    for item in items:
+      pass
+
+@benchmark(number=10000)
+def fraction_write(log: treelog.proto.Log, number: int) -> None:
+  with treelog.set(log), treelog.iter.fraction('loop', range(number)) as items:
+    for item in items:
+      treelog.info('message')
+
+@benchmark(number=1000)
+def open_small(log: treelog.proto.Log, number: int) -> None:
+  data = b'x' * 100
+  for i in range(number):
+    with log.open('small.dat', 'wb', info) as f:
+      f.write(data)
+
+@benchmark(number=10)
+def open_large(log: treelog.proto.Log, number: int) -> None:
+  data = b'x' * 2**24
+  for i in range(number):
+    with log.open('large.dat', 'wb', info) as f:
+      f.write(data)
+
+@benchmark(number=10000)
+def teelog(log: treelog.proto.Log, number: int) -> None:
+  tee = treelog.TeeLog(treelog.NullLog(), treelog.TeeLog(log, treelog.NullLog()))
+  for i in range(number):
+    tee.write('message', info)
+
+@benchmark(number=10000)
+def filterlog(log: treelog.proto.Log, number: int) -> None:
+  filtered = treelog.FilterLog(treelog.FilterLog(log, minlevel=info), minlevel=info)
+  for i in range(number):
+    filtered.write('message', debug)
+    filtered.write('message', info)
+
+def _record(number: int) -> treelog.RecordLog:
+  record = treelog.RecordLog()
+  with treelog.set(record), treelog.iter.plain('loop', range(number//10)) as items:
+    for item in items:
+      for i in range(9):
+        treelog.info('message')
+  return record
+
+@benchmark(number=10000, setup=_record)
+def replay(log: treelog.proto.Log, record: treelog.RecordLog) -> None:
+  record.replay(log)
+
+# DRIVER
+
+def build() -> str:
+  '''Return ``'mypyc'`` if treelog is compiled, ``'python'`` otherwise.'''
+
+  return 'mypyc' if os.path.splitext(treelog._forward.__file__)[1] in ('.so', '.pyd') else 'python'
+
+def run(name: str, sinkname: str, number: int, repeat: int) -> typing.Dict[str, typing.Any]:
+  ndefault, setup, func = BENCHMARKS[name]
+  times = []
+  for i in range(repeat):
+    data = setup(number)
+    with tempfile.TemporaryDirectory() as tmpdir, open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+      log = SINKS[sinkname](tmpdir)
+      t0 = time.perf_counter()
+      func(log, data)
+      close = getattr(log, 'close', None)
+      if close:
+        close()
+      times.append(time.perf_counter() - t0)
+  return collections.OrderedDict([
+    ('benchmark', name),
+    ('sink', sinkname),
+    ('build', build()),
+    ('python', platform.python_implementation() + ' ' + platform.python_version()),
+    ('treelog', treelog.version),
+    ('number', number),
+    ('repeat', repeat),
+    ('best', min(times) / number),
+    ('median', statistics.median(times) / number),
+  ])
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('patterns', nargs='*', default=['*:*'], metavar='BENCHMARK:SINK', help='glob patterns of benchmarks and sinks to run (default: all)')
+  parser.add_argument('--scale', type=float, default=1., help='multiply the default number of operations per run (default: 1)')
+  parser.add_argument('--repeat', type=int, default=5, help='number of runs per benchmark (default: 5)')
+  parser.add_argument('--output', type=argparse.FileType('w'), default=sys.stdout, help='output file for the json lines (default: stdout)')
+  parser.add_argument('--list', action='store_true', help='list the available benchmarks and sinks and exit')
+  args = parser.parse_args(argv)
+  if args.list:
+    print('benchmarks:', ', '.join(BENCHMARKS))
+    print('sinks:', ', '.join(SINKS))
+    return
+  patterns = [pattern.partition(':')[::2] for pattern in args.patterns]
+  for name, (ndefault, setup, func) in BENCHMARKS.items():
+    for sinkname in SINKS:
+      if any(fnmatch.fnmatchcase(name, bpat) and fnmatch.fnmatchcase(sinkname, spat or '*') for bpat, spat in patterns):
+        result = run(name, sinkname, max(1, round(ndefault * args.scale)), args.repeat)
+        print(json.dumps(result), file=args.output, flush=True)
+
+if __name__ == '__main__':
+  main()
+
+# vim:sw=2:sts=2:et
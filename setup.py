@@ -7,7 +7,7 @@ with open(os.path.join('treelog', '__init__.py')) as f:
 if os.getenv('TREELOG_USE_MYPYC', None) == '1':
   from mypyc.build import mypycify
   import pathlib
-  ext_modules = mypycify([str(p) for p in pathlib.Path('treelog').glob('*.py') if p.name not in {'__init__.py', 'proto.py'}])
+  ext_modules = mypycify([str(p) for p in pathlib.Path('treelog').glob('*.py') if p.name not in {'__init__.py', '__main__.py', 'proto.py'}])
 else:
   ext_modules = []
 
@@ -18,7 +18,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import treelog, unittest, contextlib, tempfile, os, sys, hashlib, io, warnings, gc, doctest
+import treelog, treelog.__main__, treelog._resource, subprocess, unittest, unittest.mock, contextlib, tempfile, os, sys, hashlib, io, warnings, gc, doctest, concurrent.futures, time, asyncio, itertools, json, threading, tracemalloc, sqlite3, pickle, multiprocessing, socket
+
+# Loggers compiled with mypyc cannot be weakly referenced, and are kept alive
+# by the fork handlers until they are closed.
+compiled = os.path.splitext(treelog._fork.__file__)[1] in ('.so', '.pyd')
 
 class Log(unittest.TestCase):
 
@@ -306,6 +310,267 @@ class RecordLog(Log):
     with self.assertSilent(), treelog.set(treelog.LoggingLog()), self.assertLogs('nutils'):
       recordlog.replay()
 
+  def test_pickle(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    recordlog.write('test', level=treelog.proto.Level.info)
+    with recordlog.open('test.dat', 'w', level=treelog.proto.Level.info) as f:
+      f.write('test')
+    copy = pickle.loads(pickle.dumps(recordlog))
+    self.assertEqual(copy._messages, recordlog._messages)
+    with copy.open('copy.dat', 'w', level=treelog.proto.Level.info) as f:
+      f.write('copy')
+    self.assertEqual(copy._messages[-2:], [('open', 1, 'copy.dat', 'w', treelog.proto.Level.info), ('close', 1, 'copy')])
+
+  def test_unpickle_dict(self):
+    recordlog = treelog.RecordLog.__new__(treelog.RecordLog)
+    recordlog.__setstate__(dict(_simplify=False, _messages=[('write', 'test', treelog.proto.Level.info)], _fid=0))
+    recordlog.write('more', level=treelog.proto.Level.info)
+    self.assertEqual(recordlog._messages, [('write', 'test', treelog.proto.Level.info), ('write', 'more', treelog.proto.Level.info)])
+
+class BinaryLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.BinaryLog(tmpdir, title='test') as binarylog:
+        yield binarylog
+      self.assertEqual(os.listdir(tmpdir), ['log.treelog'])
+      for Log in StdoutLog, DataLog, HtmlLog, RichOutputLog:
+        with self.subTest('replay to {}'.format(Log.__name__)), Log.output_tester(self) as log, open(os.path.join(tmpdir, 'log.treelog'), 'rb') as f:
+          title, events = treelog._binary.load(f)
+          self.assertEqual(title, 'test')
+          treelog._silent.replay((message for t, message in events), log)
+
+  def test_text(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.BinaryLog(tmpdir, title='test') as binarylog, binarylog.open('test.txt', 'w', treelog.proto.Level.info) as f:
+        f.write('☃\n')
+      with open(os.path.join(tmpdir, 'log.treelog'), 'rb') as f:
+        title, events = treelog._binary.load(f)
+        self.assertEqual([message for t, message in events], [('open', 0, 'test.txt', 'w', treelog.proto.Level.info), ('close', 0, '☃\n')])
+
+  def test_truncated(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.BinaryLog(tmpdir, title='test') as binarylog, treelog.set(binarylog):
+        self.generate()
+      with open(os.path.join(tmpdir, 'log.treelog'), 'rb') as f:
+        data = f.read()
+    title, events = treelog._binary.load(io.BytesIO(data))
+    messages = [message for t, message in events]
+    for n in range(len(treelog._binary.MAGIC) + 8, len(data), 7):
+      title, events = treelog._binary.load(io.BytesIO(data[:n]))
+      truncated = [message for t, message in events]
+      self.assertEqual(truncated, messages[:len(truncated)])
+
+  def test_render(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.BinaryLog(tmpdir, title='test') as binarylog, treelog.set(binarylog):
+        self.generate()
+      with treelog.HtmlLog(os.path.join(tmpdir, 'direct'), title='test') as htmllog, treelog.set(htmllog):
+        self.generate()
+      with capture() as captured:
+        treelog.__main__.main(['render', os.path.join(tmpdir, 'log.treelog'), os.path.join(tmpdir, 'rendered')])
+      self.assertEqual(captured.stdout, 'rendered {} to log.html\n'.format(os.path.join(tmpdir, 'log.treelog')))
+      self.assertEqual(sorted(os.listdir(os.path.join(tmpdir, 'rendered'))), sorted(os.listdir(os.path.join(tmpdir, 'direct'))))
+      for name in os.listdir(os.path.join(tmpdir, 'direct')):
+        with open(os.path.join(tmpdir, 'direct', name), 'rb') as f1, open(os.path.join(tmpdir, 'rendered', name), 'rb') as f2:
+          self.assertEqual(f1.read(), f2.read(), name)
+
+class SocketLog(Log):
+
+  @contextlib.contextmanager
+  def server(self, **kwargs):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      address = os.path.join(tmpdir, 'socket')
+      server = treelog.CollectorServer(address, os.path.join(tmpdir, 'out'), **kwargs)
+      thread = threading.Thread(target=server.serve_forever, args=(.01,))
+      thread.start()
+      try:
+        yield address, os.path.join(tmpdir, 'out')
+      finally:
+        server.shutdown()
+        thread.join()
+        server.server_close()
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with self.server(format='data') as (address, outdir):
+      with treelog.SocketLog(address, title='test', batchsize=16) as socketlog:
+        yield socketlog
+      outdir = os.path.join(outdir, 'producer-1')
+      self.assertEqual(set(os.listdir(outdir)), {'test.dat', 'test-1.dat', 'test-2.dat', 'same.dat', 'dbg.dat'})
+      with open(os.path.join(outdir, 'test.dat'), 'r') as f:
+        self.assertEqual(f.read(), 'test1')
+      with open(os.path.join(outdir, 'test-1.dat'), 'rb') as f:
+        self.assertEqual(f.read(), b'test2')
+      with open(os.path.join(outdir, 'dbg.dat'), 'r') as f:
+        self.assertEqual(f.read(), 'test4')
+
+  def test_html(self):
+    with self.server() as (address, outdir):
+      with treelog.SocketLog(address, title='first') as a, treelog.SocketLog(address, title='second') as b:
+        a.write('from a', treelog.proto.Level.info)
+        b.write('from b', treelog.proto.Level.info)
+        b.flush()
+        a.flush()
+      self.assertEqual(sorted(os.listdir(outdir)), ['producer-1', 'producer-2'])
+      with open(os.path.join(outdir, 'producer-1', 'log.html')) as f:
+        self.assertIn('from b', f.read())
+      with open(os.path.join(outdir, 'producer-2', 'log.html')) as f:
+        self.assertIn('from a', f.read())
+
+  def test_reconnect(self):
+    with self.server() as (address, outdir):
+      with treelog.SocketLog(address, title='test', batchsize=1, delay=0) as socketlog, treelog.set(socketlog):
+        with treelog.context('before'):
+          treelog.info('message 1')
+          socketlog._file._sock.shutdown(socket.SHUT_RDWR)
+          treelog.info('message 2')
+        with treelog.context('after'):
+          treelog.info('message 3')
+      self.assertEqual(os.listdir(outdir), ['producer-1'])
+      with open(os.path.join(outdir, 'producer-1', 'log.html')) as f:
+        html = f.read()
+      for text in 'before', 'message 1', 'message 2', 'after', 'message 3':
+        self.assertEqual(html.count(text), 1, text)
+
+  def test_giveup(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      socketlog = treelog.SocketLog(os.path.join(tmpdir, 'socket'), title='test', retries=1, delay=60)
+      socketlog.write('message 1', treelog.proto.Level.info)
+      socketlog.flush() # first attempt fails
+      socketlog.write('message 2', treelog.proto.Level.info)
+      socketlog.flush() # no new attempt before the delay has passed
+      self.assertEqual(socketlog._file._attempts, 1)
+      self.assertIn(b'message 2', socketlog._file._pending)
+      socketlog._file._next = 0 # skip the delay
+      with warnings.catch_warnings(record=True) as w:
+        warnings.simplefilter('always')
+        socketlog.flush()
+        socketlog.write('message 3', treelog.proto.Level.info)
+        socketlog.close()
+      self.assertEqual(len(w), 1)
+      self.assertIn('dropping', str(w[0].message))
+      self.assertEqual(socketlog._file._pending, b'')
+
+  def test_unclosed(self):
+    with self.server() as (address, outdir):
+      socketlog = treelog.SocketLog(address, title='test')
+      socketlog.pushcontext('unfinished')
+      socketlog.write('message', treelog.proto.Level.info)
+      socketlog.flush()
+      socketlog._file._sock.close()
+      socketlog._file.closed = True
+    with self.assertRaises(FileNotFoundError):
+      os.stat(address)
+
+  def test_parseaddress(self):
+    self.assertEqual(treelog._socket.parseaddress('/tmp/treelog.sock'), '/tmp/treelog.sock')
+    self.assertEqual(treelog._socket.parseaddress('example.com:1234'), ('example.com', 1234))
+    self.assertEqual(treelog._socket.parseaddress(':1234'), ('localhost', 1234))
+
+class SqliteLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.SqliteLog(tmpdir, batchsize=5) as sqlitelog:
+        yield sqlitelog
+        self.assertEqual(sqlitelog.messages(minlevel=treelog.proto.Level.info), [
+          ('', 'my message', treelog.proto.Level.user),
+          ('my context > iter 1', 'a', treelog.proto.Level.info),
+          ('my context > iter 2', 'b', treelog.proto.Level.info),
+          ('my context > iter 3', 'c', treelog.proto.Level.info),
+          ('my context', 'multiple..\n  ..lines', treelog.proto.Level.error),
+          ('my context', 'generating', treelog.proto.Level.info),
+          ('context step=0', 'foo', treelog.proto.Level.info),
+          ('context step=1', 'bar', treelog.proto.Level.info),
+          ('', 'warn', treelog.proto.Level.warning)])
+        self.assertEqual(sqlitelog.messages('my context*', minlevel=treelog.proto.Level.warning), [
+          ('my context', 'multiple..\n  ..lines', treelog.proto.Level.error)])
+      self.assertEqual(sqlitelog.filename, 'log.sqlite')
+      db = sqlite3.connect(os.path.join(tmpdir, 'log.sqlite'))
+      try:
+        self.assertEqual(db.execute('SELECT id, parent, title, path FROM contexts ORDER BY id').fetchall(), [
+          (0, None, '', ''),
+          (1, 0, 'my context', 'my context'),
+          (2, 1, 'iter 0', 'my context > iter 0'),
+          (3, 1, 'iter 1', 'my context > iter 1'),
+          (4, 1, 'iter 2', 'my context > iter 2'),
+          (5, 1, 'iter 3', 'my context > iter 3'),
+          (6, 1, 'empty', 'my context > empty'),
+          (7, 0, 'generate_test', 'generate_test'),
+          (8, 0, 'context step=0', 'context step=0'),
+          (9, 0, 'context step=1', 'context step=1')])
+        self.assertEqual(db.execute('SELECT count(*) FROM contexts WHERE stop IS NULL OR stop < start').fetchone(), (0,))
+        self.assertEqual(db.execute('SELECT context, level, name, file, size FROM attachments ORDER BY id').fetchall(), [
+          (0, 1, 'test.dat', 'b444ac06613fc8d63795be9ad0beaf55011936ac.dat', 5),
+          (1, 2, 'test.dat', '109f4b3c50d7b0df729d299bc6f8e9ef9066971f.dat', 5),
+          (7, 3, 'test.dat', '3ebfa301dc59196f18593c45e519287a23297589.dat', 5),
+          (0, 4, 'same.dat', '3ebfa301dc59196f18593c45e519287a23297589.dat', 5),
+          (0, 0, 'dbg.dat', '1ff2b3704aede04eecb51e50ca698efd50a1379b.dat', 5)])
+        self.assertIn('contexts_path', [name for name, in db.execute("SELECT name FROM sqlite_master WHERE type = 'index'")])
+      finally:
+        db.close()
+
+class JsonLinesLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tests = ['b444ac06613fc8d63795be9ad0beaf55011936ac.dat', '109f4b3c50d7b0df729d299bc6f8e9ef9066971f.dat',
+               '3ebfa301dc59196f18593c45e519287a23297589.dat', '1ff2b3704aede04eecb51e50ca698efd50a1379b.dat']
+      with treelog.JsonLinesLog(tmpdir, title='test') as jsonlog:
+        yield jsonlog
+      self.assertEqual(jsonlog.filename, 'log.jsonl')
+      self.assertEqual(set(os.listdir(tmpdir)), {'log.jsonl', *tests})
+      for i, test in enumerate(tests, 1):
+        with open(os.path.join(tmpdir, test), 'rb') as f:
+          self.assertEqual(f.read(), b'test%i' % i)
+      with open(os.path.join(tmpdir, 'log.jsonl'), 'r') as f:
+        events = [json.loads(line) for line in f]
+    times = [event.pop('t') for event in events]
+    self.assertEqual(times, sorted(times))
+    self.assertEqual(events, [
+      {'event': 'start', 'title': 'test', 'time': events[0]['time']},
+      {'event': 'write', 'context': None, 'level': 'user', 'text': 'my message'},
+      {'event': 'open', 'context': None, 'level': 'info', 'name': 'test.dat', 'file': tests[0]},
+      {'event': 'push', 'id': 1, 'parent': None, 'title': 'my context'},
+      {'event': 'push', 'id': 2, 'parent': 1, 'title': 'iter 0'},
+      {'event': 'recontext', 'id': 3, 'replaces': 2, 'parent': 1, 'title': 'iter 1'},
+      {'event': 'write', 'context': 3, 'level': 'info', 'text': 'a'},
+      {'event': 'recontext', 'id': 4, 'replaces': 3, 'parent': 1, 'title': 'iter 2'},
+      {'event': 'write', 'context': 4, 'level': 'info', 'text': 'b'},
+      {'event': 'recontext', 'id': 5, 'replaces': 4, 'parent': 1, 'title': 'iter 3'},
+      {'event': 'write', 'context': 5, 'level': 'info', 'text': 'c'},
+      {'event': 'pop', 'id': 5},
+      {'event': 'push', 'id': 6, 'parent': 1, 'title': 'empty'},
+      {'event': 'pop', 'id': 6},
+      {'event': 'write', 'context': 1, 'level': 'error', 'text': 'multiple..\n  ..lines'},
+      {'event': 'write', 'context': 1, 'level': 'info', 'text': 'generating'},
+      {'event': 'open', 'context': 1, 'level': 'user', 'name': 'test.dat', 'file': tests[1]},
+      {'event': 'pop', 'id': 1},
+      {'event': 'push', 'id': 7, 'parent': None, 'title': 'generate_test'},
+      {'event': 'open', 'context': 7, 'level': 'warning', 'name': 'test.dat', 'file': tests[2]},
+      {'event': 'pop', 'id': 7},
+      {'event': 'push', 'id': 8, 'parent': None, 'title': 'context step=0'},
+      {'event': 'write', 'context': 8, 'level': 'info', 'text': 'foo'},
+      {'event': 'recontext', 'id': 9, 'replaces': 8, 'parent': None, 'title': 'context step=1'},
+      {'event': 'write', 'context': 9, 'level': 'info', 'text': 'bar'},
+      {'event': 'pop', 'id': 9},
+      {'event': 'open', 'context': None, 'level': 'error', 'name': 'same.dat', 'file': tests[2]},
+      {'event': 'open', 'context': None, 'level': 'debug', 'name': 'dbg.dat', 'file': tests[3]},
+      {'event': 'write', 'context': None, 'level': 'debug', 'text': 'dbg'},
+      {'event': 'write', 'context': None, 'level': 'warning', 'text': 'warn'}])
+
+  def test_buffering(self):
+    with tempfile.TemporaryDirectory() as tmpdir, treelog.JsonLinesLog(tmpdir, title='test') as jsonlog:
+      jsonlog.write('x', treelog.proto.Level.info)
+      self.assertEqual(os.path.getsize(os.path.join(tmpdir, 'log.jsonl')), 0)
+      jsonlog.flush()
+      with open(os.path.join(tmpdir, 'log.jsonl'), 'r') as f:
+        self.assertEqual([json.loads(line)['event'] for line in f], ['start', 'write'])
+
 class SimplifiedRecordLog(Log):
 
   @contextlib.contextmanager
@@ -492,6 +757,272 @@ class FilterLog(Log):
       ('close', 2, b'test3'),
       ('write', 'warn', treelog.proto.Level.warning)])
 
+  def test_rules(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    filterlog = treelog.FilterLog(recordlog, minlevel=treelog.proto.Level.warning, rules={
+      'solve > newton*': treelog.proto.Level.info,
+      'solve > newton* > iter *': treelog.proto.Level.debug,
+      'solve > * > iter 1': treelog.proto.Level.error})
+    with treelog.set(filterlog):
+      treelog.info('a')
+      with treelog.context('solve'):
+        treelog.info('b')
+        with treelog.context('newton'):
+          treelog.info('c')
+          treelog.debug('d')
+          with treelog.context('iter {}', 0) as format:
+            treelog.debug('e')
+            format(1)
+            treelog.warning('f')
+            format(2)
+            treelog.debug('g')
+          with treelog.infofile('x', 'w') as f:
+            f.write('x')
+        with treelog.context('picard'), treelog.context('iter 0'):
+          treelog.info('h')
+    self.assertEqual([message for message in recordlog._messages if message[0] in ('write', 'open')], [
+      ('write', 'c', treelog.proto.Level.info),
+      ('write', 'e', treelog.proto.Level.debug),
+      ('write', 'g', treelog.proto.Level.debug),
+      ('open', 0, 'x', 'w', treelog.proto.Level.info)])
+
+  def test_rules_order(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    filterlog = treelog.FilterLog(recordlog, minlevel=treelog.proto.Level.warning, rules={
+      'a > x': treelog.proto.Level.error,
+      '*': treelog.proto.Level.error,
+      'a': treelog.proto.Level.debug})
+    with treelog.set(filterlog):
+      with treelog.context('a'):
+        treelog.debug('in a')
+      with treelog.context('b'):
+        treelog.warning('in b')
+    self.assertEqual([message for message in recordlog._messages if message[0] == 'write'], [
+      ('write', 'in a', treelog.proto.Level.debug)])
+
+  def test_maxdepth(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    filterlog = treelog.FilterLog(recordlog, minlevel=treelog.proto.Level.info, maxdepth=1)
+    with treelog.set(filterlog), treelog.context('a'):
+      with treelog.context('b {}', 0) as format:
+        treelog.info('x')
+        format(1)
+        treelog.debug('y')
+      treelog.info('z')
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'a'),
+      ('write', 'x', treelog.proto.Level.info),
+      ('write', 'z', treelog.proto.Level.info),
+      ('popcontext',)])
+
+class RingBufferLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with StdoutLog.output_tester(self) as stdoutlog:
+      ringlog = treelog.RingBufferLog(stdoutlog)
+      yield ringlog
+      ringlog.dump()
+
+  def test_capacity(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    ringlog = treelog.RingBufferLog(recordlog, capacity=3)
+    ringlog.pushcontext('a')
+    ringlog.pushcontext('b')
+    ringlog.write('x', treelog.proto.Level.debug)
+    ringlog.recontext('c')
+    ringlog.write('y', treelog.proto.Level.info)
+    self.assertEqual(recordlog._messages, [])
+    ringlog.write('z', treelog.proto.Level.error)
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'a'),
+      ('pushcontext', 'b'),
+      ('recontext', 'c'),
+      ('write', 'y', treelog.proto.Level.info),
+      ('write', 'z', treelog.proto.Level.error),
+      ('popcontext',),
+      ('popcontext',)])
+    recordlog._messages.clear()
+    ringlog.popcontext()
+    ringlog.dump()
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'a'),
+      ('pushcontext', 'c'),
+      ('popcontext',),
+      ('popcontext',)])
+
+  def test_exception(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.set(treelog.RingBufferLog(recordlog)):
+      try:
+        with treelog.context('a'), treelog.context('b'):
+          treelog.debug('x')
+          raise ValueError
+      except ValueError:
+        with treelog.context('handler'):
+          treelog.info('y')
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'a'),
+      ('pushcontext', 'b'),
+      ('write', 'x', treelog.proto.Level.debug),
+      ('popcontext',),
+      ('popcontext',)])
+
+  def test_generatorexit(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    def items():
+      with treelog.context('items'):
+        treelog.debug('x')
+        yield 1
+        yield 2
+    with treelog.set(treelog.RingBufferLog(recordlog)):
+      generator = items()
+      next(generator)
+      generator.close()
+    self.assertEqual(recordlog._messages, [])
+
+  def test_file(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    ringlog = treelog.RingBufferLog(recordlog, minlevel=treelog.proto.Level.warning)
+    with ringlog.open('a.dat', 'wb', treelog.proto.Level.info) as f:
+      f.write(b'a')
+    self.assertEqual(recordlog._messages, [])
+    with ringlog.open('b.txt', 'w', treelog.proto.Level.warning) as f:
+      f.write('b')
+    self.assertEqual(recordlog._messages, [
+      ('open', 0, 'a.dat', 'wb', treelog.proto.Level.info),
+      ('close', 0, b'a'),
+      ('open', 1, 'b.txt', 'w', treelog.proto.Level.warning),
+      ('close', 1, 'b')])
+
+class DeferredLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with capture() as captured:
+      yield treelog.DeferredLog(treelog.StdoutLog())
+    self.assertEqual(captured.stdout,
+      'my message\n'
+      'test.dat\n'
+      'my context > multiple..\n'
+      '  ..lines\n'
+      'my context > generating\n'
+      'my context > test.dat\n'
+      'generate_test > test.dat\n'
+      'same.dat\n'
+      'dbg.dat\n'
+      'dbg\n'
+      'warn\n')
+
+  def test_exception(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.set(treelog.DeferredLog(recordlog)):
+      for i in range(3):
+        try:
+          with treelog.context('iter {}', i):
+            treelog.info('start')
+            with treelog.infofile('data', 'w') as f:
+              f.write('data')
+            if i == 1:
+              raise ValueError
+        except ValueError:
+          with treelog.context('handler'):
+            treelog.info('recovered')
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'iter 1'),
+      ('write', 'start', treelog.proto.Level.info),
+      ('open', 0, 'data', 'w', treelog.proto.Level.info),
+      ('close', 0, 'data'),
+      ('popcontext',)])
+
+  def test_generatorexit(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    def items():
+      with treelog.context('items'):
+        treelog.info('x')
+        yield 1
+        yield 2
+    with treelog.set(treelog.DeferredLog(recordlog)):
+      generator = items()
+      next(generator)
+      generator.close()
+    self.assertEqual(recordlog._messages, [])
+
+  def test_defer(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.set(recordlog):
+      with treelog.defer('iter {}', 0) as format:
+        treelog.info('a')
+        format(1)
+        treelog.info('b')
+        with treelog.infofile('data', 'w') as f:
+          treelog.warning('c')
+          f.write('data')
+        treelog.debug('d')
+      with treelog.defer('quiet'):
+        treelog.info('e')
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'iter 1'),
+      ('write', 'b', treelog.proto.Level.info),
+      ('write', 'c', treelog.proto.Level.warning),
+      ('open', 0, 'data', 'w', treelog.proto.Level.info),
+      ('close', 0, 'data'),
+      ('write', 'd', treelog.proto.Level.debug),
+      ('popcontext',)])
+
+class RateLimitLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with StdoutLog.output_tester(self) as stdoutlog:
+      ratelimitlog = treelog.RateLimitLog(stdoutlog, maxmessages=3)
+      yield ratelimitlog
+      ratelimitlog.flush()
+
+  def test_repeat(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    ratelimitlog = treelog.RateLimitLog(recordlog)
+    for text in 'aaab':
+      ratelimitlog.write(text, treelog.proto.Level.info)
+    ratelimitlog.write('b', treelog.proto.Level.warning)
+    ratelimitlog.write('b', treelog.proto.Level.warning)
+    ratelimitlog.pushcontext('x')
+    ratelimitlog.write('b', treelog.proto.Level.warning)
+    ratelimitlog.popcontext()
+    self.assertEqual(recordlog._messages, [
+      ('write', 'a', treelog.proto.Level.info),
+      ('write', 'a (repeated 2 more times)', treelog.proto.Level.info),
+      ('write', 'b', treelog.proto.Level.info),
+      ('write', 'b', treelog.proto.Level.warning),
+      ('write', 'b (repeated 1 more times)', treelog.proto.Level.warning),
+      ('pushcontext', 'x'),
+      ('write', 'b', treelog.proto.Level.warning),
+      ('popcontext',)])
+
+  def test_maxmessages(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    ratelimitlog = treelog.RateLimitLog(recordlog, maxmessages=1)
+    ratelimitlog.pushcontext('iter 0')
+    for text in 'abc':
+      ratelimitlog.write(text, treelog.proto.Level.info)
+    ratelimitlog.write('d', treelog.proto.Level.error)
+    ratelimitlog.recontext('iter 1')
+    ratelimitlog.write('e', treelog.proto.Level.info)
+    ratelimitlog.popcontext()
+    for text in 'fg':
+      ratelimitlog.write(text, treelog.proto.Level.debug)
+    ratelimitlog.flush()
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'iter 0'),
+      ('write', 'a', treelog.proto.Level.info),
+      ('write', 'd', treelog.proto.Level.error),
+      ('write', '2 info messages suppressed', treelog.proto.Level.info),
+      ('recontext', 'iter 1'),
+      ('write', 'e', treelog.proto.Level.info),
+      ('popcontext',),
+      ('write', 'f', treelog.proto.Level.debug),
+      ('write', '1 debug messages suppressed', treelog.proto.Level.debug)])
+
 class LoggingLog(Log):
 
   @contextlib.contextmanager
@@ -524,6 +1055,792 @@ class NullLog(Log):
     with treelog.disable():
       self.assertIsInstance(treelog.current, treelog.NullLog)
 
+class TimingLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    timinglog = treelog.TimingLog()
+    with unittest.mock.patch('time.perf_counter', side_effect=itertools.count()), unittest.mock.patch('time.process_time', side_effect=itertools.count(step=.5)):
+      yield timinglog
+    self.assertEqual(timinglog.totext(),
+      '      wall        cpu    count        min        max  context\n'
+      '     8.000      4.000        1      8.000      8.000  my context\n'
+      '     4.000      2.000        4      1.000      1.000    iter #\n'
+      '     1.000      0.500        1      1.000      1.000    empty\n'
+      '     1.000      0.500        1      1.000      1.000  generate_test\n'
+      '     2.000      1.000        2      1.000      1.000  context step=#\n')
+    self.assertEqual(timinglog.tocollapsed(),
+      'my context 3000000\n'
+      'my context;iter # 4000000\n'
+      'my context;empty 1000000\n'
+      'generate_test 1000000\n'
+      'context step=# 2000000\n')
+    self.assertIn('<tr><td>4.000</td><td>2.000</td><td>4</td><td>1.000</td><td>1.000</td><td style="padding-left:2em">iter #</td></tr>\n', timinglog.tohtml())
+
+  def test_key(self):
+    timinglog = treelog.TimingLog(key=str)
+    with treelog.set(timinglog), treelog.iter.plain('iter', 'ab') as items:
+      for item in items:
+        pass
+    self.assertEqual([node.title for node in timinglog.root.children.values()], ['iter 0', 'iter 1', 'iter 2'])
+
+class SamplingLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with treelog.SamplingLog(interval=.0001) as samplinglog:
+      yield samplinglog
+    self.assertEqual(samplinglog.currentcontext, [])
+    self.assertLessEqual({path for path, stack in samplinglog.samples}, {(), ('my context',), ('my context', 'iter #'), ('my context', 'empty'), ('generate_test',), ('context step=#',)})
+
+  def test_hotspot(self):
+    with treelog.SamplingLog(interval=.001) as samplinglog, treelog.set(samplinglog), treelog.context('busy'):
+      _busy(.1)
+    self.assertIn((('busy',), '_busy'), {(path, stack[-1].rsplit('(')[-1].rstrip(')')) for path, stack in samplinglog.samples})
+    self.assertRegex(samplinglog.totext(), r'(?m)^busy: [0-9]+ samples\n    self   total  function\n  [ 0-9.]+%  [ 0-9.]+%  .*tests.py:[0-9]+\(_busy\)\n')
+
+  def test_render(self):
+    samplinglog = treelog.SamplingLog()
+    samplinglog.samples.update({
+      (('a',), ('m.py:1(main)', 'm.py:5(f)')): 3,
+      (('a',), ('m.py:1(main)', 'm.py:9(g)')): 1,
+      (('a', 'b;c'), ('m.py:1(main)', 'm.py:9(g)')): 2,
+      ((), ('m.py:1(main)',)): 1})
+    self.assertEqual(samplinglog.totext(limit=1),
+      '(no context): 1 samples\n'
+      '    self   total  function\n'
+      '  100.0%  100.0%  m.py:1(main)\n'
+      'a: 4 samples\n'
+      '    self   total  function\n'
+      '   75.0%   75.0%  m.py:5(f)\n'
+      'a > b;c: 2 samples\n'
+      '    self   total  function\n'
+      '  100.0%  100.0%  m.py:9(g)\n')
+    self.assertEqual(samplinglog.tocollapsed(),
+      'a;b,c;m.py:1(main);m.py:9(g) 2\n'
+      'a;m.py:1(main);m.py:5(f) 3\n'
+      'a;m.py:1(main);m.py:9(g) 1\n'
+      'm.py:1(main) 1\n')
+
+class StatsLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    recordlog = treelog.RecordLog()
+    statslog = treelog.StatsLog(recordlog)
+    yield statslog
+    self.assertEqual(statslog.name, 'RecordLog')
+    self.assertEqual(statslog.messages, {'debug': 1, 'info': 6, 'user': 1, 'warning': 1, 'error': 1})
+    self.assertEqual(statslog.files, {'debug': 1, 'info': 1, 'user': 1, 'warning': 1, 'error': 1})
+    self.assertEqual(statslog.contexts, 9)
+    self.assertEqual(statslog.filesize, 25)
+    self.assertEqual(list(statslog.time), ['pushcontext', 'popcontext', 'recontext', 'write', 'open'])
+    reference = treelog.RecordLog()
+    with treelog.set(reference):
+      self.generate()
+    self.assertEqual(recordlog._messages, reference._messages)
+    statslog.close()
+
+  def test_stats(self):
+    a = treelog.StatsLog(treelog.NullLog(), name='a')
+    b = treelog.StatsLog(treelog.NullLog(), name='b')
+    with treelog.set(treelog.TeeLog(a, b)):
+      treelog.info('x' * 2000)
+      with treelog.context('c'), a.open('f', 'wb', treelog.proto.Level.user) as f:
+        f.write(b'x' * 2000)
+        f.writelines([b'x' * 1000])
+    self.assertEqual(a.filesize, 3000)
+    report = treelog.stats()
+    self.assertRegex(report,
+      r'(?m)^a\n'
+      r'  messages: 0 debug, 1 info, 0 user, 0 warning, 0 error\n'
+      r'  files: 0 debug, 0 info, 1 user, 0 warning, 0 error\n'
+      r'  contexts: 1\n'
+      r'  size: 2\.0K text, 2\.9K files\n'
+      r'  time: [0-9.]+s \(pushcontext [0-9.]+s, popcontext [0-9.]+s, recontext [0-9.]+s, write [0-9.]+s, open [0-9.]+s\)\n'
+      r'b\n')
+    a.close()
+    b.close()
+    self.assertNotIn('\nb\n', treelog.stats())
+
+class TraceLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with unittest.mock.patch('time.perf_counter', side_effect=itertools.count()), treelog.TraceLog(tmpdir) as tracelog:
+        yield tracelog
+      self.assertEqual(tracelog.filename, 'trace.json')
+      with open(os.path.join(tmpdir, 'trace.json'), 'r') as f:
+        events = json.load(f)
+    self.assertEqual({(event['pid'], event['tid']) for event in events}, {(os.getpid(), threading.get_ident())})
+    self.assertEqual([event['ts'] for event in events], [i * 1e6 for i in range(len(events))])
+    self.assertEqual([(event['ph'], event['name'], event.get('cat')) for event in events], [
+      ('i', 'my message', 'user'),
+      ('i', 'test.dat', 'info'),
+      ('B', 'my context', None),
+      ('B', 'iter 0', None),
+      ('E', '', None),
+      ('B', 'iter 1', None),
+      ('i', 'a', 'info'),
+      ('E', '', None),
+      ('B', 'iter 2', None),
+      ('i', 'b', 'info'),
+      ('E', '', None),
+      ('B', 'iter 3', None),
+      ('i', 'c', 'info'),
+      ('E', '', None),
+      ('B', 'empty', None),
+      ('E', '', None),
+      ('i', 'multiple..\n  ..lines', 'error'),
+      ('i', 'generating', 'info'),
+      ('i', 'test.dat', 'user'),
+      ('E', '', None),
+      ('B', 'generate_test', None),
+      ('i', 'test.dat', 'warning'),
+      ('E', '', None),
+      ('B', 'context step=0', None),
+      ('i', 'foo', 'info'),
+      ('E', '', None),
+      ('B', 'context step=1', None),
+      ('i', 'bar', 'info'),
+      ('E', '', None),
+      ('i', 'same.dat', 'error'),
+      ('i', 'dbg.dat', 'debug'),
+      ('i', 'dbg', 'debug'),
+      ('i', 'warn', 'warning')])
+
+  @unittest.skipIf(compiled, 'compiled loggers are not collected until closed')
+  def test_unclosed(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      tracelog = treelog.TraceLog(tmpdir)
+      tracelog.pushcontext('a')
+      tracelog.pushcontext('b')
+      with self.assertWarns(ResourceWarning):
+        del tracelog
+        gc.collect()
+      with open(os.path.join(tmpdir, 'trace.json'), 'r') as f:
+        events = json.load(f)
+    self.assertEqual([(event['ph'], event['name']) for event in events], [('B', 'a'), ('B', 'b'), ('E', ''), ('E', '')])
+
+class ResourceLog(Log):
+
+  @contextlib.contextmanager
+  def output_tester(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    tracemalloc.start()
+    try:
+      yield treelog.ResourceLog(recordlog)
+    finally:
+      tracemalloc.stop()
+    messages = []
+    for message in recordlog._messages:
+      if message[0] == 'write' and message[2] == treelog.proto.Level.debug and message[1] != 'dbg':
+        self.assertRegex(message[1], r'^peak rss [0-9.]+[KMG]? \(\+[0-9.]+[BKMG]\), allocated [+-][0-9.]+[BKMG](, read [0-9.]+[BKMG], written [0-9.]+[BKMG])?$')
+        messages.append('summary')
+      else:
+        messages.append(message[0])
+    self.assertEqual(messages, ['write', 'open', 'close', 'pushcontext',
+      'pushcontext', 'summary', 'recontext', 'write', 'summary', 'recontext', 'write', 'summary', 'recontext', 'write', 'summary', 'popcontext',
+      'pushcontext', 'summary', 'popcontext', 'write', 'open', 'write', 'close', 'summary', 'popcontext',
+      'pushcontext', 'open', 'close', 'summary', 'popcontext',
+      'pushcontext', 'write', 'summary', 'recontext', 'write', 'summary', 'popcontext',
+      'open', 'close', 'open', 'close', 'write', 'write'])
+
+  def test_level(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.set(treelog.ResourceLog(recordlog, level=treelog.proto.Level.info)), treelog.context('a'):
+      pass
+    self.assertEqual([message[0] for message in recordlog._messages], ['pushcontext', 'write', 'popcontext'])
+    self.assertEqual(recordlog._messages[1][2], treelog.proto.Level.info)
+
+  def test_formatbytes(self):
+    self.assertEqual(treelog._resource.formatbytes(1023), '1023B')
+    self.assertEqual(treelog._resource.formatbytes(1536), '1.5K')
+    self.assertEqual(treelog._resource.formatbytes(3 * 2**30), '3.0G')
+
+class Budget(unittest.TestCase):
+
+  def setUp(self):
+    self.recordlog = treelog.RecordLog(simplify=False)
+    self.previous = treelog.current
+    treelog.current = self.recordlog
+
+  def tearDown(self):
+    treelog.current = self.previous
+
+  def assertMessages(self, *patterns):
+    messages = self.recordlog._messages
+    self.assertEqual(len(messages), len(patterns), messages)
+    for message, pattern in zip(messages, patterns):
+      self.assertEqual(message[0], pattern[0])
+      if len(pattern) > 2:
+        self.assertEqual(message[2], pattern[2])
+      if len(pattern) > 1:
+        self.assertRegex(message[1], pattern[1])
+
+  def test_context(self):
+    with treelog.context('a', budget=10):
+      treelog.info('hi')
+    self.assertMessages(
+      ('pushcontext', '^a$'),
+      ('write', '^hi$', treelog.proto.Level.info),
+      ('write', r'^a took 0\.[0-9]{3}s of budget 10\.000s$', treelog.proto.Level.debug),
+      ('popcontext',))
+
+  def waitforexpiry(self):
+    # wait for the watchdog to expire the innermost budget of this thread
+    self.assertTrue(treelog._watchdog._local.budgets[-1].expired.wait(10))
+
+  def test_context_exceeded(self):
+    with treelog.context('a {}', 1, budget=.01):
+      self.waitforexpiry()
+      self.assertMessages(('pushcontext', '^a 1$')) # the warning is written by this thread only
+    self.assertMessages(
+      ('pushcontext', '^a 1$'),
+      ('write', r'(?s)^a 1 exceeded budget of 0\.010s, currently at:\n.*, in test_context_exceeded\n.*, in waitforexpiry\n.*$', treelog.proto.Level.warning),
+      ('write', r'^a 1 took [0-9.]+s, exceeding budget of 0\.010s$', treelog.proto.Level.warning),
+      ('popcontext',))
+
+  def test_context_change(self):
+    with treelog.context('a', budget=.01):
+      self.waitforexpiry()
+      with treelog.context('b'):
+        pass
+    self.assertMessages(
+      ('pushcontext', '^a$'),
+      ('write', r'(?s)^a exceeded budget of 0\.010s, currently at:\n.*, in waitforexpiry\n.*$', treelog.proto.Level.warning),
+      ('pushcontext', '^b$'),
+      ('popcontext',),
+      ('write', r'^a took [0-9.]+s, exceeding budget of 0\.010s$', treelog.proto.Level.warning),
+      ('popcontext',))
+
+  def test_wrap(self):
+    with treelog.iter.wrap(['a', 'b', 'c'], [False, True], budget=.5) as items:
+      for wait in items:
+        if wait:
+          self.waitforexpiry()
+    self.assertMessages(
+      ('pushcontext', '^a$'),
+      ('write', r'^a took [0-9.]+s'),
+      ('recontext', '^b$'),
+      ('write', r'^b took [0-9.]+s'),
+      ('recontext', '^c$'),
+      ('write', r'(?s)^c exceeded budget of 0\.500s, currently at:\n.*, in test_wrap\n.*, in waitforexpiry\n.*$', treelog.proto.Level.warning),
+      ('write', r'^c took [0-9.]+s, exceeding budget of 0\.500s$', treelog.proto.Level.warning),
+      ('popcontext',))
+
+  def test_many(self):
+    for i in range(100):
+      with treelog.context('a', budget=60):
+        pass
+    self.assertLessEqual(len(treelog._watchdog.watchdog._heap), 51)
+
+class Merge(unittest.TestCase):
+
+  def setUp(self):
+    tmpdir = tempfile.TemporaryDirectory()
+    self.addCleanup(tmpdir.cleanup)
+    self.tmpdir = tmpdir.name
+
+  def record(self, name, log, timestamps=None):
+    with unittest.mock.patch('time.monotonic', side_effect=timestamps) if timestamps else contextlib.suppress(), treelog.set(log):
+      with treelog.context('solve'):
+        treelog.info('step 1')
+        with treelog.context('empty'):
+          pass
+        with treelog.userfile('mesh.dat', 'wb') as f:
+          f.write(b'mesh')
+        treelog.warning('step 2')
+    path = os.path.join(self.tmpdir, name)
+    if isinstance(log, treelog.RecordLog):
+      with open(path, 'wb') as f:
+        pickle.dump(log, f)
+    else:
+      log.close()
+    return path
+
+  def merged(self, paths, **kwargs):
+    recordlog = treelog.RecordLog(simplify=False)
+    treelog.merge(recordlog, paths, **kwargs)
+    return recordlog._messages
+
+  def test_sequential(self):
+    a = self.record('a.pickle', treelog.RecordLog())
+    b = self.record('b', treelog.BinaryLog(os.path.join(self.tmpdir, 'b')))
+    c = self.record('c', treelog.JsonLinesLog(os.path.join(self.tmpdir, 'c')))
+    self.assertEqual(self.merged([a, b, c]), [
+      ('pushcontext', a),
+      ('pushcontext', 'solve'),
+      ('write', 'step 1', treelog.proto.Level.info),
+      ('open', 0, 'mesh.dat', 'wb', treelog.proto.Level.user),
+      ('close', 0, b'mesh'),
+      ('write', 'step 2', treelog.proto.Level.warning),
+      ('popcontext',),
+      ('popcontext',),
+      ('pushcontext', b),
+      ('pushcontext', 'solve'),
+      ('write', 'step 1', treelog.proto.Level.info),
+      ('write', 'mesh.dat is identical to mesh.dat in {} > solve'.format(a), treelog.proto.Level.user),
+      ('write', 'step 2', treelog.proto.Level.warning),
+      ('popcontext',),
+      ('popcontext',),
+      ('pushcontext', c),
+      ('pushcontext', 'solve'),
+      ('write', 'step 1', treelog.proto.Level.info),
+      ('write', 'mesh.dat is identical to mesh.dat in {} > solve'.format(a), treelog.proto.Level.user),
+      ('write', 'step 2', treelog.proto.Level.warning),
+      ('popcontext',),
+      ('popcontext',)])
+
+  def test_interleave(self):
+    a = self.record('a', treelog.BinaryLog(os.path.join(self.tmpdir, 'a')), timestamps=[0, 2, 4, 6, 8, 10, 12, 14, 16])
+    b = self.record('b', treelog.JsonLinesLog(os.path.join(self.tmpdir, 'b')), timestamps=[1, 3, 5, 7, 9, 11, 13, 15, 17])
+    # files are merged at the time of closing, which for b is 9 and for a is 10
+    self.assertEqual(self.merged([a, b], interleave=True, dedup=False), [
+      ('pushcontext', a),
+      ('pushcontext', 'solve'),
+      ('write', 'step 1', treelog.proto.Level.info),
+      ('popcontext',),
+      ('popcontext',),
+      ('pushcontext', b),
+      ('pushcontext', 'solve'),
+      ('write', 'step 1', treelog.proto.Level.info),
+      ('open', 0, 'mesh.dat', 'wb', treelog.proto.Level.user),
+      ('close', 0, b'mesh'),
+      ('popcontext',),
+      ('popcontext',),
+      ('pushcontext', a),
+      ('pushcontext', 'solve'),
+      ('open', 1, 'mesh.dat', 'wb', treelog.proto.Level.user),
+      ('close', 1, b'mesh'),
+      ('popcontext',),
+      ('popcontext',),
+      ('pushcontext', b),
+      ('pushcontext', 'solve'),
+      ('write', 'step 2', treelog.proto.Level.warning),
+      ('popcontext',),
+      ('popcontext',),
+      ('pushcontext', a),
+      ('pushcontext', 'solve'),
+      ('write', 'step 2', treelog.proto.Level.warning),
+      ('popcontext',),
+      ('popcontext',)])
+
+  def test_interleave_without_timestamps(self):
+    a = self.record('a.pickle', treelog.RecordLog())
+    with self.assertRaises(ValueError):
+      self.merged([a, a], interleave=True)
+
+  def test_cli(self):
+    a = self.record('a.pickle', treelog.RecordLog())
+    b = self.record('b', treelog.BinaryLog(os.path.join(self.tmpdir, 'b')))
+    with capture() as captured:
+      treelog.__main__.main(['merge', os.path.join(self.tmpdir, 'out'), a, b])
+    self.assertEqual(captured.stdout, 'merged 2 logs to log.html\n')
+    with open(os.path.join(self.tmpdir, 'out', 'log.html')) as f:
+      html = f.read()
+    self.assertIn('<div class="title">{}</div>'.format(b), html)
+    self.assertIn('mesh.dat is identical to mesh.dat in {} &gt; solve'.format(a), html)
+
+class Collector(unittest.TestCase):
+
+  def test_process(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.Collector(recordlog) as collector:
+      process = multiprocessing.Process(target=_collector_process, args=(collector.log, 'a'))
+      process.start()
+      process.join()
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'process {}'.format(process.pid)),
+      ('pushcontext', 'task a'),
+      ('write', 'working', treelog.proto.Level.info),
+      ('open', 0, 'a.txt', 'w', treelog.proto.Level.user),
+      ('close', 0, 'a\nb\n'),
+      ('open', 1, 'a.dat', 'wb', treelog.proto.Level.info),
+      ('close', 1, b'a'),
+      ('popcontext',),
+      ('popcontext',)])
+
+  def test_pool(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.Collector(recordlog, title='worker {pid}') as collector, treelog.set(collector.log):
+      treelog.info('parent')
+      with multiprocessing.Pool(2, initializer=collector.log.install) as pool:
+        self.assertEqual(pool.map(_collector_task, 'abcd'), list('abcd'))
+    contexts = [message[1] for message in recordlog._messages if message[0] == 'pushcontext']
+    self.assertEqual(contexts[:1], ['worker {}'.format(os.getpid())])
+    self.assertEqual(sorted(set(title for title in contexts if title.startswith('task'))), ['task a', 'task b', 'task c', 'task d'])
+    self.assertEqual(sorted(message[2] for message in recordlog._messages if message[0] == 'close' and isinstance(message[2], bytes)), [b'a', b'b', b'c', b'd'])
+    self.assertEqual(recordlog._messages.count(('popcontext',)), len(contexts))
+
+@unittest.skipIf(sys.version_info < (3, 8), 'shared memory requires Python 3.8 or higher')
+class SharedMemoryCollector(unittest.TestCase):
+
+  def test_process(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.SharedMemoryCollector(recordlog, nrings=2) as collector:
+      process = multiprocessing.Process(target=_collector_process, args=(collector.log, 'a'))
+      process.start()
+      process.join()
+      stagingdir = collector.log._stagingdir
+    self.assertFalse(os.path.exists(stagingdir))
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'process {}'.format(process.pid)),
+      ('pushcontext', 'task a'),
+      ('write', 'working', treelog.proto.Level.info),
+      ('open', 0, 'a.txt', 'w', treelog.proto.Level.user),
+      ('close', 0, 'a\nb\n'),
+      ('open', 1, 'a.dat', 'wb', treelog.proto.Level.info),
+      ('close', 1, b'a'),
+      ('popcontext',),
+      ('popcontext',)])
+
+  def test_wraparound(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.SharedMemoryCollector(recordlog, nrings=1, capacity=64, interval=.001) as collector, treelog.set(collector.log):
+      for i in range(100):
+        treelog.info('message {}'.format(i))
+      treelog.info('x' * 1000)
+    self.assertEqual([message[1] for message in recordlog._messages if message[0] == 'write'], ['message {}'.format(i) for i in range(100)] + ['x' * 1000])
+
+  def test_pool(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.SharedMemoryCollector(recordlog, nrings=3) as collector:
+      with multiprocessing.Pool(2, initializer=collector.log.install) as pool:
+        self.assertEqual(pool.map(_collector_task, 'abcd'), list('abcd'))
+    contexts = [message[1] for message in recordlog._messages if message[0] == 'pushcontext']
+    self.assertEqual(sorted(set(title for title in contexts if title.startswith('task'))), ['task a', 'task b', 'task c', 'task d'])
+    self.assertEqual(recordlog._messages.count(('popcontext',)), len(contexts))
+
+  def test_reuse(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.SharedMemoryCollector(recordlog, nrings=2, interval=.001) as collector:
+      with multiprocessing.Pool(2, initializer=collector.log.install, maxtasksperchild=1) as pool:
+        self.assertEqual(pool.map(_collector_task, 'abcdef', chunksize=1), list('abcdef'))
+    contexts = [message[1] for message in recordlog._messages if message[0] == 'pushcontext']
+    self.assertEqual(sorted(set(title for title in contexts if title.startswith('task'))), ['task a', 'task b', 'task c', 'task d', 'task e', 'task f'])
+    self.assertEqual(len(set(title for title in contexts if title.startswith('process'))), 6)
+    self.assertEqual(recordlog._messages.count(('popcontext',)), len(contexts))
+
+  def test_killed(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    with treelog.SharedMemoryCollector(recordlog, nrings=1, interval=.001) as collector:
+      process = multiprocessing.Process(target=_collector_killed, args=(collector.log,))
+      process.start()
+      process.join()
+      collector.log.write('parent', treelog.proto.Level.info)
+    self.assertEqual(recordlog._messages, [
+      ('pushcontext', 'process {}'.format(process.pid)),
+      ('write', 'killed', treelog.proto.Level.info),
+      ('popcontext',),
+      ('pushcontext', 'process {}'.format(os.getpid())),
+      ('write', 'parent', treelog.proto.Level.info),
+      ('popcontext',)])
+
+  def test_exhausted(self):
+    with treelog.SharedMemoryCollector(treelog.RecordLog(), nrings=1) as collector:
+      collector.log.write('parent', treelog.proto.Level.info)
+      with self.assertRaises(RuntimeError):
+        collector.log._claim()
+
+  def test_inactive(self):
+    collector = treelog.SharedMemoryCollector(treelog.RecordLog(), nrings=1)
+    with self.assertRaises(RuntimeError):
+      collector.log
+    with collector:
+      collector.log.write('parent', treelog.proto.Level.info)
+    with self.assertRaises(RuntimeError):
+      collector.log
+
+@unittest.skipIf(not hasattr(os, 'register_at_fork'), 'fork handlers not supported on platform')
+class Fork(unittest.TestCase):
+
+  def fork(self, log):
+    pid = os.fork()
+    if not pid:
+      status = 1
+      try:
+        log.write('child message', treelog.proto.Level.info)
+        log.close()
+        status = 0
+      finally:
+        os._exit(status)
+    self.assertEqual(os.waitpid(pid, 0)[1], 0)
+    return pid
+
+  def test_htmllog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.HtmlLog(tmpdir, title='test') as htmllog:
+        htmllog.pushcontext('ctx')
+        htmllog.write('parent before', treelog.proto.Level.info)
+        pid = self.fork(htmllog)
+        htmllog.write('parent after', treelog.proto.Level.info)
+        htmllog.popcontext()
+      with open(os.path.join(tmpdir, 'log.html')) as f:
+        parent = f.read()
+      with open(os.path.join(tmpdir, 'log-1.html')) as f:
+        child = f.read()
+    self.assertIn('forked <a href="log-1.html">log-1.html</a>', parent)
+    self.assertIn('parent after', parent)
+    self.assertNotIn('child message', parent)
+    self.assertEqual(parent.count('<div class="title">ctx</div>'), 1)
+    self.assertIn('<title>test (pid {})</title>'.format(pid), child)
+    self.assertIn('<div class="title">ctx</div>', child)
+    self.assertIn('child message', child)
+    self.assertNotIn('parent', child)
+
+  def test_binarylog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.BinaryLog(tmpdir, title='test') as binarylog:
+        binarylog.pushcontext('ctx')
+        pid = self.fork(binarylog)
+        binarylog.write('parent', treelog.proto.Level.info)
+        binarylog.popcontext()
+      loaded = {}
+      for name in 'log.treelog', 'log-1.treelog':
+        with open(os.path.join(tmpdir, name), 'rb') as f:
+          title, events = treelog._binary.load(f)
+          loaded[name] = title, [message for t, message in events]
+    self.assertEqual(loaded['log.treelog'], ('test', [('pushcontext', 'ctx'), ('write', 'parent', treelog.proto.Level.info), ('popcontext',)]))
+    self.assertEqual(loaded['log-1.treelog'], ('test (pid {})'.format(pid), [('pushcontext', 'ctx'), ('write', 'child message', treelog.proto.Level.info)]))
+
+  def test_jsonlineslog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.JsonLinesLog(tmpdir, title='test') as jsonlog:
+        jsonlog.pushcontext('ctx')
+        pid = self.fork(jsonlog)
+        jsonlog.popcontext()
+      with open(os.path.join(tmpdir, 'log.jsonl')) as f:
+        parent = [json.loads(line) for line in f]
+      with open(os.path.join(tmpdir, 'log-1.jsonl')) as f:
+        child = [json.loads(line) for line in f]
+    self.assertEqual([(event['event'], event.get('file')) for event in parent], [('start', None), ('push', None), ('fork', 'log-1.jsonl'), ('pop', None)])
+    self.assertEqual([(event['event'], event.get('title') or event.get('text')) for event in child], [('start', 'test (pid {})'.format(pid)), ('push', 'ctx'), ('write', 'child message')])
+
+  def test_tracelog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.TraceLog(tmpdir) as tracelog:
+        tracelog.pushcontext('ctx')
+        pid = self.fork(tracelog)
+        tracelog.write('parent', treelog.proto.Level.info)
+        tracelog.popcontext()
+      with open(os.path.join(tmpdir, 'trace.json')) as f:
+        parent = json.load(f)
+      with open(os.path.join(tmpdir, 'trace-1.json')) as f:
+        child = json.load(f)
+    self.assertEqual([(event['ph'], event['name']) for event in parent], [('B', 'ctx'), ('i', 'parent'), ('E', '')])
+    self.assertEqual([(event['ph'], event['name'], event['pid']) for event in child], [('B', 'ctx', pid), ('i', 'child message', pid), ('E', '', pid)])
+
+  def test_unregister(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.HtmlLog(tmpdir) as htmllog:
+        self.assertIn(id(htmllog), treelog._fork._loggers)
+      self.assertNotIn(id(htmllog), treelog._fork._loggers)
+
+  def test_pool(self):
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.HtmlLog(tmpdir, title='test') as htmllog, treelog.BinaryLog(os.path.join(tmpdir, 'bin'), title='test') as binarylog, treelog.set(treelog.TeeLog(htmllog, binarylog)):
+        with concurrent.futures.ProcessPoolExecutor(2, mp_context=context) as executor:
+          self.assertEqual(list(executor.map(abs, [-1, -2])), [1, 2])
+        self.assertNotIn('log-1.html', os.listdir(tmpdir))
+        self.assertEqual(os.listdir(os.path.join(tmpdir, 'bin')), ['log.treelog'])
+        with concurrent.futures.ProcessPoolExecutor(1, mp_context=context) as executor:
+          self.assertEqual(executor.submit(_forked_task, 'a').result(), 'a')
+      with open(os.path.join(tmpdir, 'log.html')) as f:
+        parent = f.read()
+      with open(os.path.join(tmpdir, 'log-1.html')) as f:
+        child = f.read()
+      with open(os.path.join(tmpdir, 'bin', 'log-1.treelog'), 'rb') as f:
+        title, events = treelog._binary.load(f)
+        messages = [message for t, message in events]
+    self.assertEqual(parent.count('forked'), 1)
+    self.assertIn('forked <a href="log-1.html">log-1.html</a>', parent)
+    self.assertIn('<div class="item" data-loglevel="1">a</div>', child)
+    self.assertEqual(messages, [('write', 'a', treelog.proto.Level.info)])
+
+class Pickle(unittest.TestCase):
+
+  def test_datalog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      datalog = treelog.DataLog(tmpdir)
+      with concurrent.futures.ProcessPoolExecutor(2) as executor:
+        self.assertEqual(list(executor.map(_pickled_task, [datalog, datalog], 'ab')), ['a', 'b'])
+      self.assertEqual(sorted(os.listdir(tmpdir)), ['a.dat', 'b.dat'])
+      with open(os.path.join(tmpdir, 'a.dat')) as f:
+        self.assertEqual(f.read(), 'a')
+
+  def test_htmllog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      # spawn rather than fork, as a forked worker would get a log of its own
+      with treelog.HtmlLog(tmpdir, title='test') as htmllog, concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+        htmllog.pushcontext('submit')
+        self.assertEqual(executor.submit(_pickled_task, htmllog, 'a').result(), 'a')
+        htmllog.popcontext()
+      with open(os.path.join(tmpdir, 'log.html')) as f:
+        parent = f.read()
+      with open(os.path.join(tmpdir, 'log-1.html')) as f:
+        child = f.read()
+      self.assertNotIn('log-1.html', parent)
+      self.assertIn('continued from <a href="log.html">log.html</a>', child)
+      self.assertIn('<title>test (pid ', child)
+      self.assertIn('<div class="title">task a</div>', child)
+      self.assertIn('<a href="{}.dat" download="a.dat">a.dat</a>'.format(hashlib.sha1(b'a').hexdigest()), child)
+      self.assertTrue(child.endswith(treelog._html.HTMLFOOT))
+
+  def test_htmllog_copy(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.HtmlLog(tmpdir, title='test') as htmllog:
+        htmllog.write('before', treelog.proto.Level.info)
+        copy = pickle.loads(pickle.dumps(htmllog))
+        self.assertEqual(sorted(name for name in os.listdir(tmpdir) if name.endswith('.html')), ['log.html'])
+        copy.write('copied', treelog.proto.Level.info)
+        copy.close()
+        htmllog.write('after', treelog.proto.Level.info)
+      with open(os.path.join(tmpdir, 'log.html')) as f:
+        parent = f.read()
+      with open(os.path.join(tmpdir, 'log-1.html')) as f:
+        child = f.read()
+    self.assertNotIn('log-1.html', parent)
+    self.assertIn('after', parent)
+    self.assertIn('continued from <a href="log.html">log.html</a>', child)
+    self.assertIn('copied', child)
+
+class ThreadSafety(unittest.TestCase):
+
+  nthreads = 8
+  nwrites = 200
+
+  def hammer(self, log):
+    def task(i):
+      log.pushcontext('thread {}'.format(i))
+      for j in range(self.nwrites):
+        if j % 50 == 0:
+          with log.open('file-{}-{}.dat'.format(i, j), 'wb', treelog.proto.Level.info) as f:
+            f.write(b'%d' % j)
+        log.write('msg-{}-{}'.format(i, j), treelog.proto.Level.info)
+      log.popcontext()
+    threads = [threading.Thread(target=task, args=(i,)) for i in range(self.nthreads)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+  def test_recordlog(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    self.hammer(recordlog)
+    commands = [message[0] for message in recordlog._messages]
+    self.assertEqual(commands.count('write'), self.nthreads * self.nwrites)
+    self.assertEqual(commands.count('open'), self.nthreads * 4)
+    self.assertEqual(commands.count('close'), self.nthreads * 4)
+
+  def test_stdoutlog(self):
+    with capture() as captured:
+      self.hammer(treelog.StdoutLog())
+    lines = captured.stdout.splitlines()
+    self.assertEqual(sum('msg-' in line for line in lines), self.nthreads * self.nwrites)
+    self.assertEqual(sum(line.endswith('.dat') for line in lines), self.nthreads * 4)
+
+  def test_htmllog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.HtmlLog(tmpdir, title='test') as htmllog:
+        self.hammer(htmllog)
+      with open(os.path.join(tmpdir, 'log.html')) as f:
+        html = f.read()
+    self.assertEqual(html.count('msg-'), self.nthreads * self.nwrites)
+    self.assertEqual(html.count('<div class="context">'), html.count('<div class="end"></div>'))
+
+  def test_binarylog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.BinaryLog(tmpdir, title='test') as binarylog:
+        self.hammer(binarylog)
+      with open(os.path.join(tmpdir, 'log.treelog'), 'rb') as f:
+        title, events = treelog._binary.load(f)
+        commands = [message[0] for t, message in events]
+    self.assertEqual(commands.count('write'), self.nthreads * self.nwrites)
+    self.assertEqual(commands.count('close'), self.nthreads * 4)
+
+  def test_jsonlineslog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.JsonLinesLog(tmpdir, title='test') as jsonlog:
+        self.hammer(jsonlog)
+      with open(os.path.join(tmpdir, 'log.jsonl')) as f:
+        events = [json.loads(line)['event'] for line in f]
+    self.assertEqual(events.count('write'), self.nthreads * self.nwrites)
+    self.assertEqual(events.count('push'), events.count('pop'))
+
+  def test_sqlitelog(self):
+    with tempfile.TemporaryDirectory() as tmpdir, treelog.SqliteLog(tmpdir, batchsize=10) as sqlitelog:
+      self.hammer(sqlitelog)
+      self.assertEqual(len(sqlitelog.messages()), self.nthreads * self.nwrites)
+
+  def test_tracelog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      with treelog.TraceLog(tmpdir) as tracelog:
+        self.hammer(tracelog)
+      with open(os.path.join(tmpdir, 'trace.json')) as f:
+        events = json.load(f)
+    self.assertEqual(sum(event['ph'] == 'B' for event in events), sum(event['ph'] == 'E' for event in events))
+
+  def test_datalog(self):
+    with tempfile.TemporaryDirectory() as tmpdir:
+      self.hammer(treelog.DataLog(tmpdir))
+      self.assertEqual(len(os.listdir(tmpdir)), self.nthreads * 4)
+
+  def assertStructure(self, messages, maxdepth=None):
+    # contexts are balanced and never popped beyond the top level, and every
+    # file is closed exactly once
+    depth = 0
+    files = set()
+    for message in messages:
+      if message[0] == 'pushcontext':
+        depth += 1
+        if maxdepth is not None:
+          self.assertLessEqual(depth, maxdepth)
+      elif message[0] == 'popcontext':
+        depth -= 1
+        self.assertGreaterEqual(depth, 0)
+      elif message[0] == 'recontext':
+        self.assertGreater(depth, 0)
+      elif message[0] == 'open':
+        self.assertNotIn(message[1], files)
+        files.add(message[1])
+      elif message[0] == 'close':
+        files.remove(message[1])
+    self.assertEqual(depth, 0)
+    self.assertEqual(files, set())
+
+  def test_filterlog(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    self.hammer(treelog.FilterLog(recordlog, minlevel=treelog.proto.Level.info, rules={'thread *': treelog.proto.Level.warning, 'thread 0': treelog.proto.Level.info}, maxdepth=1))
+    self.assertStructure(recordlog._messages, maxdepth=1)
+
+  def test_deferredlog(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    self.hammer(treelog.DeferredLog(recordlog, minlevel=treelog.proto.Level.info))
+    self.assertStructure(recordlog._messages)
+    commands = [message[0] for message in recordlog._messages]
+    self.assertEqual(commands.count('write'), self.nthreads * self.nwrites)
+    self.assertEqual(commands.count('pushcontext'), self.nthreads)
+
+  def test_ratelimitlog(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    log = treelog.RateLimitLog(recordlog)
+    self.hammer(log)
+    log.flush()
+    self.assertStructure(recordlog._messages)
+    self.assertEqual(sorted(message[1] for message in recordlog._messages if message[0] == 'write'), sorted('msg-{}-{}'.format(i, j) for i in range(self.nthreads) for j in range(self.nwrites)))
+
+  def test_resourcelog(self):
+    recordlog = treelog.RecordLog(simplify=False)
+    self.hammer(treelog.ResourceLog(recordlog, level=treelog.proto.Level.debug))
+    self.assertStructure(recordlog._messages)
+    writes = [message for message in recordlog._messages if message[0] == 'write']
+    self.assertEqual(sum(message[2] == treelog.proto.Level.info for message in writes), self.nthreads * self.nwrites)
+    # every summary is written right before a popcontext
+    self.assertEqual([recordlog._messages[i+1] for i, message in enumerate(recordlog._messages) if message[0] == 'write' and message[2] == treelog.proto.Level.debug], [('popcontext',)] * self.nthreads)
+
 class Iter(unittest.TestCase):
 
   def setUp(self):
@@ -580,6 +1897,7 @@ class Iter(unittest.TestCase):
       ('write', 'hi', treelog.proto.Level.info),
       ('popcontext',))
 
+  @unittest.skipIf(compiled, 'compiled generators are not closed when collected')
   def test_break_notentered(self):
     with self.assertWarns(ResourceWarning):
       for item in treelog.iter.plain('test', [1,2,3]):
@@ -637,6 +1955,119 @@ class Iter(unittest.TestCase):
       ('recontext', 'test 100%'),
       ('popcontext',))
 
+  def test_fraction_braces(self):
+    with treelog.iter.fraction('{test}', 'ab') as items:
+      self.assertEqual(list(items), list('ab'))
+    self.assertMessages(
+      ('pushcontext', '{test} 0/2'),
+      ('recontext', '{test} 1/2'),
+      ('recontext', '{test} 2/2'),
+      ('popcontext',))
+
+  def test_fraction_eta(self):
+    with unittest.mock.patch('time.monotonic', side_effect=[0., 2., 3.]), treelog.iter.fraction('test', 'abc', eta=True) as items:
+      self.assertEqual(list(items), list('abc'))
+    self.assertMessages(
+      ('pushcontext', 'test 0/3'),
+      ('recontext', 'test 1/3'),
+      ('recontext', 'test 2/3 (0.5/s, eta 0:04)'),
+      ('recontext', 'test 3/3 (0.667/s, eta 0:02)'),
+      ('popcontext',))
+
+  def test_fraction_eta_interval(self):
+    with unittest.mock.patch('time.monotonic', side_effect=[0., .05, .2, .25, .4]), treelog.iter.fraction('test', 'abcde', eta=True) as items:
+      self.assertEqual(list(items), list('abcde'))
+    self.assertMessages(
+      ('pushcontext', 'test 0/5'),
+      ('recontext', 'test 1/5'),
+      ('recontext', 'test 2/5'),
+      ('recontext', 'test 3/5 (10/s, eta 0:00)'),
+      ('recontext', 'test 4/5 (10/s, eta 0:00)'),
+      ('recontext', 'test 5/5 (10/s, eta 0:00)'),
+      ('popcontext',))
+
+  def test_percentage_eta(self):
+    with unittest.mock.patch('time.monotonic', side_effect=[0., 3600., 7200., 10800.]), treelog.iter.percentage('test', 'abcd', eta=True) as items:
+      self.assertEqual(list(items), list('abcd'))
+    self.assertMessages(
+      ('pushcontext', 'test 0%'),
+      ('recontext', 'test 25%'),
+      ('recontext', 'test 50% (0.000278/s, eta 3:00:00)'),
+      ('recontext', 'test 75% (0.000278/s, eta 2:00:00)'),
+      ('recontext', 'test 100% (0.000278/s, eta 1:00:00)'),
+      ('popcontext',))
+
+  def test_fraction_generator(self):
+    with treelog.iter.fraction('test', (c for c in 'abc')) as items:
+      self.assertEqual(list(items), list('abc'))
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('recontext', 'test 2'),
+      ('recontext', 'test 3'),
+      ('popcontext',))
+
+  def test_fraction_estimate(self):
+    with treelog.iter.fraction('test', (c for c in 'abc'), length=2) as items:
+      self.assertEqual(list(items), list('abc'))
+    self.assertMessages(
+      ('pushcontext', 'test 0/2'),
+      ('recontext', 'test 1/2'),
+      ('recontext', 'test 2/2'),
+      ('recontext', 'test 3/3'),
+      ('popcontext',))
+
+  def test_fraction_length_hint(self):
+    class queue:
+      def __init__(self, items):
+        self.items = list(items)
+      def __iter__(self):
+        return self
+      def __next__(self):
+        if not self.items:
+          raise StopIteration
+        item = self.items.pop(0)
+        if item == 'b':
+          self.items.append('d')
+        return item
+      def __length_hint__(self):
+        return len(self.items)
+    with treelog.iter.fraction('test', queue('abc')) as items:
+      self.assertEqual(list(items), list('abcd'))
+    self.assertMessages(
+      ('pushcontext', 'test 0/3'),
+      ('recontext', 'test 1/3'),
+      ('recontext', 'test 2/4'),
+      ('recontext', 'test 3/4'),
+      ('recontext', 'test 4/4'),
+      ('popcontext',))
+
+  def test_fraction_multiple_mixed(self):
+    with treelog.iter.fraction('test', 'abcd', (i for i in range(3))) as items:
+      self.assertEqual(list(items), [('a',0), ('b',1), ('c',2)])
+    self.assertMessages(
+      ('pushcontext', 'test 0/4'),
+      ('recontext', 'test 1/4'),
+      ('recontext', 'test 2/4'),
+      ('recontext', 'test 3/4'),
+      ('popcontext',))
+
+  def test_percentage_generator(self):
+    with treelog.iter.percentage('test', (c for c in 'ab')) as items:
+      self.assertEqual(list(items), list('ab'))
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('recontext', 'test 2'),
+      ('popcontext',))
+
+  def test_percentage_empty(self):
+    with treelog.iter.percentage('test', '') as items:
+      self.assertEqual(list(items), [])
+    self.assertMessages(
+      ('pushcontext', 'test 100%'),
+      ('popcontext',))
+
   def test_send(self):
     def titles():
       a = yield 'value'
@@ -654,15 +2085,367 @@ class Iter(unittest.TestCase):
       ('write', 'hi', treelog.proto.Level.info),
       ('popcontext',))
 
+class AsyncIter(unittest.TestCase):
+
+  def setUp(self):
+    self.recordlog = treelog.RecordLog(simplify=False)
+    self.previous = treelog.current
+    treelog.current = self.recordlog
+    self.loop = asyncio.new_event_loop()
+
+  def tearDown(self):
+    self.loop.close()
+    treelog.current = self.previous
+
+  def assertMessages(self, *msg):
+    self.assertEqual(self.recordlog._messages, list(msg))
+
+  def consume(self, aiterable):
+    async def consume():
+      items = []
+      async for item in aiterable:
+        items.append(item)
+      return items
+    return self.loop.run_until_complete(consume())
+
+  def test_context(self):
+    async def test():
+      async with treelog.iter.plain('test', arange(3)) as myiter:
+        async for i in myiter:
+          treelog.info('hi')
+    self.loop.run_until_complete(test())
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('write', 'hi', treelog.proto.Level.info),
+      ('recontext', 'test 2'),
+      ('write', 'hi', treelog.proto.Level.info),
+      ('recontext', 'test 3'),
+      ('write', 'hi', treelog.proto.Level.info),
+      ('popcontext',))
+
+  def test_nocontext(self):
+    self.assertEqual(self.consume(treelog.iter.plain('test', arange(2))), [0, 1])
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('recontext', 'test 2'),
+      ('popcontext',))
+
+  def test_break_entered(self):
+    async def test():
+      async with treelog.iter.plain('test', arange(3)) as myiter:
+        async for i in myiter:
+          break
+        self.assertMessages(
+          ('pushcontext', 'test 0'),
+          ('recontext', 'test 1'))
+    self.loop.run_until_complete(test())
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('popcontext',))
+
+  def test_exception(self):
+    async def test():
+      async with treelog.iter.plain('test', arange(3)) as myiter:
+        async for i in myiter:
+          raise ValueError
+    with self.assertRaises(ValueError):
+      self.loop.run_until_complete(test())
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('popcontext',))
+
+  def test_break_notentered(self):
+    async def test():
+      async for i in treelog.iter.plain('test', arange(3)):
+        break
+    with self.assertWarns(ResourceWarning):
+      self.loop.run_until_complete(test())
+      gc.collect()
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('popcontext',))
+
+  def test_fraction(self):
+    self.assertEqual(self.consume(treelog.iter.fraction('test', arange(3), length=3)), [0, 1, 2])
+    self.assertMessages(
+      ('pushcontext', 'test 0/3'),
+      ('recontext', 'test 1/3'),
+      ('recontext', 'test 2/3'),
+      ('recontext', 'test 3/3'),
+      ('popcontext',))
+
+  def test_fraction_unsized(self):
+    self.assertEqual(self.consume(treelog.iter.fraction('test', arange(2))), [0, 1])
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('recontext', 'test 2'),
+      ('popcontext',))
+
+  def test_percentage(self):
+    self.assertEqual(self.consume(treelog.iter.percentage('test', arange(4), 'abcd')), [(0, 'a'), (1, 'b'), (2, 'c'), (3, 'd')])
+    self.assertMessages(
+      ('pushcontext', 'test 0%'),
+      ('recontext', 'test 25%'),
+      ('recontext', 'test 50%'),
+      ('recontext', 'test 75%'),
+      ('recontext', 'test 100%'),
+      ('popcontext',))
+
+  def test_multiple(self):
+    self.assertEqual(self.consume(treelog.iter.plain('test', arange(3), 'ab')), [(0, 'a'), (1, 'b')])
+
+  def test_sync_in_async_for(self):
+    self.assertEqual(self.consume(treelog.iter.plain('test', 'ab')), ['a', 'b'])
+    self.assertMessages(
+      ('pushcontext', 'test 0'),
+      ('recontext', 'test 1'),
+      ('recontext', 'test 2'),
+      ('popcontext',))
+
+  def test_async_in_sync_for(self):
+    with self.assertRaises(TypeError):
+      list(treelog.iter.plain('test', arange(2)))
+
+  @unittest.skipIf(sys.version_info < (3, 7), 'task local loggers require contextvars')
+  def test_concurrent_tasks(self):
+    records = {}
+    async def task(name):
+      with treelog.set(treelog.RecordLog(simplify=False), local=True) as record:
+        async for i in treelog.iter.plain(name, arange(2)):
+          await asyncio.sleep(0)
+          treelog.info('{} {}'.format(name, i))
+      records[name] = record._messages
+    async def main():
+      await asyncio.gather(task('a'), task('b'))
+    self.loop.run_until_complete(main())
+    self.assertMessages()
+    self.assertIs(treelog.current, self.recordlog)
+    for name in 'ab':
+      self.assertEqual(records[name], [
+        ('pushcontext', name + ' 0'),
+        ('recontext', name + ' 1'),
+        ('write', name + ' 0', treelog.proto.Level.info),
+        ('recontext', name + ' 2'),
+        ('write', name + ' 1', treelog.proto.Level.info),
+        ('popcontext',)])
+
+  def test_set_in_task(self):
+    other = treelog.RecordLog(simplify=False)
+    async def main():
+      with treelog.set(other):
+        await self.loop.run_in_executor(None, treelog.info, 'executor')
+    self.loop.run_until_complete(main())
+    self.assertMessages()
+    self.assertIs(treelog.current, self.recordlog)
+    self.assertEqual(other._messages, [('write', 'executor', treelog.proto.Level.info)])
+
+class PMap(unittest.TestCase):
+
+  def setUp(self):
+    self.recordlog = treelog.RecordLog(simplify=False)
+    self.previous = treelog.current
+    treelog.current = self.recordlog
+
+  def tearDown(self):
+    treelog.current = self.previous
+
+  def assertMessages(self, *msg):
+    self.assertEqual(self.recordlog._messages, list(msg))
+
+  def test_threads(self):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+      self.assertEqual(list(treelog.iter.pmap('test', _pmap_func, [.03, .02, .01], executor=executor)), [3, 2, 1])
+    self.assertMessages(
+      ('pushcontext', 'test 0/3'),
+      ('recontext', 'test 1/3'),
+      ('pushcontext', 'sleep'),
+      ('write', '0.03', treelog.proto.Level.info),
+      ('popcontext',),
+      ('recontext', 'test 2/3'),
+      ('pushcontext', 'sleep'),
+      ('write', '0.02', treelog.proto.Level.info),
+      ('popcontext',),
+      ('recontext', 'test 3/3'),
+      ('pushcontext', 'sleep'),
+      ('write', '0.01', treelog.proto.Level.info),
+      ('popcontext',),
+      ('popcontext',))
+
+  def test_processes(self):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=2) as executor:
+      self.assertEqual(list(treelog.iter.pmap('test', _pmap_func, [.02, .01], executor=executor)), [2, 1])
+    self.assertMessages(
+      ('pushcontext', 'test 0/2'),
+      ('recontext', 'test 1/2'),
+      ('pushcontext', 'sleep'),
+      ('write', '0.02', treelog.proto.Level.info),
+      ('popcontext',),
+      ('recontext', 'test 2/2'),
+      ('pushcontext', 'sleep'),
+      ('write', '0.01', treelog.proto.Level.info),
+      ('popcontext',),
+      ('popcontext',))
+
+  def test_caller_messages(self):
+    for item in treelog.iter.pmap('test', _pmap_func, [0]):
+      treelog.info('caller')
+    self.assertMessages(
+      ('pushcontext', 'test 0/1'),
+      ('recontext', 'test 1/1'),
+      ('pushcontext', 'sleep'),
+      ('write', '0', treelog.proto.Level.info),
+      ('popcontext',),
+      ('write', 'caller', treelog.proto.Level.info),
+      ('popcontext',))
+
+  def test_exception(self):
+    with self.assertRaises(ValueError):
+      list(treelog.iter.pmap('test', _pmap_func, [-1]))
+    self.assertMessages(
+      ('pushcontext', 'test 0/1'),
+      ('recontext', 'test 1/1'),
+      ('pushcontext', 'sleep'),
+      ('write', '-1', treelog.proto.Level.info),
+      ('popcontext',),
+      ('popcontext',))
+
+  def test_exception_running(self):
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+      with self.assertRaises(ValueError):
+        list(treelog.iter.pmap('test', _pmap_late, [-1, .05], executor=executor))
+      self.assertIs(treelog.current, self.recordlog)
+    self.assertNotIn(('write', 'late', treelog.proto.Level.info), self.recordlog._messages)
+
+  def test_interleaved(self):
+    a = treelog.iter.pmap('a', _pmap_func, [0, 0])
+    b = treelog.iter.pmap('b', _pmap_func, [0])
+    self.assertEqual(next(a), 0)
+    self.assertEqual(next(b), 0)
+    self.assertIs(treelog.current, self.recordlog)
+    self.assertEqual(list(a), [0])
+    self.assertEqual(list(b), [])
+    self.assertIs(treelog.current, self.recordlog)
+
+  def test_abandoned(self):
+    items = treelog.iter.pmap('test', _pmap_func, [0, 0])
+    self.assertEqual(next(items), 0)
+    self.assertIs(treelog.current, self.recordlog)
+    del items
+    gc.collect()
+    self.assertIs(treelog.current, self.recordlog)
+    treelog.info('after')
+    self.assertEqual(self.recordlog._messages[-1], ('write', 'after', treelog.proto.Level.info))
+
+  def test_set_in_worker(self):
+    other = treelog.RecordLog(simplify=False)
+    def func(arg):
+      with treelog.set(other):
+        treelog.info('other')
+      treelog.info('record')
+    list(treelog.iter.pmap('test', func, [0]))
+    self.assertIs(treelog.current, self.recordlog)
+    self.assertEqual(other._messages, [('write', 'other', treelog.proto.Level.info)])
+    self.assertIn(('write', 'record', treelog.proto.Level.info), self.recordlog._messages)
+    self.assertNotIn(('write', 'other', treelog.proto.Level.info), self.recordlog._messages)
+
 class DocTest(unittest.TestCase):
 
   def test_docs(self):
     doctest.testmod(treelog)
 
+@unittest.skipIf(sys.version_info < (3, 7), 'lazy imports require module level __getattr__')
+class LazyImport(unittest.TestCase):
+
+  def test_lazy(self):
+    # run in a fresh interpreter, as the tests import everything
+    script = (
+      'import sys, treelog\n'
+      'assert "treelog._sqlite" not in sys.modules and "sqlite3" not in sys.modules\n'
+      'assert "treelog._shm" not in sys.modules and "concurrent.futures" not in sys.modules\n'
+      'assert "SqliteLog" in dir(treelog)\n'
+      'assert treelog.SqliteLog.__module__ == "treelog"\n'
+      'assert "treelog._sqlite" in sys.modules\n')
+    subprocess.run([sys.executable, '-c', script], check=True)
+
+  def test_missing(self):
+    with self.assertRaises(AttributeError):
+      treelog.nonexistent
+
 del Log # hide from unittest discovery
 
 ## INTERNALS
 
+class arange:
+  'asynchronous range'
+
+  def __init__(self, n):
+    self.i = 0
+    self.n = n
+
+  def __aiter__(self):
+    return self
+
+  async def __anext__(self):
+    if self.i == self.n:
+      raise StopAsyncIteration
+    self.i += 1
+    await asyncio.sleep(0)
+    return self.i - 1
+
+@treelog.withcontext
+def sleep(seconds):
+  treelog.info(str(seconds))
+  if seconds < 0:
+    raise ValueError('negative sleep length')
+  time.sleep(seconds)
+
+def _pickled_task(log, name):
+  with treelog.set(log), treelog.context('task {}', name), treelog.infofile(name + '.dat', 'w') as f:
+    f.write(name)
+  return name
+
+def _forked_task(name):
+  treelog.info(name)
+  return name
+
+def _collector_process(log, name):
+  log.install()
+  _collector_task(name)
+
+def _collector_killed(log):
+  log.write('killed', treelog.proto.Level.info)
+  os._exit(0) # without releasing the ring
+
+def _collector_task(name):
+  with treelog.context('task {}', name):
+    treelog.info('working')
+    with treelog.userfile(name + '.txt', 'w') as f:
+      f.write('a\nb\n')
+    with treelog.infofile(name + '.dat', 'wb') as f:
+      f.write(name.encode())
+  return name
+
+def _busy(seconds):
+  t0 = time.perf_counter()
+  while time.perf_counter() - t0 < seconds:
+    pass
+
+def _pmap_late(seconds):
+  if seconds < 0:
+    raise ValueError
+  time.sleep(seconds)
+  treelog.info('late')
+
+def _pmap_func(seconds):
+  sleep(seconds)
+  return round(seconds * 100)
+
 @contextlib.contextmanager
 def capture():
   with tempfile.TemporaryFile('w+', newline='') as f:
@@ -20,26 +20,117 @@
 
 version = '1.0b7'
 
-import sys, functools, contextlib, typing, typing_extensions
+import sys, functools, contextlib, importlib, threading, typing, typing_extensions
 
-from . import iter, proto
-from ._forward import TeeLog, FilterLog
+from . import iter, proto, _watchdog
+from ._forward import TeeLog, FilterLog, RingBufferLog, DeferredLog, RateLimitLog
 from ._silent import NullLog, DataLog, RecordLog
 from ._text import StdoutLog, RichOutputLog, LoggingLog
 from ._html import HtmlLog
 
-for _log in TeeLog, FilterLog, NullLog, DataLog, RecordLog, StdoutLog, RichOutputLog, LoggingLog, HtmlLog:
+for _log in TeeLog, FilterLog, RingBufferLog, DeferredLog, RateLimitLog, NullLog, DataLog, RecordLog, StdoutLog, RichOutputLog, LoggingLog, HtmlLog:
   _log.__module__ = __name__
 del _log
 
+# The remaining loggers are imported upon first access, such that importing
+# treelog does not pay for the dependencies of loggers that are not used.
+_lazy = {
+  'TimingLog': '_timing', 'SamplingLog': '_timing', 'TraceLog': '_timing',
+  'ResourceLog': '_resource',
+  'StatsLog': '_stats', 'stats': '_stats',
+  'JsonLinesLog': '_json',
+  'BinaryLog': '_binary',
+  'SqliteLog': '_sqlite',
+  'merge': '_merge',
+  'QueueLog': '_queue', 'Collector': '_queue',
+  'SharedMemoryLog': '_shm', 'SharedMemoryCollector': '_shm',
+  'SocketLog': '_socket', 'CollectorServer': '_socket',
+}
+
+def _import(name: str) -> typing.Any:
+  obj = getattr(importlib.import_module('.' + _lazy[name], __name__), name)
+  if isinstance(obj, type):
+    obj.__module__ = __name__
+  globals()[name] = obj
+  return obj
+
+if typing.TYPE_CHECKING:
+  from ._timing import TimingLog, SamplingLog, TraceLog
+  from ._resource import ResourceLog
+  from ._stats import StatsLog, stats
+  from ._json import JsonLinesLog
+  from ._binary import BinaryLog
+  from ._sqlite import SqliteLog
+  from ._merge import merge
+  from ._queue import QueueLog, Collector
+  from ._shm import SharedMemoryLog, SharedMemoryCollector
+  from ._socket import SocketLog, CollectorServer
+elif sys.version_info < (3, 7): # module level __getattr__ is not supported
+  for _name in _lazy:
+    _import(_name)
+  del _name
+else:
+  def __getattr__(name: str) -> typing.Any:
+    if name not in _lazy:
+      raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+    return _import(name)
+
+  def __dir__() -> typing.List[str]:
+    return sorted(globals().keys() | _lazy.keys())
+
 Log = None # For backwards compatibility.
 
 current = FilterLog(TeeLog(StdoutLog(), DataLog()), minlevel=proto.Level.info) # type: proto.Log
 
-@contextlib.contextmanager
-def set(logger: proto.Log) -> typing.Generator[proto.Log, None, None]:
-  '''Set logger as current.'''
+class _LocalOverride:
+  '''Thread-local stand-in for :class:`contextvars.ContextVar`.'''
+
+  def __init__(self) -> None:
+    self._local = threading.local()
+
+  def get(self, default: typing.Any) -> typing.Any:
+    return getattr(self._local, 'value', default)
+
+  def set(self, value: typing.Any) -> typing.Any:
+    token = self._local.__dict__.get('value', _LocalOverride)
+    self._local.value = value
+    return token
+
+  def reset(self, token: typing.Any) -> None:
+    if token is _LocalOverride:
+      del self._local.value
+    else:
+      self._local.value = token
+
+# Worker threads of iter.pmap and local loggers may log to a logger of their
+# own, which overrides current in that thread or task only. Functions of this
+# module obtain the logger via _current rather than reading current directly.
+# Python < 3.7 lacks contextvars, in which case the override is per thread.
+if sys.version_info >= (3, 7):
+  import contextvars
+  _override = contextvars.ContextVar('treelog_override') # type: contextvars.ContextVar[proto.Log]
+else:
+  _override = _LocalOverride()
+
+def _current() -> proto.Log:
+  return _override.get(current)
 
+@contextlib.contextmanager
+def set(logger: proto.Log, *, local: bool = False) -> typing.Generator[proto.Log, None, None]:
+  '''Set logger as current.
+
+  If ``local`` is true the logger is set for the current thread only, and in
+  an :mod:`asyncio` task for that task only, including the tasks it creates,
+  on Python 3.7 and higher. In a worker thread of :func:`treelog.iter.pmap`,
+  or within a local logger, the logger is always set locally.'''
+
+  if local or _override.get(None) is not None:
+    token = _override.set(logger)
+    try:
+      yield logger
+    finally:
+      _override.reset(token)
+    return
   global current
   old = current
   try:
@@ -51,7 +142,7 @@ def set(logger: proto.Log) -> typing.Generator[proto.Log, None, None]:
 def add(logger: proto.Log) -> typing_extensions.ContextManager[proto.Log]:
   '''Add logger to current.'''
 
-  return set(TeeLog(current, logger))
+  return set(TeeLog(_current(), logger))
 
 def disable() -> typing_extensions.ContextManager[proto.Log]:
   '''Disable logger.'''
@@ -59,27 +150,49 @@ def disable() -> typing_extensions.ContextManager[proto.Log]:
   return set(NullLog())
 
 @contextlib.contextmanager
-def context(title: str, *initargs: typing.Any, **initkwargs: typing.Any) -> typing.Generator[typing.Optional[typing.Callable[..., None]], None, None]:
+def context(title: str, *initargs: typing.Any, budget: typing.Optional[float] = None, **initkwargs: typing.Any) -> typing.Generator[typing.Optional[typing.Callable[..., None]], None, None]:
   '''Enterable context.
 
   Returns an enterable object which upon enter creates a context with a given
   title, to be automatically closed upon exit. In case additional arguments are
   given the title is used as a format string, and a callable is returned that
-  allows for recontextualization from within the current with-block.'''
+  allows for recontextualization from within the current with-block.
+
+  If a ``budget`` in seconds is given, a warning is written to the log upon
+  the first change of context after the context exceeded it, or upon exit,
+  including the stack of the running thread at the time the budget expired,
+  and the actual duration is written to the log prior to closing the context.'''
 
-  log = current
+  log = _current()
   if initargs or initkwargs:
     format = title.format
     reformat = lambda *args, **kwargs: log.recontext(format(*args, **kwargs)) # type: typing.Optional[typing.Callable[..., None]]
     title = title.format(*initargs, **initkwargs)
   else:
     reformat = None
+  _watchdog.report()
   log.pushcontext(title)
+  watched = _watchdog.Budget(log, title, budget) if budget is not None else None
   try:
     yield reformat
   finally:
+    if watched:
+      watched.stop()
+    _watchdog.report()
     log.popcontext()
 
+@contextlib.contextmanager
+def defer(title: str, *initargs: typing.Any, minlevel: proto.Level = proto.Level.warning, **initkwargs: typing.Any) -> typing.Generator[typing.Optional[typing.Callable[..., None]], None, None]:
+  '''Enterable context of which the contents are logged only on failure.
+
+  Like :func:`context`, except that messages below ``minlevel`` are held back
+  and discarded upon exit, unless a message of level ``minlevel`` or higher is
+  written or an exception is raised, in which case all messages are written
+  to the current logger. See :class:`DeferredLog`.'''
+
+  with set(DeferredLog(_current(), minlevel)), context(title, *initargs, **initkwargs) as reformat:
+    yield reformat
+
 T = typing.TypeVar('T')
 
 def withcontext(f: typing.Callable[..., T]) -> typing.Callable[..., T]:
@@ -106,7 +219,7 @@ class _Print:
     sep : :class:`str`
         String inserted between values, default a space.
     '''
-    current.write(sep.join(map(str, args)), self._level)
+    _override.get(current).write(sep.join(map(str, args)), self._level)
 
   @typing.overload
   def open(self, name: str, mode: typing_extensions.Literal['w']) -> typing_extensions.ContextManager[typing.IO[str]]: ...
@@ -125,7 +238,7 @@ class _Print:
     '''
     if mode not in ('w', 'wb'):
       raise ValueError("expected mode 'w' or 'wb' but got {!r}".format(mode))
-    return current.open(name, mode, self._level)
+    return _current().open(name, mode, self._level)
 
 debug, info, user, warning, error = map(_Print, proto.Level)
 debugfile, infofile, userfile, warningfile, errorfile = debug.open, info.open, user.open, warning.open, error.open
@@ -0,0 +1,84 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+'''Command line tools for treelog output.'''
+
+import argparse, typing
+from . import _binary, _html, _merge, _silent, _socket
+
+def render(args: argparse.Namespace) -> None:
+  '''Render a binary log to html.'''
+
+  with open(args.logfile, 'rb') as f:
+    title, events = _binary.load(f)
+    with _html.HtmlLog(args.outdir, filename=args.filename, title=args.title or title) as htmllog:
+      _silent.replay((message for t, message in events), htmllog)
+  print('rendered {} to {}'.format(args.logfile, htmllog.filename))
+
+def merge(args: argparse.Namespace) -> None:
+  '''Merge recorded logs into a single html log.'''
+
+  with _html.HtmlLog(args.outdir, filename=args.filename, title=args.title or 'merge') as htmllog:
+    _merge.merge(htmllog, args.sources, interleave=args.interleave, dedup=not args.keep_duplicates)
+  print('merged {} logs to {}'.format(len(args.sources), htmllog.filename))
+
+def collect(args: argparse.Namespace) -> None:
+  '''Collect the output of socket logs until interrupted.'''
+
+  address = _socket.parseaddress(args.address)
+  server = _socket.CollectorServer(address, args.outdir, format=args.format)
+  print('collecting logs on {} to {}'.format(args.address, args.outdir), flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+
+def main(argv: typing.Optional[typing.Sequence[str]] = None) -> None:
+  parser = argparse.ArgumentParser(prog='python -m treelog', description=__doc__)
+  commands = parser.add_subparsers(dest='command', metavar='command')
+  commands.required = True
+  parser_render = commands.add_parser('render', help=render.__doc__, description=render.__doc__)
+  parser_render.add_argument('logfile', help='binary log written by BinaryLog')
+  parser_render.add_argument('outdir', help='output directory for the html log and attachments')
+  parser_render.add_argument('--filename', default='log.html', help='file name of the html log (default: log.html)')
+  parser_render.add_argument('--title', help='title of the html log (default: title of the binary log)')
+  parser_render.set_defaults(func=render)
+  parser_merge = commands.add_parser('merge', help=merge.__doc__, description=merge.__doc__)
+  parser_merge.add_argument('outdir', help='output directory for the html log and attachments')
+  parser_merge.add_argument('sources', nargs='+', help='RecordLog pickles, BinaryLog or JsonLinesLog files, or directories containing them')
+  parser_merge.add_argument('--interleave', action='store_true', help='interleave events by timestamp instead of concatenating logs')
+  parser_merge.add_argument('--keep-duplicates', action='store_true', help='write identical files repeatedly')
+  parser_merge.add_argument('--filename', default='log.html', help='file name of the html log (default: log.html)')
+  parser_merge.add_argument('--title', help='title of the html log (default: merge)')
+  parser_merge.set_defaults(func=merge)
+  parser_collect = commands.add_parser('collect', help=collect.__doc__, description=collect.__doc__)
+  parser_collect.add_argument('address', help='path of a unix socket, or host:port to listen on tcp')
+  parser_collect.add_argument('outdir', help='output directory, with a subdirectory per log')
+  parser_collect.add_argument('--format', choices=['html', 'data'], default='html', help='write every log as HtmlLog or DataLog (default: html)')
+  parser_collect.set_defaults(func=collect)
+  args = parser.parse_args(argv)
+  args.func(args)
+
+if __name__ == '__main__':
+  main()
+
+# vim:sw=2:sts=2:et
@@ -0,0 +1,242 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib, io, os, shutil, struct, sys, tempfile, threading, time, types, typing, warnings
+from . import proto, _io, _fork
+
+MAGIC = b'TREELOG\x01'
+
+PUSHCONTEXT, POPCONTEXT, RECONTEXT, WRITE, OPEN, CLOSE, END = range(7)
+
+_event = struct.Struct('<Bd') # opcode, time.monotonic
+_size = struct.Struct('<I')
+_datasize = struct.Struct('<Q')
+_open = struct.Struct('<IBB') # fid, level, binary
+
+Event = typing.Tuple[float, typing.Tuple[typing.Any, ...]]
+
+class BinaryLog:
+  '''Output compact binary stream of events.
+
+  All events are written with a :func:`time.monotonic` timestamp and without
+  any formatting, the contents of files included, such that logging is cheap
+  at runtime. The stream can be rendered afterwards, possibly on another
+  machine, to the same output as :class:`HtmlLog` via::
+
+    python -m treelog render log.treelog outdir
+
+  A process that is forked while the log is open continues in a new stream in
+  the same directory, which is created upon the first event of the child and
+  starts with the contexts that are active at the time of the fork.'''
+
+  def __init__(self, dirpath: str, *, filename: str = 'log.treelog', title: typing.Optional[str] = None, buffering: int = 2**16) -> None:
+    self._dir = _io.directory(dirpath)
+    self._file, self.filename = self._dir.openfirstunused(_io.sequence(filename), 'wb', buffering=buffering)
+    self._buffering = buffering
+    self._title = ' '.join(sys.argv) if title is None else title
+    self._file.write(MAGIC + encodestring(self._title))
+    self._fid = 0
+    self._contexts = [] # type: typing.List[str]
+    self._forked = False # whether the stream of a forked child is yet to be opened
+    self._lock = threading.Lock()
+    _fork.register(self)
+
+  def pushcontext(self, title: str) -> None:
+    data = encodestring(title)
+    with self._lock:
+      if self._forked:
+        self._startchild()
+      self._file.write(_event.pack(PUSHCONTEXT, time.monotonic()) + data)
+      self._contexts.append(title)
+
+  def popcontext(self) -> None:
+    with self._lock:
+      if self._forked:
+        self._startchild()
+      self._file.write(_event.pack(POPCONTEXT, time.monotonic()))
+      self._contexts.pop()
+
+  def recontext(self, title: str) -> None:
+    data = encodestring(title)
+    with self._lock:
+      if self._forked:
+        self._startchild()
+      self._file.write(_event.pack(RECONTEXT, time.monotonic()) + data)
+      self._contexts[-1] = title
+
+  def write(self, text: str, level: proto.Level) -> None:
+    data = bytes([level.value]) + encodestring(text)
+    with self._lock:
+      if self._forked:
+        self._startchild()
+      self._file.write(_event.pack(WRITE, time.monotonic()) + data)
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    binary = mode == 'wb'
+    with self._lock:
+      if self._forked:
+        self._startchild()
+      fid = self._fid
+      self._fid += 1
+      self._file.write(_event.pack(OPEN, time.monotonic()) + _open.pack(fid, level.value, binary) + encodestring(filename))
+    with tempfile.TemporaryFile('wb+') as raw:
+      try:
+        if binary:
+          yield raw
+        else:
+          f = io.TextIOWrapper(raw, encoding='utf-8')
+          try:
+            yield f
+          finally:
+            f.detach()
+      finally:
+        size = raw.seek(0, io.SEEK_END)
+        raw.seek(0)
+        with self._lock:
+          self._file.write(_event.pack(CLOSE, time.monotonic()) + _size.pack(fid) + _datasize.pack(size))
+          shutil.copyfileobj(raw, self._file)
+
+  def flush(self) -> None:
+    '''Write buffered events to disk.'''
+
+    with self._lock:
+      if not self._forked:
+        self._file.flush()
+
+  def _startchild(self) -> None:
+    # to be called with the lock held
+    self._forked = False
+    self._file, name = self._dir.openfirstunused(_io.sequence(self.filename), 'wb', buffering=self._buffering)
+    self._file.write(MAGIC + encodestring('{} (pid {})'.format(self._title, os.getpid())))
+    t = time.monotonic()
+    for title in self._contexts:
+      self._file.write(_event.pack(PUSHCONTEXT, t) + encodestring(title))
+    self._file.flush()
+    _fork.flushatexit(self._file)
+
+  def _beforefork(self) -> None:
+    # the lock is held until after the fork, such that the child does not inherit a half written event
+    self._lock.acquire()
+    if not self._file.closed:
+      self._file.flush()
+
+  def _afterfork(self, child: bool) -> None:
+    if child:
+      self._lock = threading.Lock()
+      if not self._file.closed:
+        self._file.close() # flushed before the fork, so this only releases the descriptor
+        self._forked = True
+    else:
+      self._lock.release()
+
+  def close(self) -> bool:
+    _fork.unregister(self)
+    if hasattr(self, '_file') and not self._file.closed:
+      with self._lock:
+        self._file.close()
+      return True
+    else:
+      return False
+
+  def __enter__(self) -> 'BinaryLog':
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    self.close()
+
+  def __del__(self) -> None:
+    if self.close():
+      warnings.warn('unclosed object {!r}'.format(self), ResourceWarning)
+
+def encodestring(s: str) -> bytes:
+  b = s.encode('utf-8', 'surrogateescape')
+  return _size.pack(len(b)) + b
+
+def load(f: typing.BinaryIO) -> typing.Tuple[str, typing.Iterator[Event]]:
+  '''Read title and events from a stream written by :class:`BinaryLog`.
+
+  Events are returned as pairs of timestamp and message, in the vocabulary of
+  :class:`treelog.RecordLog`. A stream that is truncated, for instance because
+  the writing process was killed, ends at the last complete event.'''
+
+  if f.read(len(MAGIC)) != MAGIC:
+    raise ValueError('not a treelog binary stream')
+  title = _readstring(f)
+  if title is None:
+    raise ValueError('truncated header')
+  return title, _events(f)
+
+def _events(f: typing.BinaryIO, modes: typing.Optional[typing.Dict[int, bool]] = None) -> typing.Iterator[Event]:
+  levels = list(proto.Level)
+  if modes is None:
+    modes = {}
+  while True:
+    head = f.read(_event.size)
+    if len(head) < _event.size:
+      return
+    opcode, t = _event.unpack(head)
+    if opcode == PUSHCONTEXT or opcode == RECONTEXT:
+      title = _readstring(f)
+      if title is None:
+        return
+      yield t, ('pushcontext' if opcode == PUSHCONTEXT else 'recontext', title)
+    elif opcode == POPCONTEXT:
+      yield t, ('popcontext',)
+    elif opcode == WRITE:
+      levelbyte = f.read(1)
+      text = _readstring(f)
+      if not levelbyte or text is None:
+        return
+      yield t, ('write', text, levels[levelbyte[0]])
+    elif opcode == OPEN:
+      data = f.read(_open.size)
+      filename = _readstring(f)
+      if len(data) < _open.size or filename is None:
+        return
+      fid, level, binary = _open.unpack(data)
+      modes[fid] = bool(binary)
+      yield t, ('open', fid, filename, 'wb' if binary else 'w', levels[level])
+    elif opcode == CLOSE:
+      data = f.read(_size.size + _datasize.size)
+      if len(data) < _size.size + _datasize.size:
+        return
+      fid, = _size.unpack_from(data)
+      size, = _datasize.unpack_from(data, _size.size)
+      contents = f.read(size)
+      if len(contents) < size:
+        return
+      yield t, ('close', fid, contents if modes.pop(fid) else contents.decode('utf-8', 'surrogateescape'))
+    elif opcode == END:
+      return
+    else:
+      raise ValueError('invalid opcode {}'.format(opcode))
+
+def _readstring(f: typing.BinaryIO) -> typing.Optional[str]:
+  data = f.read(_size.size)
+  if len(data) < _size.size:
+    return None
+  size, = _size.unpack(data)
+  data = f.read(size)
+  if len(data) < size:
+    return None
+  return data.decode('utf-8', 'surrogateescape')
+
+# vim:sw=2:sts=2:et
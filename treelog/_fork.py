@@ -0,0 +1,163 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+'''Fork handlers for loggers that write to a file.
+
+Loggers that cannot share their output with a forked child register
+themselves via :func:`register`, and unregister via :func:`unregister` when
+they are closed, and implement two methods: ``_beforefork``,
+which is called in the parent before the fork and typically flushes the
+output, and ``_afterfork(child)``, which is called in both processes after the
+fork and typically lets the child drop the output of the parent, to open a new
+file upon its first message. A child announces the name of that file to the
+parent through :class:`Children`, such that the parent can link it. Forking is
+only detected via :func:`os.register_at_fork`, i.e. on Python 3.7 and higher,
+and only for :func:`os.fork`, as used by :mod:`multiprocessing` but not by
+:mod:`subprocess`.'''
+
+import os, sys, time, typing, weakref
+
+# Registered loggers by id. Loggers are referenced weakly if their class
+# supports it, such that an unclosed logger is still collected, and strongly
+# otherwise, as for classes that are compiled with mypyc.
+_loggers = {} # type: typing.Dict[int, typing.Callable[[], typing.Any]]
+
+def register(log: typing.Any) -> None:
+  key = id(log)
+  try:
+    ref = weakref.ref(log, lambda ref: _loggers.get(key) is ref and _loggers.pop(key)) # type: typing.Callable[[], typing.Any]
+  except TypeError:
+    ref = lambda: log
+  _loggers[key] = ref
+
+def unregister(log: typing.Any) -> None:
+  try:
+    _loggers.pop(id(log), None)
+  except TypeError: # the registry of a compiled module is cleared at interpreter shutdown
+    pass
+
+def _registered() -> typing.List[typing.Any]:
+  return [log for log in (ref() for ref in list(_loggers.values())) if log is not None]
+
+def _before() -> None:
+  for log in _registered():
+    log._beforefork()
+
+def _after_in_parent() -> None:
+  for log in _registered():
+    log._afterfork(False)
+
+def _after_in_child() -> None:
+  for log in _registered():
+    log._afterfork(True)
+
+class Children:
+  '''Pipe through which forked children announce their output to the parent.'''
+
+  interval = .1 # minimum number of seconds between two reads of the pipe
+
+  def __init__(self) -> None:
+    self._read = None # type: typing.Optional[int]
+    self._write = None # type: typing.Optional[int]
+    self._parent = None # type: typing.Optional[int]
+    self._next = 0.
+    self._partial = b''
+
+  def prepare(self) -> None:
+    '''Create the pipe, to be called in the parent before the fork.'''
+
+    if self._read is None:
+      self._read, self._write = os.pipe()
+      os.set_blocking(self._read, False)
+
+  def forked(self) -> None:
+    '''Take the write end of the pipe, to be called in the child after the fork.'''
+
+    # a child that forks before it announced itself does not have a pipe of
+    # its own, in which case its children announce themselves to its parent
+    if self._write is not None:
+      assert self._read is not None
+      os.close(self._read)
+      if self._parent is not None:
+        os.close(self._parent)
+      self._parent = self._write
+      self._read = self._write = None
+    self._partial = b''
+
+  def announce(self, message: str) -> None:
+    '''Send a single line message to the parent, if any.'''
+
+    if self._parent is None:
+      return
+    try:
+      # the parent does not wait for its children, so the message is dropped rather than blocking if the pipe is full
+      os.set_blocking(self._parent, False)
+      os.write(self._parent, message.encode('utf-8', 'surrogateescape') + b'\n')
+    except OSError:
+      pass
+    finally:
+      os.close(self._parent)
+      self._parent = None
+
+  def receive(self, force: bool = False) -> typing.List[str]:
+    '''Return the messages of children, reading the pipe at most once per interval unless forced.'''
+
+    if self._read is None:
+      return []
+    if not force:
+      now = time.monotonic()
+      if now < self._next:
+        return []
+      self._next = now + self.interval
+    data = self._partial
+    while True:
+      try:
+        chunk = os.read(self._read, 65536)
+      except BlockingIOError:
+        break
+      if not chunk:
+        break
+      data += chunk
+    *lines, self._partial = data.split(b'\n')
+    return [line.decode('utf-8', 'surrogateescape') for line in lines]
+
+  def close(self) -> None:
+    for fd in self._read, self._write, self._parent:
+      if fd is not None:
+        os.close(fd)
+    self._read = self._write = self._parent = None
+
+def flushatexit(f: typing.IO[typing.Any]) -> None:
+  '''Flush a buffered file when a worker of :mod:`multiprocessing` exits.
+
+  Workers end with :func:`os._exit`, which skips the flushing of open files.'''
+
+  util = sys.modules.get('multiprocessing.util')
+  if util is not None:
+    util.Finalize(None, _flush, args=(f,), exitpriority=0)
+
+def _flush(f: typing.IO[typing.Any]) -> None:
+  if not f.closed:
+    f.flush()
+
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(before=_before, after_in_parent=_after_in_parent, after_in_child=_after_in_child)
+
+# vim:sw=2:sts=2:et
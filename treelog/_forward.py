@@ -18,8 +18,8 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import contextlib, typing, typing_extensions, tempfile, warnings, os
-from . import proto, _io
+import contextlib, fnmatch, sys, threading, typing, typing_extensions, tempfile, warnings, os
+from . import proto, _io, _silent
 
 class TeeLog:
   '''Forward messages to two underlying loggers.'''
@@ -68,26 +68,394 @@ class TeeLog:
         f2.write(data)
 
 class FilterLog:
-  '''Filter messages based on level.'''
+  '''Filter messages based on level.
 
-  def __init__(self, baselog: proto.Log, minlevel: proto.Level) -> None:
+  Messages and files below ``minlevel`` are discarded. Different levels can be
+  set for parts of the tree via ``rules``, a mapping of path patterns to
+  levels, such as ``{'solve > newton > *': Level.debug}``. A pattern is
+  split at ``' > '`` and every component is matched against the title of the
+  context at the same depth using :func:`fnmatch.fnmatchcase`; the level of a
+  matching rule applies to the context and all its children, unless
+  overruled by a rule further down. If several rules match the same context
+  the one that comes last in ``rules`` wins. If ``maxdepth`` is given, contexts deeper than that are
+  not forwarded, and their messages appear in the deepest forwarded context.
+
+  The rules are compiled into a trie that is advanced upon every change of
+  context, such that checking the level of a message takes constant time.
+  Without rules and ``maxdepth`` contexts are forwarded as is.'''
+
+  def __init__(self, baselog: proto.Log, minlevel: proto.Level, *, rules: typing.Optional[typing.Mapping[str, proto.Level]] = None, maxdepth: typing.Optional[int] = None) -> None:
+    self._baselog = baselog
+    self._minlevel = minlevel
+    self._maxdepth = maxdepth
+    self._passthrough = not rules and maxdepth is None
+    root = _Trie()
+    for index, (pattern, level) in enumerate((rules or {}).items()):
+      node = root
+      for component in pattern.split(' > '):
+        node = node.children.setdefault(component, _Trie())
+      node.rule = index, level
+    # every frame holds the trie nodes that match the path so far and the minimum level
+    self._frames = [((root,), minlevel)] # type: typing.List[typing.Tuple[typing.Tuple[_Trie, ...], proto.Level]]
+    self._lock = threading.RLock()
+
+  def _enter(self, title: str) -> None:
+    nodes, minlevel = self._frames[-1]
+    matches = tuple(child for node in nodes for pattern, child in node.children.items() if fnmatch.fnmatchcase(title, pattern))
+    rules = [node.rule for node in matches if node.rule is not None]
+    if rules:
+      index, minlevel = max(rules, key=lambda rule: rule[0])
+    self._frames.append((matches, minlevel))
+
+  def _forwarded(self) -> bool:
+    # whether the innermost context is forwarded to the base logger
+    return self._maxdepth is None or len(self._frames) <= self._maxdepth + 1
+
+  def pushcontext(self, title: str) -> None:
+    if self._passthrough:
+      self._baselog.pushcontext(title)
+      return
+    with self._lock:
+      self._enter(title)
+      if self._forwarded():
+        self._baselog.pushcontext(title)
+
+  def popcontext(self) -> None:
+    if self._passthrough:
+      self._baselog.popcontext()
+      return
+    with self._lock:
+      if self._forwarded():
+        self._baselog.popcontext()
+      self._frames.pop()
+
+  def recontext(self, title: str) -> None:
+    if self._passthrough:
+      self._baselog.recontext(title)
+      return
+    with self._lock:
+      self._frames.pop()
+      self._enter(title)
+      if self._forwarded():
+        self._baselog.recontext(title)
+
+  def write(self, text: str, level: proto.Level) -> None:
+    if self._passthrough:
+      if level.value >= self._minlevel.value:
+        self._baselog.write(text, level)
+      return
+    with self._lock:
+      if level.value >= self._frames[-1][1].value:
+        self._baselog.write(text, level)
+
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing_extensions.ContextManager[typing.IO[typing.Any]]:
+    if self._passthrough:
+      return self._baselog.open(filename, mode, level) if level.value >= self._minlevel.value else _io.devnull(mode)
+    with self._lock:
+      return self._baselog.open(filename, mode, level) if level.value >= self._frames[-1][1].value else _io.devnull(mode)
+
+class _Trie:
+
+  def __init__(self) -> None:
+    self.children = {} # type: typing.Dict[str, _Trie]
+    self.rule = None # type: typing.Optional[typing.Tuple[int, proto.Level]] # position in rules and level
+
+class RingBufferLog:
+  '''Keep the most recent messages in memory and write them on failure.
+
+  The last ``capacity`` events, i.e. context changes, messages and files, are
+  stored in a ring that is allocated upon creation, without any formatting.
+  The stored history is written to ``baselog`` as soon as a message of level
+  ``minlevel`` or higher arrives, an :class:`Exception` escapes a context, or
+  :meth:`dump` is called, after which the ring is emptied. Contexts that were
+  entered before the oldest stored event are reconstructed, such that every
+  dump is a complete tree. The contents of files are kept in memory as well.
+
+  Typical usage is to combine a terse log with a detailed history:
+
+  >>> import treelog
+  >>> ring = treelog.RingBufferLog(treelog.StdoutLog(), capacity=3)
+  >>> log = treelog.TeeLog(treelog.FilterLog(treelog.NullLog(), minlevel=treelog.proto.Level.warning), ring)
+  >>> with treelog.set(log), treelog.context('iter'):
+  ...   for i in range(5):
+  ...     treelog.debug('step {}'.format(i))
+  ...   treelog.error('failed')
+  iter > step 3
+  iter > step 4
+  iter > failed
+  '''
+
+  def __init__(self, baselog: proto.Log, capacity: int = 1000, minlevel: proto.Level = proto.Level.error) -> None:
+    if capacity < 1:
+      raise ValueError('capacity should be positive')
     self._baselog = baselog
+    self._capacity = capacity
     self._minlevel = minlevel
+    self._ring = [None] * capacity # type: typing.List[typing.Any]
+    self._count = 0 # number of events stored since the last dump
+    self._stack = [] # type: typing.List[typing.Tuple[str, typing.Optional[BaseException]]]
+    self._dumped = None # type: typing.Optional[BaseException]
+    self._lock = threading.Lock()
+
+  def _append(self, event: typing.Tuple[typing.Any, ...]) -> None:
+    # to be called with the lock held
+    self._ring[self._count % self._capacity] = event
+    self._count += 1
 
   def pushcontext(self, title: str) -> None:
-    self._baselog.pushcontext(title)
+    with self._lock:
+      self._append(('pushcontext', title))
+      # remember the exception being handled, if any, to tell it apart from one escaping this context
+      self._stack.append((title, sys.exc_info()[1]))
 
   def popcontext(self) -> None:
-    self._baselog.popcontext()
+    exc = sys.exc_info()[1]
+    with self._lock:
+      title, handled = self._stack.pop()
+      self._append(('popcontext', title))
+      # only errors count as failures, not GeneratorExit of an abandoned generator or KeyboardInterrupt
+      escaped = isinstance(exc, Exception) and exc is not handled and exc is not self._dumped
+    if escaped:
+      self._dumped = exc
+      self.dump()
 
   def recontext(self, title: str) -> None:
-    self._baselog.recontext(title)
+    with self._lock:
+      oldtitle, handled = self._stack[-1]
+      self._append(('recontext', title, oldtitle))
+      self._stack[-1] = title, handled
 
   def write(self, text: str, level: proto.Level) -> None:
+    with self._lock:
+      self._append(('write', text, level))
     if level.value >= self._minlevel.value:
+      self.dump()
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    with tempfile.TemporaryFile(mode+'+') as f:
+      yield f
+      f.seek(0)
+      data = f.read()
+    with self._lock:
+      self._append(('file', filename, mode, level, data))
+    if level.value >= self._minlevel.value:
+      self.dump()
+
+  def dump(self) -> None:
+    '''Write the stored history to the base logger and empty the ring.'''
+
+    with self._lock:
+      n = min(self._count, self._capacity)
+      start = self._count - n
+      events = [self._ring[i % self._capacity] for i in range(start, self._count)]
+      self._ring[:] = [None] * self._capacity
+      self._count = 0
+      stack = [title for title, handled in self._stack]
+    depth = len(stack)
+    # rewind the current context stack to the state prior to the oldest event
+    for i in range(len(events)-1, -1, -1):
+      event = events[i]
+      if event[0] == 'pushcontext':
+        stack.pop()
+      elif event[0] == 'popcontext':
+        stack.append(event[1])
+      elif event[0] == 'recontext':
+        stack[-1] = event[2]
+    log = self._baselog
+    for title in stack:
+      log.pushcontext(title)
+    for event in events:
+      if event[0] == 'pushcontext':
+        log.pushcontext(event[1])
+      elif event[0] == 'popcontext':
+        log.popcontext()
+      elif event[0] == 'recontext':
+        log.recontext(event[1])
+      elif event[0] == 'write':
+        log.write(event[1], event[2])
+      else:
+        filename, mode, level, data = event[1:]
+        with log.open(filename, mode, level) as f:
+          f.write(data)
+    for i in range(depth):
+      log.popcontext()
+
+class DeferredLog:
+  '''Forward the contents of a context only if it fails.
+
+  Messages and files of a level below ``minlevel`` are held back while inside
+  a context, and discarded when the context is closed. If instead a message or
+  file of level ``minlevel`` or higher arrives, or an :class:`Exception`
+  escapes the context, all messages held back so far are forwarded to
+  ``baselog``, as is everything that follows in the same context. Messages
+  outside of any context are forwarded directly. See also :func:`treelog.defer`.'''
+
+  def __init__(self, baselog: proto.Log, minlevel: proto.Level = proto.Level.warning) -> None:
+    self._baselog = baselog
+    self._minlevel = minlevel
+    self._buffer = _silent.RecordLog(simplify=False)
+    # every frame holds the length of the buffer upon entry, whether the
+    # context has been forwarded, and the exception being handled upon entry
+    self._frames = [] # type: typing.List[typing.Tuple[int, bool, typing.Optional[BaseException]]]
+    self._lock = threading.RLock()
+
+  def _deferring(self) -> bool:
+    return bool(self._frames) and not self._frames[-1][1]
+
+  def _forward(self) -> None:
+    _silent.replay(self._buffer._messages, self._baselog)
+    self._buffer._messages.clear()
+    self._frames = [(0, True, handled) for mark, forwarded, handled in self._frames]
+
+  def _discard(self) -> None:
+    mark, forwarded, handled = self._frames.pop()
+    if forwarded:
+      self._baselog.popcontext()
+    else:
+      del self._buffer._messages[mark:]
+
+  def pushcontext(self, title: str) -> None:
+    exc = sys.exc_info()[1]
+    with self._lock:
+      self._frames.append((len(self._buffer._messages), False, exc))
+      self._buffer.pushcontext(title)
+
+  def popcontext(self) -> None:
+    exc = sys.exc_info()[1]
+    with self._lock:
+      # as for RingBufferLog, a GeneratorExit or KeyboardInterrupt is no failure
+      if isinstance(exc, Exception) and exc is not self._frames[-1][2] and self._deferring():
+        self._forward()
+      self._discard()
+
+  def recontext(self, title: str) -> None:
+    with self._lock:
+      handled = self._frames[-1][2]
+      self._discard()
+      self._frames.append((len(self._buffer._messages), False, handled))
+      self._buffer.pushcontext(title)
+
+  def write(self, text: str, level: proto.Level) -> None:
+    with self._lock:
+      if level.value >= self._minlevel.value and self._deferring():
+        self._forward()
+      (self._buffer if self._deferring() else self._baselog).write(text, level)
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    with self._lock:
+      if level.value >= self._minlevel.value and self._deferring():
+        self._forward()
+      deferring = self._deferring()
+    if not deferring:
+      with self._baselog.open(filename, mode, level) as f:
+        yield f
+      return
+    with tempfile.TemporaryFile(mode+'+') as f:
+      yield f
+      f.seek(0)
+      data = f.read()
+    # the context may have been forwarded while the file was open
+    with self._lock, (self._buffer if self._deferring() else self._baselog).open(filename, mode, level) as f:
+      f.write(data)
+
+class RateLimitLog:
+  '''Collapse repeated messages and limit the number of messages per context.
+
+  A message that is identical in text and level to the message directly
+  preceding it is not forwarded to ``baselog``, but counted, and the count is
+  written as a single message ``text (repeated N more times)`` as soon as a
+  different event arrives. If ``maxmessages`` is given, at most that many
+  messages per level are forwarded per context, and the number of messages
+  that were suppressed is written at the end of the context. Counts that are
+  pending outside of any context are written by :meth:`flush`.
+
+  >>> import treelog
+  >>> log = treelog.RateLimitLog(treelog.StdoutLog(), maxmessages=2)
+  >>> with treelog.set(log), treelog.context('solve'):
+  ...   for i in range(3):
+  ...     treelog.warning('not converged')
+  ...   for i in range(3):
+  ...     treelog.info('residual {}'.format(i))
+  solve > not converged
+  solve > not converged (repeated 2 more times)
+  solve > residual 0
+  solve > residual 1
+  solve > 1 info messages suppressed
+  '''
+
+  def __init__(self, baselog: proto.Log, maxmessages: typing.Optional[int] = None) -> None:
+    self._baselog = baselog
+    self._maxmessages = maxmessages
+    self._last = None # type: typing.Optional[typing.Tuple[str, proto.Level]]
+    self._repeats = 0
+    # number of forwarded and suppressed messages per level, for every context
+    self._counts = [({}, {})] # type: typing.List[typing.Tuple[typing.Dict[proto.Level, int], typing.Dict[proto.Level, int]]]
+    self._lock = threading.RLock()
+
+  def _flushrepeats(self) -> None:
+    if self._repeats:
+      assert self._last
+      text, level = self._last
+      self._baselog.write('{} (repeated {} more times)'.format(text, self._repeats), level)
+      self._repeats = 0
+    self._last = None
+
+  def _summarize(self) -> None:
+    forwarded, suppressed = self._counts[-1]
+    for level in proto.Level:
+      if level in suppressed:
+        self._baselog.write('{} {} messages suppressed'.format(suppressed[level], level.name), level)
+
+  def pushcontext(self, title: str) -> None:
+    with self._lock:
+      self._flushrepeats()
+      self._counts.append(({}, {}))
+      self._baselog.pushcontext(title)
+
+  def popcontext(self) -> None:
+    with self._lock:
+      self._flushrepeats()
+      self._summarize()
+      self._counts.pop()
+      self._baselog.popcontext()
+
+  def recontext(self, title: str) -> None:
+    with self._lock:
+      self._flushrepeats()
+      self._summarize()
+      self._counts[-1] = {}, {}
+      self._baselog.recontext(title)
+
+  def write(self, text: str, level: proto.Level) -> None:
+    with self._lock:
+      if (text, level) == self._last:
+        self._repeats += 1
+        return
+      self._flushrepeats()
+      if self._maxmessages is not None:
+        forwarded, suppressed = self._counts[-1]
+        if forwarded.get(level, 0) >= self._maxmessages:
+          suppressed[level] = suppressed.get(level, 0) + 1
+          return
+        forwarded[level] = forwarded.get(level, 0) + 1
       self._baselog.write(text, level)
+      self._last = text, level
 
   def open(self, filename: str, mode: str, level: proto.Level) -> typing_extensions.ContextManager[typing.IO[typing.Any]]:
-    return self._baselog.open(filename, mode, level) if level.value >= self._minlevel.value else _io.devnull(mode)
+    with self._lock:
+      self._flushrepeats()
+    return self._baselog.open(filename, mode, level)
+
+  def flush(self) -> None:
+    '''Write the pending repeat count, and the number of messages suppressed
+    outside of any context.'''
+
+    with self._lock:
+      self._flushrepeats()
+      if len(self._counts) == 1:
+        self._summarize()
+        self._counts[0] = {}, {}
 
 # vim:sw=2:sts=2:et
@@ -18,15 +18,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import contextlib, sys, os, urllib.parse, html, hashlib, warnings, typing, types
-from . import proto, _io
+import contextlib, sys, os, io, urllib.parse, html, hashlib, threading, warnings, typing, types, typing_extensions
+from . import proto, _io, _fork
 
 class HtmlLog:
-  '''Output html nested lists.'''
+  '''Output html nested lists.
+
+  A process that is forked while the log is open continues in a new html file
+  in the same directory, which is created upon the first message of the child
+  and linked from the log of the parent as soon as the parent writes its next
+  message or closes the log. Likewise, a log that is unpickled, for instance
+  in a task of a process pool, continues in a new html file in the directory
+  of the log, which should therefore be shared by all processes. The file is
+  created upon the first message of the unpickled log, and links back to the
+  file of the log that was pickled.'''
+
+  _reopened = False
+  _origin = None # type: typing.Optional[str] # name of the file of the pickled log, to be linked from the first file of the unpickled log
 
   def __init__(self, dirpath: str, *, filename: str = 'log.html', title: typing.Optional[str] = None, htmltitle: typing.Optional[str] = None, favicon: typing.Optional[str] = None) -> None:
+    self._dirpath = os.path.abspath(dirpath)
     self._dir = _io.directory(dirpath)
     self._file, self.filename = self._dir.openfirstunused(_io.sequence(filename), 'w', encoding='utf-8')
+    self._name = self.filename
     css = hashlib.sha1(CSS.encode()).hexdigest() + '.css'
     try:
       with self._dir.open(css, 'w') as f:
@@ -45,48 +59,104 @@ class HtmlLog:
       htmltitle = html.escape(title)
     if favicon is None:
       favicon = FAVICON
-    self._file.write(HTMLHEAD.format(title=title, htmltitle=htmltitle, css=css, js=js, favicon=favicon))
-    # active contexts that are not yet opened as html elements
-    self._unopened = [] # type: typing.List[str]
+    self._start(dict(title=title, htmltitle=htmltitle, css=css, js=js, favicon=favicon))
+    self._file.write(HTMLHEAD.format(**self._head))
+
+  def _start(self, head: typing.Dict[str, str]) -> None:
+    self._head = head
+    # titles of active contexts, of which the first _opened are opened as html elements
+    self._contexts = [] # type: typing.List[str]
+    self._opened = 0
+    self._forked = False # whether the file of a forked child or unpickled log is yet to be opened
+    self._children = _fork.Children()
+    self._lock = threading.RLock()
+    _fork.register(self)
 
   def pushcontext(self, title: str) -> None:
-    self._unopened.append(title)
+    with self._lock:
+      self._contexts.append(title)
 
   def popcontext(self) -> None:
-    if self._unopened:
-      self._unopened.pop()
-    else:
-      print('</div><div class="end"></div></div>', file=self._file)
+    with self._lock:
+      self._contexts.pop()
+      if len(self._contexts) < self._opened:
+        self._opened -= 1
+        print('</div><div class="end"></div></div>', file=self._file)
 
   def recontext(self, title: str) -> None:
-    self.popcontext()
-    self.pushcontext(title)
+    with self._lock:
+      self.popcontext()
+      self.pushcontext(title)
 
   def write(self, text: str, level: proto.Level, escape: bool = True) -> None:
-    for c in self._unopened:
-      print('<div class="context"><div class="title">{}</div><div class="children">'.format(html.escape(c)), file=self._file)
-    self._unopened.clear()
     if escape:
       text = html.escape(text)
+    with self._lock:
+      if self._forked:
+        self._startchild()
+      self._linkchildren(force=False)
+      self._item(text, level)
+
+  def _item(self, text: str, level: proto.Level) -> None:
+    # to be called with the lock held
+    for c in self._contexts[self._opened:]:
+      print('<div class="context"><div class="title">{}</div><div class="children">'.format(html.escape(c)), file=self._file)
+    self._opened = len(self._contexts)
     print('<div class="item" data-loglevel="{}">{}</div>'.format(level.value, text), file=self._file, flush=True)
 
+  def _linkchildren(self, force: bool) -> None:
+    # to be called with the lock held
+    for name in self._children.receive(force):
+      self._item('forked <a href="{href}">{name}</a>'.format(href=urllib.parse.quote(name), name=html.escape(name)), proto.Level.info)
+
+  def _startchild(self) -> None:
+    # to be called with the lock held
+    self._forked = False
+    self._file, self._name = self._dir.openfirstunused(_io.sequence(self.filename), 'w', encoding='utf-8')
+    self._file.write(HTMLHEAD.format(**dict(self._head, title='{} (pid {})'.format(self._head['title'], os.getpid()))))
+    if self._origin is not None:
+      self._item('continued from <a href="{href}">{name}</a>'.format(href=urllib.parse.quote(self._origin), name=html.escape(self._origin)), proto.Level.info)
+      self._origin = None
+    self._file.flush()
+    self._children.announce(self._name)
+
   @contextlib.contextmanager
   def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
     base, ext = os.path.splitext(filename)
     with self._dir.temp(mode) as f:
       yield f
-      f.seek(0)
-      realname = _filehash(f.fileno(), 'sha1').hex() + ext
-      try:
-        self._dir.link(f, realname)
-      except FileExistsError:
-        pass
+      realname = self._dir.linkhashed(f, ext)
     self.write('<a href="{href}" download="{name}">{name}</a>'.format(href=urllib.parse.quote(realname), name=html.escape(filename)), level, escape=False)
 
+  def _beforefork(self) -> None:
+    # the lock is held until after the fork, such that the child does not inherit a half written item
+    self._lock.acquire()
+    if not self._file.closed:
+      self._file.flush()
+      self._children.prepare()
+
+  def _afterfork(self, child: bool) -> None:
+    if child:
+      self._lock = threading.RLock()
+      if not self._file.closed:
+        self._file.close() # flushed before the fork, so this only releases the descriptor
+        self._forked = True
+        self._opened = 0
+      self._children.forked()
+    else:
+      self._lock.release()
+
+  def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+    return _ReopenedHtmlLog, (self._dirpath, self.filename, self._head, self._name)
+
   def close(self) -> bool:
+    _fork.unregister(self)
     if hasattr(self, '_file') and not self._file.closed:
-      self._file.write(HTMLFOOT)
-      self._file.close()
+      with self._lock:
+        self._linkchildren(force=True)
+        self._file.write(HTMLFOOT)
+        self._file.close()
+        self._children.close()
       return True
     else:
       return False
@@ -98,9 +168,24 @@ class HtmlLog:
     self.close()
 
   def __del__(self) -> None:
-    if self.close():
+    if self.close() and not self._reopened:
       warnings.warn('unclosed object {!r}'.format(self), ResourceWarning)
 
+class _ReopenedHtmlLog(HtmlLog):
+  '''Unpickled :class:`HtmlLog`, which is closed implicitly when it goes out of scope.'''
+
+  def __init__(self, dirpath: str, filename: str, head: typing.Dict[str, str], origin: str) -> None:
+    # compiled classes cannot be created without calling __init__, hence this subclass
+    self._dirpath = dirpath
+    self._dir = _io.directory(dirpath)
+    self.filename = filename
+    self._reopened = True
+    self._origin = self._name = origin
+    self._file = io.StringIO()
+    self._file.close() # as in a forked child, the file is opened upon the first message
+    self._start(head)
+    self._forked = True
+
 HTMLHEAD = '''\
 <!DOCTYPE html>
 <html>
@@ -117,9 +202,10 @@ HTMLHEAD = '''\
 <div id="log">
 '''
 
+# final, such that compiled code inlines it and can still close a log during interpreter shutdown
 HTMLFOOT = '''\
 </div></body></html>
-'''
+''' # type: typing_extensions.Final
 
 CSS = '''\
 body { font-family: monospace; font-size: 12px; }
@@ -774,13 +860,4 @@ FAVICON = 'data:image/png;base64,' \
   'TD0oiqIo6qrOURRFUVRepQ4TRVEURdXVV6MoiqKoV2UJpCiKov7+p1AURVFUWZWiKIqiqI2a' \
   '8O8qJ0n+GP4AAAAASUVORK5CYII='
 
-def _filehash(fd: int, hashtype: str) -> bytes:
-  h = hashlib.new(hashtype)
-  blocksize = 65536
-  buf = os.read(fd, blocksize)
-  while buf:
-    h.update(buf)
-    buf = os.read(fd, blocksize)
-  return h.digest()
-
 # vim:sw=2:sts=2:et
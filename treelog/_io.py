@@ -18,7 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import os, contextlib, random, functools, typing, types, sys
+import os, contextlib, random, functools, hashlib, threading, typing, types, sys
 
 supports_fd = os.supports_dir_fd >= {os.open, os.link, os.unlink}
 
@@ -39,27 +39,36 @@ class directory:
       self._fd = None
       self._path = path
     self._rng = randomnames()
+    self._rnglock = threading.Lock()
 
   def _join(self, name: str) -> str:
     return name if self._path is None else os.path.join(self._path, name)
 
-  def open(self, filename: str, mode: str, *, encoding: typing.Optional[str] = None, umask: int = 0o666) -> typing.IO[typing.Any]:
+  def open(self, filename: str, mode: str, *, encoding: typing.Optional[str] = None, umask: int = 0o666, buffering: int = -1, exclusive: bool = True) -> typing.IO[typing.Any]:
     if mode not in ('w', 'wb'):
       raise ValueError('invalid mode: {!r}'.format(mode))
-    return open(self._join(filename), mode+'+', encoding=encoding, opener=lambda name, flags: os.open(name, flags|os.O_CREAT|os.O_EXCL, mode=umask, dir_fd=self._fd))
+    excl = os.O_EXCL if exclusive else 0
+    return open(self._join(filename), mode+'+', buffering=buffering, encoding=encoding, opener=lambda name, flags: os.open(name, flags|os.O_CREAT|excl, mode=umask, dir_fd=self._fd))
 
-  def openfirstunused(self, filenames: typing.Iterable[str], mode: str, *, encoding: typing.Optional[str] = None, umask: int = 0o666) -> typing.Tuple[typing.IO[typing.Any], str]:
+  def openfirstunused(self, filenames: typing.Iterable[str], mode: str, *, encoding: typing.Optional[str] = None, umask: int = 0o666, buffering: int = -1) -> typing.Tuple[typing.IO[typing.Any], str]:
     for filename in filenames:
       try:
-        return self.open(filename, mode, encoding=encoding, umask=umask), filename
+        return self.open(filename, mode, encoding=encoding, umask=umask, buffering=buffering), filename
       except FileExistsError:
         pass
     raise ValueError('all filenames are in use')
 
+  def _tempnames(self) -> typing.Generator[str, None, None]:
+    # the random name generator is shared by all threads
+    while True:
+      with self._rnglock:
+        name = next(self._rng)
+      yield name
+
   @contextlib.contextmanager
   def temp(self, mode: str) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    f, name = self.openfirstunused(self._tempnames(), mode)
     try:
-      f, name = self.openfirstunused(self._rng, mode)
       with f:
         yield f
     finally:
@@ -68,6 +77,17 @@ class directory:
   def link(self, src: typing.IO[typing.Any], dst: str) -> None:
     os.link(src.name, self._join(dst), src_dir_fd=self._fd, dst_dir_fd=self._fd)
 
+  def linkhashed(self, src: typing.IO[typing.Any], ext: str = '') -> str:
+    '''Link file under the sha1 hash of its contents and return the name.'''
+
+    src.seek(0)
+    dst = filehash(src.fileno(), 'sha1').hex() + ext
+    try:
+      self.link(src, dst)
+    except FileExistsError:
+      pass
+    return dst
+
   def linkfirstunused(self, src: typing.IO[typing.Any], dsts: typing.Iterable[str]) -> str:
     for dst in dsts:
       try:
@@ -79,9 +99,18 @@ class directory:
     raise ValueError('all destinations are in use')
 
   def __del__(self) -> None:
-    if os and os.close and self._fd is not None:
+    if getattr(os, 'close', None) is not None and self._fd is not None: # os may be cleared at interpreter shutdown
       os.close(self._fd)
 
+def filehash(fd: int, hashtype: str) -> bytes:
+  h = hashlib.new(hashtype)
+  blocksize = 65536
+  buf = os.read(fd, blocksize)
+  while buf:
+    h.update(buf)
+    buf = os.read(fd, blocksize)
+  return h.digest()
+
 def sequence(filename: str) -> typing.Generator[str, None, None]:
   '''Generate file names a.b, a-1.b, a-2.b, etc.'''
 
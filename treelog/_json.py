@@ -0,0 +1,178 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib, itertools, json, os, sys, threading, time, types, typing, warnings
+from . import proto, _io, _fork
+
+class JsonLinesLog:
+  '''Output one json object per line for every event.
+
+  Every line has the fields ``t``, the :func:`time.monotonic` timestamp, and
+  ``event``, which is one of:
+
+  * ``start``: the first line, with the ``title`` of the log and the wall
+    clock ``time`` (seconds since the epoch) that corresponds with ``t``;
+  * ``push``: a new context with a unique ``id``, the ``parent`` context id
+    (null at the top level) and ``title``;
+  * ``recontext``: a new context with a unique ``id`` that replaces the
+    context ``replaces``, with the same ``parent`` and a new ``title``;
+  * ``pop``: the closing of context ``id``;
+  * ``write``: a message with ``context`` id, ``level`` and ``text``;
+  * ``open``: a file with ``context`` id, ``level``, ``name`` and ``file``,
+    the name of the stored file in the output directory. Files are stored
+    under the sha1 hash of their contents, and are logged once closed;
+  * ``fork``: a fork of the process in context ``context``, which continues
+    logging to ``file`` in the output directory, starting with a ``push``
+    for every active context. The file is created upon the first event of
+    the child, and the line is written as soon as the parent writes its next
+    event or closes the log, such that ``t`` is not the time of the fork.
+
+  Lines are written in chunks of ``buffering`` bytes, such that events are not
+  visible on disk immediately and are lost if the process is killed.'''
+
+  def __init__(self, dirpath: str, *, filename: str = 'log.jsonl', title: typing.Optional[str] = None, buffering: int = 2**16) -> None:
+    self._dir = _io.directory(dirpath)
+    self._file, self.filename = self._dir.openfirstunused(_io.sequence(filename), 'w', encoding='utf-8', buffering=buffering)
+    self._buffering = buffering
+    self._title = ' '.join(sys.argv) if title is None else title
+    self._dumps = json.JSONEncoder(ensure_ascii=False, check_circular=False).encode
+    self._ids = itertools.count(1)
+    self._stack = [] # type: typing.List[int]
+    self._titles = [] # type: typing.List[str]
+    self._forked = False # whether the file of a forked child is yet to be opened
+    self._children = _fork.Children()
+    self._lock = threading.Lock()
+    self._start(self._title)
+    _fork.register(self)
+
+  def _start(self, title: str) -> None:
+    self._file.write('{{"t":{:.6f},"event":"start","title":{},"time":{:.6f}}}\n'.format(time.monotonic(), self._dumps(title), time.time()))
+
+  def _check(self) -> None:
+    # to be called with the lock held, prior to writing an event
+    if self._forked:
+      self._startchild()
+    self._linkchildren(force=False)
+
+  def _linkchildren(self, force: bool) -> None:
+    # to be called with the lock held
+    for message in self._children.receive(force):
+      context, name = message.split(' ', 1)
+      self._file.write('{{"t":{:.6f},"event":"fork","context":{},"file":{}}}\n'.format(time.monotonic(), context, self._dumps(name)))
+
+  def pushcontext(self, title: str) -> None:
+    with self._lock:
+      self._check()
+      contextid = next(self._ids)
+      self._file.write('{{"t":{:.6f},"event":"push","id":{},"parent":{},"title":{}}}\n'.format(time.monotonic(), contextid, self._stack[-1] if self._stack else 'null', self._dumps(title)))
+      self._stack.append(contextid)
+      self._titles.append(title)
+
+  def popcontext(self) -> None:
+    with self._lock:
+      self._check()
+      self._file.write('{{"t":{:.6f},"event":"pop","id":{}}}\n'.format(time.monotonic(), self._stack.pop()))
+      self._titles.pop()
+
+  def recontext(self, title: str) -> None:
+    with self._lock:
+      self._check()
+      contextid = next(self._ids)
+      self._file.write('{{"t":{:.6f},"event":"recontext","id":{},"replaces":{},"parent":{},"title":{}}}\n'.format(time.monotonic(), contextid, self._stack[-1], self._stack[-2] if len(self._stack) > 1 else 'null', self._dumps(title)))
+      self._stack[-1] = contextid
+      self._titles[-1] = title
+
+  def write(self, text: str, level: proto.Level) -> None:
+    text = self._dumps(text)
+    with self._lock:
+      self._check()
+      self._file.write('{{"t":{:.6f},"event":"write","context":{},"level":"{}","text":{}}}\n'.format(time.monotonic(), self._stack[-1] if self._stack else 'null', level.name, text))
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    with self._dir.temp(mode) as f:
+      yield f
+      realname = self._dir.linkhashed(f, os.path.splitext(filename)[1])
+    with self._lock:
+      self._check()
+      self._file.write('{{"t":{:.6f},"event":"open","context":{},"level":"{}","name":{},"file":{}}}\n'.format(time.monotonic(), self._stack[-1] if self._stack else 'null', level.name, self._dumps(filename), self._dumps(realname)))
+
+  def flush(self) -> None:
+    '''Write buffered events to disk.'''
+
+    with self._lock:
+      if not self._forked:
+        self._file.flush()
+
+  def _startchild(self) -> None:
+    # to be called with the lock held
+    self._forked = False
+    context = self._stack[-1] if self._stack else 'null'
+    self._file, name = self._dir.openfirstunused(_io.sequence(self.filename), 'w', encoding='utf-8', buffering=self._buffering)
+    self._start('{} (pid {})'.format(self._title, os.getpid()))
+    t = time.monotonic()
+    self._stack = []
+    for title in self._titles:
+      contextid = next(self._ids)
+      self._file.write('{{"t":{:.6f},"event":"push","id":{},"parent":{},"title":{}}}\n'.format(t, contextid, self._stack[-1] if self._stack else 'null', self._dumps(title)))
+      self._stack.append(contextid)
+    self._file.flush()
+    _fork.flushatexit(self._file)
+    self._children.announce('{} {}'.format(context, name))
+
+  def _beforefork(self) -> None:
+    # the lock is held until after the fork, such that the child does not inherit a half written line
+    self._lock.acquire()
+    if not self._file.closed:
+      self._file.flush()
+      self._children.prepare()
+
+  def _afterfork(self, child: bool) -> None:
+    if child:
+      self._lock = threading.Lock()
+      if not self._file.closed:
+        self._file.close() # flushed before the fork, so this only releases the descriptor
+        self._forked = True
+      self._children.forked()
+    else:
+      self._lock.release()
+
+  def close(self) -> bool:
+    _fork.unregister(self)
+    if hasattr(self, '_file') and not self._file.closed:
+      with self._lock:
+        self._linkchildren(force=True)
+        self._file.close()
+        self._children.close()
+      return True
+    else:
+      return False
+
+  def __enter__(self) -> 'JsonLinesLog':
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    self.close()
+
+  def __del__(self) -> None:
+    if self.close():
+      warnings.warn('unclosed object {!r}'.format(self), ResourceWarning)
+
+# vim:sw=2:sts=2:et
@@ -0,0 +1,194 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import hashlib, heapq, itertools, json, os, pickle, typing
+from . import proto, _binary
+from ._silent import RecordLog
+
+Event = typing.Tuple[typing.Optional[float], typing.Tuple[typing.Any, ...]]
+
+class Interleaver:
+  '''Write messages of multiple sources to a single log.
+
+  Every source has its own stack of contexts, which is nested in a top level
+  context with the title of the source. Messages are passed to :meth:`feed` in
+  the vocabulary of :class:`RecordLog`. Context changes are applied to the log
+  lazily, just before a message or file of the source is written, such that
+  messages of different sources can be interleaved and contexts without any
+  messages are omitted. If ``dedup`` is true, a file that is identical in name
+  and contents to an earlier file is replaced by a message that refers to the
+  context of the earlier file.'''
+
+  def __init__(self, log: proto.Log, *, dedup: bool = True) -> None:
+    self._log = log
+    self._dedup = dedup
+    self._serial = itertools.count()
+    self._sources = {} # type: typing.Dict[typing.Hashable, _Source]
+    self._stack = [] # type: typing.List[typing.Tuple[int, str]]
+    self._files = {} # type: typing.Dict[typing.Tuple[str, bytes], str]
+
+  def addsource(self, key: typing.Hashable, title: str) -> None:
+    if key in self._sources:
+      raise ValueError('source {!r} already exists'.format(key))
+    self._sources[key] = _Source(next(self._serial), title)
+
+  def removesource(self, key: typing.Hashable) -> None:
+    del self._sources[key]
+
+  def feed(self, key: typing.Hashable, message: typing.Tuple[typing.Any, ...]) -> None:
+    source = self._sources[key]
+    cmd = message[0]
+    if cmd == 'pushcontext':
+      source.stack.append((next(self._serial), message[1]))
+    elif cmd == 'recontext':
+      source.stack[-1] = next(self._serial), message[1]
+    elif cmd == 'popcontext':
+      source.stack.pop()
+    elif cmd == 'write':
+      self._sync(source)
+      self._log.write(message[1], message[2])
+    elif cmd == 'open':
+      source.files[message[1]] = message[2:]
+    elif cmd == 'close':
+      filename, mode, level = source.files.pop(message[1])
+      data = message[2]
+      self._sync(source)
+      if self._dedup:
+        digest = hashlib.sha1(data.encode() if isinstance(data, str) else data).digest()
+        previous = self._files.get((filename, digest))
+        if previous is not None:
+          self._log.write('{} is identical to {} in {}'.format(filename, filename, previous), level)
+          return
+        self._files[filename, digest] = ' > '.join(title for serial, title in self._stack)
+      with self._log.open(filename, mode, level) as f:
+        f.write(data)
+    else:
+      raise ValueError('invalid message {!r}'.format(cmd))
+
+  def _sync(self, source: '_Source') -> None:
+    target = [(source.serial, source.title)] + source.stack
+    n = 0
+    while n < len(self._stack) and n < len(target) and self._stack[n][0] == target[n][0]:
+      n += 1
+    while len(self._stack) > n:
+      self._stack.pop()
+      self._log.popcontext()
+    for item in target[n:]:
+      self._log.pushcontext(item[1])
+      self._stack.append(item)
+
+  def close(self) -> None:
+    '''Close all contexts of the log.'''
+
+    while self._stack:
+      self._stack.pop()
+      self._log.popcontext()
+
+class _Source:
+
+  def __init__(self, serial: int, title: str) -> None:
+    self.serial = serial
+    self.title = title
+    self.stack = [] # type: typing.List[typing.Tuple[int, str]]
+    self.files = {} # type: typing.Dict[int, typing.Tuple[typing.Any, ...]]
+
+def load(path: str) -> typing.Iterator[Event]:
+  '''Iterate over timestamped events of a recorded log.
+
+  The log is either a :class:`RecordLog` pickle, which is loaded in full and
+  has no timestamps, or a stream written by :class:`BinaryLog` or
+  :class:`JsonLinesLog`, which are read incrementally. A directory is
+  searched for ``log.treelog`` and ``log.jsonl``, in that order.'''
+
+  if os.path.isdir(path):
+    for name in 'log.treelog', 'log.jsonl':
+      if os.path.exists(os.path.join(path, name)):
+        path = os.path.join(path, name)
+        break
+    else:
+      raise ValueError('no log.treelog or log.jsonl in directory {}'.format(path))
+  with open(path, 'rb') as f:
+    magic = f.read(len(_binary.MAGIC))
+    f.seek(0)
+    if magic == _binary.MAGIC:
+      title, events = _binary.load(f)
+      yield from events
+    elif magic.startswith(b'{'):
+      yield from _jsonlines(f, os.path.dirname(path))
+    else:
+      record = pickle.load(f)
+      if not isinstance(record, RecordLog):
+        raise ValueError('{} does not contain a RecordLog'.format(path))
+      for message in record._messages:
+        yield None, message
+
+def _jsonlines(f: typing.BinaryIO, dirpath: str) -> typing.Iterator[Event]:
+  levels = {level.name: level for level in proto.Level}
+  for fid, line in enumerate(f):
+    try:
+      event = json.loads(line.decode('utf-8'))
+    except ValueError: # truncated last line
+      return
+    kind = event['event']
+    t = event['t']
+    if kind == 'push':
+      yield t, ('pushcontext', event['title'])
+    elif kind == 'recontext':
+      yield t, ('recontext', event['title'])
+    elif kind == 'pop':
+      yield t, ('popcontext',)
+    elif kind == 'write':
+      yield t, ('write', event['text'], levels[event['level']])
+    elif kind == 'open':
+      with open(os.path.join(dirpath, event['file']), 'rb') as attachment:
+        data = attachment.read()
+      yield t, ('open', fid, event['name'], 'wb', levels[event['level']])
+      yield t, ('close', fid, data)
+
+def merge(log: proto.Log, paths: typing.Sequence[str], *, interleave: bool = False, dedup: bool = True) -> None:
+  '''Merge recorded logs into log.
+
+  Every recorded log (see :func:`load`) is placed in a top level context with
+  its path as title. By default the logs are written one after the other; if
+  ``interleave`` is true, the events of all logs are interleaved by their
+  timestamp, which is only meaningful for logs recorded on the same machine.
+  Logs are read in a streaming fashion, and identical files are deduplicated
+  as described for :class:`Interleaver`.'''
+
+  interleaver = Interleaver(log, dedup=dedup)
+  for path in paths:
+    interleaver.addsource(path, path)
+  if interleave:
+    keyed = [_keyed(path) for path in paths]
+    for (timestamp, key), message in heapq.merge(*keyed, key=lambda item: item[0][0]):
+      interleaver.feed(key, message)
+  else:
+    for path in paths:
+      for t, message in load(path):
+        interleaver.feed(path, message)
+  interleaver.close()
+
+def _keyed(path: str) -> typing.Iterator[typing.Tuple[typing.Tuple[float, str], typing.Tuple[typing.Any, ...]]]:
+  for t, message in load(path):
+    if t is None:
+      raise ValueError('{} has no timestamps and cannot be interleaved'.format(path))
+    yield (t, path), message
+
+# vim:sw=2:sts=2:et
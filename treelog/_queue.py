@@ -0,0 +1,149 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib, multiprocessing, os, shutil, tempfile, threading, types, typing
+from . import proto
+from ._merge import Interleaver
+
+class QueueLog:
+  '''Forward messages to a :class:`Collector`, typically in another process.
+
+  Every message is put on the queue of the collector, tagged with the id of
+  the process. The contents of files are not sent through the queue, but
+  written to a staging file in the directory of the collector, of which only
+  the path is sent. Instances are obtained from :attr:`Collector.log`.'''
+
+  def __init__(self, queue: typing.Any, stagingdir: str) -> None:
+    self._queue = queue
+    self._stagingdir = stagingdir
+    self._fid = 0
+    self._lock = threading.Lock()
+
+  def __getstate__(self) -> typing.Dict[str, typing.Any]:
+    state = self.__dict__.copy()
+    del state['_lock']
+    return state
+
+  def __setstate__(self, state: typing.Dict[str, typing.Any]) -> None:
+    self.__dict__.update(state)
+    self._lock = threading.Lock()
+
+  def pushcontext(self, title: str) -> None:
+    self._queue.put((os.getpid(), ('pushcontext', title)))
+
+  def popcontext(self) -> None:
+    self._queue.put((os.getpid(), ('popcontext',)))
+
+  def recontext(self, title: str) -> None:
+    self._queue.put((os.getpid(), ('recontext', title)))
+
+  def write(self, text: str, level: proto.Level) -> None:
+    self._queue.put((os.getpid(), ('write', text, level)))
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    with self._lock:
+      fid = self._fid
+      self._fid += 1
+    fd, path = tempfile.mkstemp(dir=self._stagingdir)
+    self._queue.put((os.getpid(), ('open', fid, filename, mode, level)))
+    try:
+      with open(fd, mode, encoding='utf-8' if mode == 'w' else None, newline='' if mode == 'w' else None) as f:
+        yield f
+    finally:
+      self._queue.put((os.getpid(), ('close', fid, path)))
+
+  def install(self) -> None:
+    '''Make this the current logger of the process.
+
+    Intended as initializer of a process pool, e.g.
+    ``multiprocessing.Pool(initializer=collector.log.install)``.'''
+
+    import treelog
+    treelog.current = self
+
+class Collector:
+  '''Collect messages of :class:`QueueLog` instances in a background thread.
+
+  Upon enter, a queue and a staging directory are created, a :class:`QueueLog`
+  that writes to them is made available as :attr:`log`, and a thread is
+  started that writes all incoming messages to ``log``, by default the logger
+  that is current upon enter. The messages of every process are placed in a
+  top level context with ``title``, formatted with the ``pid`` of the process,
+  and interleaved as described for :func:`treelog.merge`. Upon exit, all
+  remaining messages are written and the staging directory is removed.
+
+  The :attr:`log` should be passed on to the child processes when they are
+  created, for instance via the initializer of a process pool. Since messages
+  are written from the background thread, the parent process should not write
+  to the underlying logger while the collector is active, but can write to
+  :attr:`log` just like the children.'''
+
+  def __init__(self, log: typing.Optional[proto.Log] = None, *, title: str = 'process {pid}', context: typing.Optional[typing.Any] = None, dedup: bool = False) -> None:
+    self._baselog = log
+    self._title = title
+    self._mp = context or multiprocessing.get_context()
+    self._dedup = dedup
+    self._worker = None # type: typing.Optional[threading.Thread]
+
+  def __enter__(self) -> 'Collector':
+    if self._worker:
+      raise RuntimeError('collector is already active')
+    if self._baselog is None:
+      from . import current
+      baselog = current
+    else:
+      baselog = self._baselog
+    self._queue = self._mp.SimpleQueue()
+    self._stagingdir = tempfile.mkdtemp(prefix='treelog-')
+    self.log = QueueLog(self._queue, self._stagingdir)
+    self._worker = threading.Thread(target=self._run, args=(Interleaver(baselog, dedup=self._dedup),), name='treelog collector', daemon=True)
+    self._worker.start()
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    assert self._worker
+    self._queue.put(None)
+    self._worker.join()
+    self._worker = None
+    shutil.rmtree(self._stagingdir, ignore_errors=True)
+
+  def _run(self, interleaver: Interleaver) -> None:
+    pids = set() # type: typing.Set[int]
+    modes = {} # type: typing.Dict[typing.Tuple[int, int], str]
+    while True:
+      item = self._queue.get()
+      if item is None:
+        break
+      pid, message = item
+      if pid not in pids:
+        pids.add(pid)
+        interleaver.addsource(pid, self._title.format(pid=pid))
+      if message[0] == 'open':
+        modes[pid, message[1]] = message[3]
+      elif message[0] == 'close':
+        with open(message[2], 'rb') as f:
+          data = f.read()
+        os.unlink(message[2])
+        message = 'close', message[1], data.decode('utf-8') if modes.pop((pid, message[1])) == 'w' else data
+      interleaver.feed(pid, message)
+    interleaver.close()
+
+# vim:sw=2:sts=2:et
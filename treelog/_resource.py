@@ -0,0 +1,119 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib, sys, threading, tracemalloc, typing, typing_extensions
+from . import proto
+
+Sample = typing.Tuple[typing.Optional[int], typing.Optional[int], typing.Optional[typing.Tuple[int, int]]]
+
+class ResourceLog:
+  '''Annotate contexts with their resource usage.
+
+  Forwards all messages to ``baselog``, and writes a summary of the resources
+  used by every context as its last message, at the given level. The summary
+  lists the peak resident set size of the process and its increase during the
+  context, the change in memory allocated by Python if :mod:`tracemalloc` is
+  tracing, and the number of bytes read from and written to storage according
+  to ``/proc/self/io``. Resources that are not available on the platform are
+  omitted.'''
+
+  def __init__(self, baselog: proto.Log, level: proto.Level = proto.Level.debug) -> None:
+    self._baselog = baselog
+    self._level = level
+    self._stack = [] # type: typing.List[Sample]
+    self._lock = threading.RLock()
+
+  def pushcontext(self, title: str) -> None:
+    with self._lock:
+      self._baselog.pushcontext(title)
+      self._stack.append(sample())
+
+  def popcontext(self) -> None:
+    with self._lock:
+      self._baselog.write(summarize(self._stack.pop(), sample()), self._level)
+      self._baselog.popcontext()
+
+  def recontext(self, title: str) -> None:
+    with self._lock:
+      self._baselog.write(summarize(self._stack.pop(), sample()), self._level)
+      self._baselog.recontext(title)
+      self._stack.append(sample())
+
+  def write(self, text: str, level: proto.Level) -> None:
+    self._baselog.write(text, level)
+
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing_extensions.ContextManager[typing.IO[typing.Any]]:
+    return self._baselog.open(filename, mode, level)
+
+def peakrss() -> typing.Optional[int]:
+  '''Return peak resident set size of the process in bytes, if available.'''
+
+  if sys.platform == 'win32':
+    return None
+  import resource
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def tracedmemory() -> typing.Optional[int]:
+  '''Return memory allocated by Python in bytes, if tracemalloc is tracing.'''
+
+  return tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+
+def iobytes() -> typing.Optional[typing.Tuple[int, int]]:
+  '''Return number of bytes read from and written to storage, if available.'''
+
+  try:
+    with open('/proc/self/io', 'rb') as f:
+      fields = dict(line.split(b':', 1) for line in f)
+    return int(fields[b'read_bytes']), int(fields[b'write_bytes'])
+  except (OSError, KeyError, ValueError):
+    return None
+
+def sample() -> Sample:
+  return peakrss(), tracedmemory(), iobytes()
+
+def summarize(start: Sample, stop: Sample) -> str:
+  '''Describe the resources used between two samples.'''
+
+  rss0, traced0, io0 = start
+  rss1, traced1, io1 = stop
+  items = []
+  if rss0 is not None and rss1 is not None:
+    items.append('peak rss {} (+{})'.format(formatbytes(rss1), formatbytes(rss1 - rss0)))
+  if traced0 is not None and traced1 is not None:
+    items.append('allocated {}{}'.format('+' if traced1 >= traced0 else '-', formatbytes(abs(traced1 - traced0))))
+  if io0 is not None and io1 is not None:
+    items.append('read {}'.format(formatbytes(io1[0] - io0[0])))
+    items.append('written {}'.format(formatbytes(io1[1] - io0[1])))
+  return ', '.join(items) or 'no resource usage available'
+
+def formatbytes(n: int) -> str:
+  '''Format number of bytes with a binary prefix, e.g. ``1.5M``.'''
+
+  if n < 1024:
+    return '{}B'.format(n)
+  value = float(n)
+  for prefix in 'KMGTP':
+    value /= 1024
+    if value < 1024:
+      break
+  return '{:.1f}{}'.format(value, prefix)
+
+# vim:sw=2:sts=2:et
@@ -0,0 +1,370 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib, heapq, multiprocessing, os, shutil, struct, tempfile, threading, time, types, typing
+from . import proto
+from ._binary import PUSHCONTEXT, POPCONTEXT, RECONTEXT, WRITE, OPEN, CLOSE, Event, encodestring, _event, _size, _open
+from ._merge import Interleaver
+
+# Every ring starts with a header of two cache lines: the first holds the pid
+# of the owning process, the number of bytes written by it and a flag that is
+# set when the owner exits, the second the number of bytes read by the
+# collector. Both counters only ever increase; the position in the ring is the
+# counter modulo the capacity. A pid of zero marks a free ring, which only the
+# collector sets, after draining a ring of which the owner exited or died.
+_HEADER = 128
+_PID, _HEAD, _RELEASED, _TAIL = 0, 8, 16, 64
+_counter = struct.Struct('<Q')
+
+class SharedMemoryLog:
+  '''Forward messages to a :class:`SharedMemoryCollector`.
+
+  Every process that writes to the log claims one of the rings of the
+  collector upon its first message, and is the only writer of that ring until
+  it exits, such that messages are written without locking between processes;
+  threads of the same process share the ring under a local lock. If all rings
+  are in use the writer waits for a ring of an exited process to be drained,
+  and raises :class:`RuntimeError` if there is none. Events are encoded
+  as for :class:`BinaryLog`, except that the contents of files are written to
+  a staging file of which only the path is sent. If the ring is full the
+  writer waits for the collector to catch up. Instances are obtained from
+  :attr:`SharedMemoryCollector.log`.'''
+
+  def __init__(self, name: str, nrings: int, capacity: int, lock: typing.Any, stagingdir: str) -> None:
+    self._name = name
+    self._nrings = nrings
+    self._capacity = capacity
+    self._lock = lock
+    self._stagingdir = stagingdir
+    self._shm = None # type: typing.Any
+    self._pid = 0
+    self._fid = 0
+    self._threadlock = threading.Lock()
+
+  def __getstate__(self) -> typing.Tuple[str, int, int, typing.Any, str]:
+    return self._name, self._nrings, self._capacity, self._lock, self._stagingdir
+
+  def __setstate__(self, state: typing.Tuple[str, int, int, typing.Any, str]) -> None:
+    self.__init__(*state) # type: ignore
+
+  def _claim(self) -> None:
+    if self._shm is None:
+      from multiprocessing import shared_memory
+      self._shm = shared_memory.SharedMemory(self._name)
+    buf = self._shm.buf
+    pid = os.getpid()
+    while True:
+      with self._lock:
+        ending = False
+        for iring in range(self._nrings):
+          offset = iring * (_HEADER + self._capacity)
+          owner = _counter.unpack_from(buf, offset + _PID)[0]
+          if not owner:
+            _counter.pack_into(buf, offset + _RELEASED, 0) # prior to the pid, such that the collector never sees the flag of the previous owner
+            _counter.pack_into(buf, offset + _PID, pid)
+            break
+          ending = ending or bool(_ended(buf, offset))
+        else:
+          if not ending:
+            raise RuntimeError('all {} rings of the shared memory log are in use'.format(self._nrings))
+          offset = -1
+      if offset >= 0:
+        break
+      time.sleep(.001) # wait for the collector to free the ring of an exited process
+    self._offset = offset
+    self._head = _counter.unpack_from(buf, offset + _HEAD)[0]
+    self._pid = pid
+    self._fid = 0
+    from multiprocessing import util
+    util.Finalize(None, self._release, exitpriority=0)
+
+  def _release(self) -> None:
+    # called at exit of the owning process, also via the finalizers of a
+    # multiprocessing worker, which does not run atexit handlers
+    buf = self._shm.buf if self._shm is not None else None
+    if self._pid == os.getpid() and buf is not None:
+      _counter.pack_into(buf, self._offset + _RELEASED, 1)
+    self._pid = 0
+
+  def _put(self, data: bytes) -> None:
+    with self._threadlock:
+      self._putlocked(data)
+
+  def _putlocked(self, data: bytes) -> None:
+    if self._pid != os.getpid():
+      self._claim()
+    buf = self._shm.buf
+    base = self._offset + _HEADER
+    capacity = self._capacity
+    head = self._head
+    pos = 0
+    while pos < len(data):
+      free = capacity - head + _counter.unpack_from(buf, self._offset + _TAIL)[0]
+      if not free:
+        time.sleep(.001)
+        continue
+      n = min(free, len(data) - pos)
+      start = head % capacity
+      first = min(n, capacity - start)
+      buf[base+start:base+start+first] = data[pos:pos+first]
+      buf[base:base+n-first] = data[pos+first:pos+n]
+      head += n
+      pos += n
+      _counter.pack_into(buf, self._offset + _HEAD, head)
+    self._head = head
+
+  def pushcontext(self, title: str) -> None:
+    self._put(_event.pack(PUSHCONTEXT, time.monotonic()) + encodestring(title))
+
+  def popcontext(self) -> None:
+    self._put(_event.pack(POPCONTEXT, time.monotonic()))
+
+  def recontext(self, title: str) -> None:
+    self._put(_event.pack(RECONTEXT, time.monotonic()) + encodestring(title))
+
+  def write(self, text: str, level: proto.Level) -> None:
+    self._put(_event.pack(WRITE, time.monotonic()) + bytes([level.value]) + encodestring(text))
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    with self._threadlock:
+      if self._pid != os.getpid():
+        self._claim()
+      fid = self._fid
+      self._fid += 1
+    fd, path = tempfile.mkstemp(dir=self._stagingdir)
+    self._put(_event.pack(OPEN, time.monotonic()) + _open.pack(fid, level.value, mode == 'wb') + encodestring(filename))
+    try:
+      with open(fd, mode, encoding='utf-8' if mode == 'w' else None, newline='' if mode == 'w' else None) as f:
+        yield f
+    finally:
+      self._put(_event.pack(CLOSE, time.monotonic()) + _size.pack(fid) + encodestring(path))
+
+  def install(self) -> None:
+    '''Make this the current logger of the process.'''
+
+    import treelog
+    treelog.current = self
+
+class SharedMemoryCollector:
+  '''Collect messages of :class:`SharedMemoryLog` instances in a background thread.
+
+  Like :class:`Collector`, but with messages passed through ring buffers in
+  shared memory rather than a pipe, which avoids pickling every message and
+  bounds the memory in use. Upon enter, ``nrings`` rings of ``capacity``
+  bytes are allocated, one for every process that is writing to :attr:`log`
+  at the same time, including the parent if it does. The ring of a process
+  that exits, or is killed, is reused once drained. The background thread polls
+  the rings every ``interval`` seconds when they are idle, and writes the
+  events of all rings in order of their timestamps. Requires Python 3.8 or
+  higher.'''
+
+  def __init__(self, log: typing.Optional[proto.Log] = None, *, nrings: typing.Optional[int] = None, capacity: int = 2**20, interval: float = .01, title: str = 'process {pid}', context: typing.Optional[typing.Any] = None, dedup: bool = False) -> None:
+    self._baselog = log
+    self._nrings = nrings or (os.cpu_count() or 1) + 1
+    self._capacity = capacity
+    self._interval = interval
+    self._title = title
+    self._mp = context or multiprocessing.get_context()
+    self._dedup = dedup
+    self._worker = None # type: typing.Optional[threading.Thread]
+    self._log = None # type: typing.Optional[SharedMemoryLog]
+
+  @property
+  def log(self) -> SharedMemoryLog:
+    '''The logger that writes to the rings, available while entered.'''
+
+    if self._log is None:
+      raise RuntimeError('collector is not active')
+    return self._log
+
+  def __enter__(self) -> 'SharedMemoryCollector':
+    if self._worker:
+      raise RuntimeError('collector is already active')
+    from multiprocessing import shared_memory
+    if self._baselog is None:
+      from . import current
+      baselog = current
+    else:
+      baselog = self._baselog
+    self._shm = shared_memory.SharedMemory(create=True, size=self._nrings * (_HEADER + self._capacity))
+    self._stagingdir = tempfile.mkdtemp(prefix='treelog-')
+    self._log = SharedMemoryLog(self._shm.name, self._nrings, self._capacity, self._mp.Lock(), self._stagingdir)
+    self._log._shm = self._shm
+    self._stop = threading.Event()
+    self._worker = threading.Thread(target=self._run, args=(self._log, Interleaver(baselog, dedup=self._dedup)), name='treelog collector', daemon=True)
+    self._worker.start()
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    assert self._worker
+    self._stop.set()
+    self._worker.join()
+    self._worker = None
+    self._log = None # releases the shared memory
+    self._shm.close()
+    self._shm.unlink()
+    shutil.rmtree(self._stagingdir, ignore_errors=True)
+
+  def _run(self, log: SharedMemoryLog, interleaver: Interleaver) -> None:
+    buf = self._shm.buf
+    assert buf is not None
+    rings = [_Reader(buf, iring * (_HEADER + self._capacity), self._capacity) for iring in range(self._nrings)]
+    pids = set() # type: typing.Set[int]
+    while True:
+      stopping = self._stop.is_set() # drain once more after the stop request
+      ended = [(ring, ring.ended()) for ring in rings] # prior to draining, such that no events follow
+      batches = [ring.drain() for ring in rings]
+      if any(batches):
+        for t, pid, message in heapq.merge(*batches, key=lambda item: item[0]):
+          if message[0] == 'close':
+            path = message[2]
+            with open(path, 'rb') as f:
+              data = f.read()
+            os.unlink(path)
+            message = 'close', message[1], data if message[3] else data.decode('utf-8')
+          elif pid not in pids:
+            pids.add(pid)
+            interleaver.addsource(pid, self._title.format(pid=pid))
+          interleaver.feed(pid, message)
+      ended = [(ring, pid) for ring, pid in ended if pid]
+      if ended:
+        with log._lock:
+          for ring, pid in ended:
+            if ring.free(pid) and pid in pids:
+              pids.remove(pid)
+              interleaver.removesource(pid)
+      elif not any(batches):
+        if stopping:
+          break
+        self._stop.wait(self._interval)
+    interleaver.close()
+
+class _Reader:
+
+  def __init__(self, buf: memoryview, offset: int, capacity: int) -> None:
+    self._buf = buf
+    self._offset = offset
+    self._capacity = capacity
+    self._pending = bytearray()
+    self._modes = {} # type: typing.Dict[int, bool]
+    self._levels = list(proto.Level)
+
+  def drain(self) -> typing.List[typing.Tuple[float, int, typing.Tuple[typing.Any, ...]]]:
+    buf = self._buf
+    head = _counter.unpack_from(buf, self._offset + _HEAD)[0]
+    tail = _counter.unpack_from(buf, self._offset + _TAIL)[0]
+    if head == tail:
+      return []
+    base = self._offset + _HEADER
+    start = tail % self._capacity
+    stop = start + head - tail
+    if stop <= self._capacity:
+      self._pending += buf[base+start:base+stop]
+    else:
+      self._pending += buf[base+start:base+self._capacity]
+      self._pending += buf[base:base+stop-self._capacity]
+    _counter.pack_into(buf, self._offset + _TAIL, head)
+    pid = _counter.unpack_from(buf, self._offset + _PID)[0]
+    events = []
+    pos = 0
+    while True:
+      decoded = self._decode(pos)
+      if decoded is None:
+        break
+      (t, message), pos = decoded
+      events.append((t, pid, message))
+    del self._pending[:pos]
+    return events
+
+  def ended(self) -> int:
+    return _ended(self._buf, self._offset)
+
+  def free(self, pid: int) -> bool:
+    # to be called with the lock of the log held, after the final drain
+    if _counter.unpack_from(self._buf, self._offset + _PID)[0] != pid:
+      return False # reclaimed by a new process with a different pid
+    self._pending.clear() # the incomplete event of a killed process, if any
+    self._modes.clear()
+    _counter.pack_into(self._buf, self._offset + _PID, 0)
+    return True
+
+  def _decode(self, pos: int) -> typing.Optional[typing.Tuple[Event, int]]:
+    data = self._pending
+    if len(data) < pos + _event.size:
+      return None
+    opcode, t = _event.unpack_from(data, pos)
+    pos += _event.size
+    if opcode == PUSHCONTEXT or opcode == RECONTEXT:
+      decoded = self._string(pos)
+      if decoded is None:
+        return None
+      title, pos = decoded
+      return (t, ('pushcontext' if opcode == PUSHCONTEXT else 'recontext', title)), pos
+    elif opcode == POPCONTEXT:
+      return (t, ('popcontext',)), pos
+    elif opcode == WRITE:
+      decoded = self._string(pos + 1)
+      if decoded is None:
+        return None
+      text, end = decoded
+      return (t, ('write', text, self._levels[data[pos]])), end
+    elif opcode == OPEN:
+      decoded = self._string(pos + _open.size)
+      if decoded is None:
+        return None
+      filename, end = decoded
+      fid, level, binary = _open.unpack_from(data, pos)
+      self._modes[fid] = bool(binary)
+      return (t, ('open', fid, filename, 'wb' if binary else 'w', self._levels[level])), end
+    elif opcode == CLOSE:
+      decoded = self._string(pos + _size.size)
+      if decoded is None:
+        return None
+      path, end = decoded
+      fid, = _size.unpack_from(data, pos)
+      return (t, ('close', fid, path, self._modes.pop(fid))), end
+    else:
+      raise ValueError('invalid opcode {}'.format(opcode))
+
+  def _string(self, pos: int) -> typing.Optional[typing.Tuple[str, int]]:
+    data = self._pending
+    if len(data) < pos + _size.size:
+      return None
+    size, = _size.unpack_from(data, pos)
+    pos += _size.size
+    if len(data) < pos + size:
+      return None
+    return data[pos:pos+size].decode('utf-8', 'surrogateescape'), pos + size
+
+def _ended(buf: memoryview, offset: int) -> int:
+  # the pid of the owner of the ring at offset if it exited or was killed, zero otherwise
+  pid = typing.cast(int, _counter.unpack_from(buf, offset + _PID)[0])
+  if not pid or _counter.unpack_from(buf, offset + _RELEASED)[0]:
+    return pid
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return pid
+  except PermissionError:
+    pass
+  return 0
+
+# vim:sw=2:sts=2:et
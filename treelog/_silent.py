@@ -18,7 +18,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import os, contextlib, functools, typing, typing_extensions, tempfile
+import os, contextlib, functools, threading, typing, typing_extensions, tempfile
 from . import proto, _io
 
 class NullLog:
@@ -39,17 +39,27 @@ class NullLog:
     return _io.devnull(mode)
 
 class DataLog:
-  '''Output only data.'''
+  '''Output only data.
+
+  The log can be pickled, for instance to pass it to a task of a process pool,
+  provided that ``names`` can be pickled as well. The unpickled log writes to
+  the same directory, which should therefore be shared by all processes.'''
 
   def __init__(self, dirpath: str = os.curdir, names: typing.Callable[[str], typing.Iterable[str]] = _io.sequence) -> None:
+    self._args = os.path.abspath(dirpath), names
     self._names = functools.lru_cache(maxsize=32)(names)
     self._dir = _io.directory(dirpath)
+    self._lock = threading.Lock()
+
+  def __reduce__(self) -> typing.Tuple[typing.Any, ...]:
+    return DataLog, self._args
 
   @contextlib.contextmanager
   def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
     with self._dir.temp(mode) as f:
       yield f
-      self._dir.linkfirstunused(f, self._names(filename))
+      with self._lock: # the cached name generators are shared
+        self._dir.linkfirstunused(f, self._names(filename))
 
   def pushcontext(self, title: str) -> None:
     pass
@@ -93,37 +103,54 @@ class RecordLog:
     self._simplify = simplify
     self._messages = [] # type: typing.List[typing.Any]
     self._fid = 0 # internal file counter
+    self._lock = threading.Lock()
+
+  def __getstate__(self) -> typing.Tuple[bool, typing.List[typing.Any], int]:
+    return self._simplify, self._messages, self._fid
+
+  def __setstate__(self, state: typing.Union[typing.Tuple[bool, typing.List[typing.Any], int], typing.Dict[str, typing.Any]]) -> None:
+    if isinstance(state, dict): # pickled by an earlier version
+      state = state['_simplify'], state['_messages'], state['_fid']
+    self._simplify, self._messages, self._fid = state
+    self._lock = threading.Lock()
 
   def pushcontext(self, title: str) -> None:
-    if self._simplify and self._messages and self._messages[-1][0] == 'popcontext':
-      self._messages[-1] = 'recontext', title
-    else:
-      self._messages.append(('pushcontext', title))
+    with self._lock:
+      if self._simplify and self._messages and self._messages[-1][0] == 'popcontext':
+        self._messages[-1] = 'recontext', title
+      else:
+        self._messages.append(('pushcontext', title))
 
   def recontext(self, title: str) -> None:
-    if self._simplify and self._messages and self._messages[-1][0] in ('pushcontext', 'recontext'):
-      self._messages[-1] = self._messages[-1][0], title
-    else:
-      self._messages.append(('recontext', title))
+    with self._lock:
+      if self._simplify and self._messages and self._messages[-1][0] in ('pushcontext', 'recontext'):
+        self._messages[-1] = self._messages[-1][0], title
+      else:
+        self._messages.append(('recontext', title))
 
   def popcontext(self) -> None:
-    if not self._simplify or not self._messages or self._messages[-1][0] not in ('pushcontext', 'recontext') or self._messages.pop()[0] == 'recontext':
-      self._messages.append(('popcontext',))
+    with self._lock:
+      if not self._simplify or not self._messages or self._messages[-1][0] not in ('pushcontext', 'recontext') or self._messages.pop()[0] == 'recontext':
+        self._messages.append(('popcontext',))
 
   @contextlib.contextmanager
   def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
-    fid = self._fid
-    self._fid += 1
-    self._messages.append(('open', fid, filename, mode, level))
+    with self._lock:
+      fid = self._fid
+      self._fid += 1
+      self._messages.append(('open', fid, filename, mode, level))
     with tempfile.TemporaryFile(mode+'+') as g:
       try:
         yield g
       finally:
         g.seek(0)
-        self._messages.append(('close', fid, g.read()))
+        data = g.read()
+        with self._lock:
+          self._messages.append(('close', fid, data))
 
   def write(self, text: str, level: proto.Level) -> None:
-    self._messages.append(('write', text, level))
+    with self._lock:
+      self._messages.append(('write', text, level))
 
   def replay(self, log: typing.Optional[proto.Log] = None) -> None:
     '''Replay this recorded log.
@@ -131,29 +158,36 @@ class RecordLog:
     All recorded messages and files will be written to the log that is either
     directly specified or currently active.'''
 
-    files = {}
     if log is None:
-      from . import current
-      log = current
-    for cmd, *args in self._messages:
-      if cmd == 'pushcontext':
-        title, = args
-        log.pushcontext(title)
-      elif cmd == 'recontext':
-        title, = args
-        log.recontext(title)
-      elif cmd == 'popcontext':
-        log.popcontext()
-      elif cmd == 'open':
-        fid, filename, mode, level = args
-        ctx = log.open(filename, mode, level=level)
-        files[fid] = ctx, ctx.__enter__()
-      elif cmd == 'close':
-        fid, data = args
-        ctx, f = files.pop(fid)
-        if data is not None:
-          f.write(data)
-        ctx.__exit__(None, None, None)
-      elif cmd == 'write':
-        text, level = args
-        log.write(text, level=level)
+      from . import _current
+      log = _current()
+    replay(self._messages, log)
+
+def replay(messages: typing.Iterable[typing.Tuple[typing.Any, ...]], log: proto.Log) -> None:
+  '''Replay messages in the vocabulary of :class:`RecordLog` to log.'''
+
+  files = {}
+  for cmd, *args in messages:
+    if cmd == 'pushcontext':
+      title, = args
+      log.pushcontext(title)
+    elif cmd == 'recontext':
+      title, = args
+      log.recontext(title)
+    elif cmd == 'popcontext':
+      log.popcontext()
+    elif cmd == 'open':
+      fid, filename, mode, level = args
+      ctx = log.open(filename, mode, level=level)
+      files[fid] = ctx, ctx.__enter__()
+    elif cmd == 'close':
+      fid, data = args
+      ctx, f = files.pop(fid)
+      if data is not None:
+        f.write(data)
+      ctx.__exit__(None, None, None)
+    elif cmd == 'write':
+      text, level = args
+      log.write(text, level=level)
+
+# vim:sw=2:sts=2:et
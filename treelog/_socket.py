@@ -0,0 +1,390 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os, socket, socketserver, sys, threading, time, typing, uuid, warnings
+from . import proto, _binary, _fork, _html, _silent
+
+Address = typing.Union[str, typing.Tuple[str, int]]
+
+class SocketLog(_binary.BinaryLog):
+  '''Stream events to a collector over a socket.
+
+  Events are encoded as for :class:`BinaryLog` and sent to ``address``, the
+  path of a Unix socket or a ``(host, port)`` tuple, in batches of at least
+  ``batchsize`` bytes or upon :meth:`flush`. The collector acknowledges the
+  events it has written, and unacknowledged events are kept such that if the
+  connection is lost they are resent after reconnecting; the collector
+  continues writing to the same output. Reconnecting is attempted upon the
+  next batch or flush, at most ``retries`` times and at least ``delay``
+  seconds apart, such that events are buffered rather than waited for in the
+  meantime. If all attempts fail a warning is issued and events are dropped
+  from then on. Upon close, the log waits for the collector to finish the
+  output, using the attempts that remain. A process that is forked while the log is open connects as a new
+  producer upon its first event. A collector is started with::
+
+    python -m treelog collect /tmp/treelog.sock outdir'''
+
+  def __init__(self, address: Address, *, title: typing.Optional[str] = None, batchsize: int = 2**16, retries: int = 10, delay: float = .1) -> None:
+    self._title = ' '.join(sys.argv) if title is None else title
+    self._args = address, batchsize, retries, delay
+    self._file = typing.cast(typing.IO[typing.Any], _Stream(self._title, *self._args))
+    self._fid = 0
+    self._contexts = [] # type: typing.List[str]
+    self._forked = False
+    self._lock = threading.Lock()
+    _fork.register(self)
+
+  def _beforefork(self) -> None:
+    self._lock.acquire()
+
+  def _afterfork(self, child: bool) -> None:
+    if not child:
+      self._lock.release()
+      return
+    self._lock = threading.Lock()
+    if not self._file.closed:
+      typing.cast(_Stream, self._file).detach()
+      self._forked = True
+
+  def _startchild(self) -> None:
+    # to be called with the lock held
+    self._forked = False
+    self._file = typing.cast(typing.IO[typing.Any], _Stream('{} (pid {})'.format(self._title, os.getpid()), *self._args))
+    t = time.monotonic()
+    for title in self._contexts:
+      self._file.write(_binary._event.pack(_binary.PUSHCONTEXT, t) + _binary.encodestring(title))
+
+class _Stream:
+  '''Binary file-like object that writes to a socket with acknowledgements.'''
+
+  def __init__(self, title: str, address: Address, batchsize: int, retries: int, delay: float) -> None:
+    self._address = address
+    self._hello = _binary.MAGIC + _binary.encodestring(title) + _binary.encodestring(uuid.uuid4().hex)
+    self._batchsize = batchsize
+    self._retries = retries
+    self._delay = delay
+    self._sock = None # type: typing.Optional[socket.socket]
+    self._pending = bytearray() # written bytes starting at offset _acked
+    self._acked = 0
+    self._sent = 0
+    self._acks = bytearray()
+    self._attempts = 0 # number of failed attempts since the last success
+    self._next = 0. # time.monotonic of the next attempt
+    self._failed = False
+    self.closed = False
+
+  def write(self, data: bytes) -> int:
+    if not self._failed:
+      self._pending += data
+      if self._acked + len(self._pending) - self._sent >= self._batchsize:
+        self.flush()
+    return len(data)
+
+  def flush(self) -> None:
+    self._attempt(self._send, wait=False)
+
+  def close(self) -> None:
+    if not self.closed:
+      self.write(_binary._event.pack(_binary.END, time.monotonic()))
+      self._attempt(self._finish, wait=True)
+      self.closed = True
+
+  def detach(self) -> None:
+    '''Release the connection without ending the stream, after a fork.'''
+
+    if self._sock is not None:
+      self._sock.close()
+      self._sock = None
+    self.closed = True
+
+  def _attempt(self, func: typing.Callable[[socket.socket], None], wait: bool) -> None:
+    # Call func with a connected socket. After a failure the next attempt is
+    # made no sooner than delay seconds later, by a later call or, if wait is
+    # true, by this call after sleeping; until then the events stay pending.
+    while not self._failed:
+      if self._sock is None:
+        remaining = self._next - time.monotonic()
+        if remaining > 0:
+          if not wait:
+            return
+          time.sleep(remaining)
+      try:
+        if self._sock is None:
+          self._sock = self._connect()
+        func(self._sock)
+      except OSError as e:
+        if self._sock is not None:
+          self._sock.close()
+          self._sock = None
+        self._attempts += 1
+        if self._attempts > self._retries:
+          self._giveup(e)
+        self._next = time.monotonic() + self._delay
+      else:
+        self._attempts = 0
+        return
+
+  def _giveup(self, reason: Exception) -> None:
+    warnings.warn('failed to send log to {}: {}; dropping {} bytes of events and all that follow'.format(self._address, reason, len(self._pending)))
+    self._failed = True
+    self._pending.clear()
+
+  def _connect(self) -> socket.socket:
+    if isinstance(self._address, str):
+      sock = socket.socket(socket.AF_UNIX)
+      try:
+        sock.connect(self._address)
+      except:
+        sock.close()
+        raise
+    else:
+      sock = socket.create_connection(self._address)
+    sock.sendall(self._hello)
+    self._acks.clear()
+    data = b''
+    while len(data) < _binary._datasize.size:
+      chunk = sock.recv(_binary._datasize.size - len(data))
+      if not chunk:
+        sock.close()
+        raise ConnectionResetError('collector closed the connection')
+      data += chunk
+    consumed, = _binary._datasize.unpack(data)
+    if consumed < self._acked:
+      sock.close()
+      self._attempts = self._retries # the stream cannot be resumed, so reconnecting is pointless
+      raise ConnectionError('collector lost {} bytes of the stream'.format(self._acked - consumed))
+    self._ack(consumed)
+    self._sent = consumed
+    return sock
+
+  def _ack(self, consumed: int) -> None:
+    del self._pending[:consumed-self._acked]
+    self._acked = consumed
+
+  def _send(self, sock: socket.socket) -> None:
+    if self._sent < self._acked + len(self._pending):
+      sock.sendall(self._pending[self._sent-self._acked:])
+      self._sent = self._acked + len(self._pending)
+    self._recvacks(sock, block=False)
+    while len(self._pending) > 4 * self._batchsize:
+      if not self._recvacks(sock, block=True):
+        raise ConnectionResetError('collector closed the connection')
+
+  def _recvacks(self, sock: socket.socket, block: bool) -> bool:
+    sock.settimeout(None if block else 0)
+    try:
+      data = sock.recv(4096)
+    except BlockingIOError:
+      return True
+    finally:
+      sock.settimeout(None)
+    if not data:
+      return False
+    self._acks += data
+    n = len(self._acks) // _binary._datasize.size * _binary._datasize.size
+    if n:
+      self._ack(_binary._datasize.unpack_from(self._acks, n - _binary._datasize.size)[0])
+      del self._acks[:n]
+    return True
+
+  def _finish(self, sock: socket.socket) -> None:
+    self._send(sock)
+    while self._recvacks(sock, block=True):
+      pass
+    if self._pending:
+      raise ConnectionResetError('collector closed the connection before the end of the stream')
+    sock.close()
+    self._sock = None
+
+class CollectorServer(socketserver.ThreadingTCPServer):
+  '''Collect the events of :class:`SocketLog` instances.
+
+  Every log that connects to ``address``, the path of a Unix socket or a
+  ``(host, port)`` tuple, is written to a directory of its own in ``outdir``
+  using :class:`HtmlLog`, or :class:`DataLog` if ``format`` is ``'data'``.
+  Every connection is handled in a separate thread. A log that reconnects
+  after a lost connection continues in the same directory. The output of a
+  log is complete as soon as the log is closed; the output of logs that
+  disconnected without closing is finished by :meth:`server_close`.'''
+
+  daemon_threads = True
+  allow_reuse_address = True
+
+  def __init__(self, address: Address, outdir: str, *, format: str = 'html') -> None:
+    if format not in ('html', 'data'):
+      raise ValueError('invalid format {!r}'.format(format))
+    self._path = address if isinstance(address, str) else None # path of the unix socket, removed on close
+    if self._path is not None:
+      self.address_family = socket.AF_UNIX
+    self._outdir = outdir
+    self._format = format
+    self._lock = threading.Lock()
+    self._producers = {} # type: typing.Dict[str, _Producer]
+    self._nproducers = 0
+    os.makedirs(outdir, exist_ok=True)
+    super().__init__(typing.cast(typing.Any, address), _Handler)
+
+  def _producer(self, key: str, title: str) -> '_Producer':
+    with self._lock:
+      producer = self._producers.get(key)
+      if producer is None:
+        while True:
+          self._nproducers += 1
+          dirpath = os.path.join(self._outdir, 'producer-{}'.format(self._nproducers))
+          try:
+            os.mkdir(dirpath)
+          except FileExistsError:
+            continue
+          break
+        log = _html.HtmlLog(dirpath, title=title) if self._format == 'html' else _silent.DataLog(dirpath) # type: proto.Log
+        producer = self._producers[key] = _Producer(log, dirpath)
+      elif producer.connection is not None:
+        try: # unblock the handler of the lost connection
+          producer.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+          pass
+      return producer
+
+  def _finish(self, key: str) -> None:
+    with self._lock:
+      producer = self._producers.pop(key)
+    producer.close()
+
+  def server_close(self) -> None:
+    super().server_close()
+    if self._path is not None:
+      try:
+        os.unlink(self._path)
+      except OSError:
+        pass
+    with self._lock:
+      producers = list(self._producers.values())
+      self._producers.clear()
+    for producer in producers:
+      if producer.connection is not None:
+        try:
+          producer.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+          pass
+      with producer.lock:
+        producer.close()
+
+class _Producer:
+
+  def __init__(self, log: proto.Log, dirpath: str) -> None:
+    self.log = log
+    self.dirpath = dirpath
+    self.lock = threading.Lock()
+    self.connection = None # type: typing.Optional[socket.socket]
+    self.consumed = 0
+    self.modes = {} # type: typing.Dict[int, bool]
+    self.files = {} # type: typing.Dict[int, typing.Tuple[typing.Any, ...]]
+    self.depth = 0
+
+  def feed(self, message: typing.Tuple[typing.Any, ...]) -> None:
+    cmd = message[0]
+    if cmd == 'pushcontext':
+      self.log.pushcontext(message[1])
+      self.depth += 1
+    elif cmd == 'recontext':
+      self.log.recontext(message[1])
+    elif cmd == 'popcontext':
+      self.log.popcontext()
+      self.depth -= 1
+    elif cmd == 'write':
+      self.log.write(message[1], message[2])
+    elif cmd == 'open':
+      self.files[message[1]] = message[2:]
+    elif cmd == 'close':
+      filename, mode, level = self.files.pop(message[1])
+      with self.log.open(filename, mode, level) as f:
+        f.write(message[2])
+
+  def close(self) -> None:
+    while self.depth:
+      self.log.popcontext()
+      self.depth -= 1
+    close = getattr(self.log, 'close', None)
+    if close is not None:
+      close()
+
+class _Handler(socketserver.BaseRequestHandler):
+
+  def handle(self) -> None:
+    reader = _Reader(self.request)
+    f = typing.cast(typing.BinaryIO, reader)
+    if reader.read(len(_binary.MAGIC)) != _binary.MAGIC:
+      return
+    title = _binary._readstring(f)
+    key = _binary._readstring(f)
+    if title is None or key is None:
+      return
+    server = typing.cast(CollectorServer, self.server)
+    producer = server._producer(key, title)
+    with producer.lock:
+      producer.connection = self.request
+      try:
+        start = producer.consumed - reader.pos
+        reader.onblock = lambda: self.request.sendall(_binary._datasize.pack(producer.consumed))
+        self.request.sendall(_binary._datasize.pack(producer.consumed))
+        for t, message in _binary._events(f, producer.modes):
+          producer.feed(message)
+          producer.consumed = start + reader.pos
+        if reader.eof: # connection lost, await reconnect
+          return
+        producer.consumed = start + reader.pos # include the end event
+        server._finish(key)
+        self.request.sendall(_binary._datasize.pack(producer.consumed))
+      except OSError:
+        pass
+      finally:
+        producer.connection = None
+
+class _Reader:
+
+  def __init__(self, sock: socket.socket) -> None:
+    self._sock = sock
+    self._buffer = bytearray()
+    self.pos = 0
+    self.eof = False
+    self.onblock = lambda: None # type: typing.Callable[[], None]
+
+  def read(self, n: int) -> bytes:
+    while len(self._buffer) < n and not self.eof:
+      self.onblock()
+      data = self._sock.recv(max(n - len(self._buffer), 2**16))
+      if data:
+        self._buffer += data
+      else:
+        self.eof = True
+    data = bytes(self._buffer[:n])
+    del self._buffer[:n]
+    self.pos += len(data)
+    return data
+
+def parseaddress(address: str) -> Address:
+  '''Parse ``host:port`` as a tcp address, anything else as a socket path.'''
+
+  host, sep, port = address.rpartition(':')
+  if sep and port.isdigit():
+    return host or 'localhost', int(port)
+  return address
+
+# vim:sw=2:sts=2:et
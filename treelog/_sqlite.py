@@ -0,0 +1,170 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import contextlib, os, sqlite3, threading, time, types, typing, warnings
+from . import proto, _io
+
+class SqliteLog:
+  '''Output contexts, messages and files to an sqlite database.
+
+  The database contains the following tables, with ``time`` in seconds since
+  the epoch and ``level`` the integer value of :class:`proto.Level`:
+
+  * ``contexts(id, parent, title, path, start, stop)``, where ``path`` is the
+    `` > `` separated list of titles of the context and its parents. The
+    implicit top level context has id 0 and an empty path, and spans the
+    lifetime of the log.
+  * ``messages(id, context, level, time, text)``
+  * ``attachments(id, context, level, time, name, file, size)``, where
+    ``file`` is the name of the file in the output directory, stored under
+    the sha1 hash of its contents.
+
+  Contexts are indexed by path, and messages and attachments by context,
+  level and time. Rows are inserted in batches of ``batchsize`` events, which
+  are committed in a single transaction; :meth:`flush` commits the pending
+  rows immediately. The database is in write-ahead-log mode, such that it can
+  be queried while the log is active, for instance using :meth:`messages`.'''
+
+  def __init__(self, dirpath: str, *, filename: str = 'log.sqlite', batchsize: int = 1000) -> None:
+    self._dir = _io.directory(dirpath)
+    f, self.filename = self._dir.openfirstunused(_io.sequence(filename), 'wb')
+    f.close()
+    # the connection is only ever used with the lock held
+    self._db = sqlite3.connect(os.path.join(dirpath, self.filename), check_same_thread=False)
+    self._lock = threading.RLock()
+    self._db.executescript(SCHEMA)
+    self._batchsize = batchsize
+    self._ids = 0
+    self._stack = [(0, '')] # type: typing.List[typing.Tuple[int, str]]
+    self._contexts = [(0, None, '', '', time.time())] # type: typing.List[typing.Tuple[int, typing.Optional[int], str, str, float]]
+    self._stops = [] # type: typing.List[typing.Tuple[float, int]]
+    self._messages = [] # type: typing.List[typing.Tuple[int, int, float, str]]
+    self._attachments = [] # type: typing.List[typing.Tuple[int, int, float, str, str, int]]
+    self._npending = 1
+    self._closed = False
+
+  def _push(self, title: str, t: float) -> None:
+    self._ids += 1
+    parent, parentpath = self._stack[-1]
+    path = parentpath + ' > ' + title if parentpath else title
+    self._contexts.append((self._ids, parent, title, path, t))
+    self._stack.append((self._ids, path))
+    self._pending()
+
+  def _pop(self, t: float) -> None:
+    self._stops.append((t, self._stack.pop()[0]))
+    self._pending()
+
+  def _pending(self) -> None:
+    self._npending += 1
+    if self._npending >= self._batchsize:
+      self.flush()
+
+  def pushcontext(self, title: str) -> None:
+    with self._lock:
+      self._push(title, time.time())
+
+  def popcontext(self) -> None:
+    with self._lock:
+      self._pop(time.time())
+
+  def recontext(self, title: str) -> None:
+    with self._lock:
+      t = time.time()
+      self._pop(t)
+      self._push(title, t)
+
+  def write(self, text: str, level: proto.Level) -> None:
+    with self._lock:
+      self._messages.append((self._stack[-1][0], level.value, time.time(), text))
+      self._pending()
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    with self._dir.temp(mode) as f:
+      yield f
+      realname = self._dir.linkhashed(f, os.path.splitext(filename)[1])
+      size = os.fstat(f.fileno()).st_size
+    with self._lock:
+      self._attachments.append((self._stack[-1][0], level.value, time.time(), filename, realname, size))
+      self._pending()
+
+  def flush(self) -> None:
+    '''Commit pending rows to the database.'''
+
+    with self._lock, self._db:
+      self._db.executemany('INSERT INTO contexts (id, parent, title, path, start) VALUES (?, ?, ?, ?, ?)', self._contexts)
+      self._db.executemany('UPDATE contexts SET stop = ? WHERE id = ?', self._stops)
+      self._db.executemany('INSERT INTO messages (context, level, time, text) VALUES (?, ?, ?, ?)', self._messages)
+      self._db.executemany('INSERT INTO attachments (context, level, time, name, file, size) VALUES (?, ?, ?, ?, ?, ?)', self._attachments)
+      self._contexts.clear()
+      self._stops.clear()
+      self._messages.clear()
+      self._attachments.clear()
+      self._npending = 0
+
+  def messages(self, pattern: str = '*', minlevel: proto.Level = proto.Level.debug) -> typing.List[typing.Tuple[str, str, proto.Level]]:
+    '''Return path, text and level of messages in contexts matching pattern.
+
+    The pattern is matched against the path of the context using sqlite's
+    case sensitive ``GLOB``, e.g. ``solve > newton*`` matches all messages in
+    context ``solve > newton`` and its children.'''
+
+    with self._lock:
+      self.flush()
+      rows = self._db.execute('SELECT contexts.path, messages.text, messages.level FROM messages JOIN contexts ON messages.context = contexts.id WHERE contexts.path GLOB ? AND messages.level >= ? ORDER BY messages.id', (pattern, minlevel.value)).fetchall()
+    return [(path, text, proto.Level(level)) for path, text, level in rows]
+
+  def close(self) -> bool:
+    if hasattr(self, '_closed') and not self._closed:
+      with self._lock:
+        self._stops.append((time.time(), 0))
+        self.flush()
+        self._db.close()
+        self._closed = True
+      return True
+    else:
+      return False
+
+  def __enter__(self) -> 'SqliteLog':
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    self.close()
+
+  def __del__(self) -> None:
+    if self.close():
+      warnings.warn('unclosed object {!r}'.format(self), ResourceWarning)
+
+SCHEMA = '''\
+PRAGMA journal_mode = WAL;
+PRAGMA synchronous = NORMAL;
+CREATE TABLE contexts (id INTEGER PRIMARY KEY, parent INTEGER REFERENCES contexts(id), title TEXT NOT NULL, path TEXT NOT NULL, start REAL NOT NULL, stop REAL);
+CREATE TABLE messages (id INTEGER PRIMARY KEY, context INTEGER NOT NULL REFERENCES contexts(id), level INTEGER NOT NULL, time REAL NOT NULL, text TEXT NOT NULL);
+CREATE TABLE attachments (id INTEGER PRIMARY KEY, context INTEGER NOT NULL REFERENCES contexts(id), level INTEGER NOT NULL, time REAL NOT NULL, name TEXT NOT NULL, file TEXT NOT NULL, size INTEGER NOT NULL);
+CREATE INDEX contexts_path ON contexts(path);
+CREATE INDEX messages_context ON messages(context, level);
+CREATE INDEX messages_level ON messages(level, time);
+CREATE INDEX messages_time ON messages(time);
+CREATE INDEX attachments_context ON attachments(context, level);
+CREATE INDEX attachments_time ON attachments(time);
+'''
+
+# vim:sw=2:sts=2:et
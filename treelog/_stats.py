@@ -0,0 +1,156 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections, contextlib, itertools, threading, time, typing, types
+from . import proto
+from ._resource import formatbytes
+
+_registry = {} # type: typing.Dict[int, StatsLog]
+_ids = itertools.count()
+
+class StatsLog:
+  '''Forward messages to an underlying logger while collecting statistics.
+
+  All calls are forwarded to ``baselog`` unchanged. The number of messages and
+  files per level, the number of contexts, the size of all messages and files,
+  and the time spent inside every method of ``baselog`` are collected in the
+  attributes of the same name. The size of a file is the number of bytes, or
+  characters in text mode, that are written to it via the yielded file
+  object. The time spent in :meth:`open` excludes the time spent inside the
+  with-block. All instances that are not closed are reported by
+  :func:`treelog.stats`.'''
+
+  def __init__(self, baselog: proto.Log, name: typing.Optional[str] = None) -> None:
+    self._baselog = baselog
+    self.name = name or type(baselog).__name__
+    self.messages = collections.OrderedDict((level.name, 0) for level in proto.Level) # type: typing.Dict[str, int]
+    self.files = collections.OrderedDict((level.name, 0) for level in proto.Level) # type: typing.Dict[str, int]
+    self.contexts = 0
+    self.textsize = 0
+    self.filesize = 0
+    self.time = collections.OrderedDict((method, 0.) for method in ('pushcontext', 'popcontext', 'recontext', 'write', 'open')) # type: typing.Dict[str, float]
+    self._lock = threading.Lock() # guards the counters only, not the calls to baselog
+    self._id = next(_ids)
+    _registry[self._id] = self
+
+  def pushcontext(self, title: str) -> None:
+    t0 = time.perf_counter()
+    self._baselog.pushcontext(title)
+    dt = time.perf_counter() - t0
+    with self._lock:
+      self.time['pushcontext'] += dt
+      self.contexts += 1
+      self.textsize += len(title)
+
+  def popcontext(self) -> None:
+    t0 = time.perf_counter()
+    self._baselog.popcontext()
+    dt = time.perf_counter() - t0
+    with self._lock:
+      self.time['popcontext'] += dt
+
+  def recontext(self, title: str) -> None:
+    t0 = time.perf_counter()
+    self._baselog.recontext(title)
+    dt = time.perf_counter() - t0
+    with self._lock:
+      self.time['recontext'] += dt
+      self.contexts += 1
+      self.textsize += len(title)
+
+  def write(self, text: str, level: proto.Level) -> None:
+    t0 = time.perf_counter()
+    self._baselog.write(text, level)
+    dt = time.perf_counter() - t0
+    with self._lock:
+      self.time['write'] += dt
+      self.messages[level.name] += 1
+      self.textsize += len(text)
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    t0 = time.perf_counter()
+    with self._baselog.open(filename, mode, level) as f:
+      dt = time.perf_counter() - t0
+      counted = _CountingFile(f)
+      yield typing.cast(typing.IO[typing.Any], counted)
+      t0 = time.perf_counter()
+    dt += time.perf_counter() - t0
+    with self._lock:
+      self.time['open'] += dt
+      self.filesize += counted.size
+      self.files[level.name] += 1
+
+  def close(self) -> bool:
+    '''Remove from the statistics reported by :func:`treelog.stats`.'''
+
+    return _registry.pop(self._id, None) is not None
+
+  def __enter__(self) -> 'StatsLog':
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    self.close()
+
+  def totext(self) -> str:
+    '''Render statistics as plain text.'''
+
+    return '{}\n  messages: {}\n  files: {}\n  contexts: {}\n  size: {} text, {} files\n  time: {:.3f}s ({})\n'.format(
+      self.name,
+      ', '.join('{} {}'.format(n, level) for level, n in self.messages.items()),
+      ', '.join('{} {}'.format(n, level) for level, n in self.files.items()),
+      self.contexts,
+      formatbytes(self.textsize), formatbytes(self.filesize),
+      sum(self.time.values()), ', '.join('{} {:.3f}s'.format(method, t) for method, t in self.time.items()))
+
+class _CountingFile:
+  '''File-like object that counts the data written to an underlying file.'''
+
+  def __init__(self, file: typing.IO[typing.Any]) -> None:
+    self._file = file
+    self.size = 0
+
+  def write(self, data: typing.Any) -> int:
+    n = self._file.write(data)
+    self.size += len(data)
+    return n
+
+  def writelines(self, lines: typing.Iterable[typing.Any]) -> None:
+    for line in lines:
+      self.write(line)
+
+  def __getattr__(self, attr: str) -> typing.Any:
+    return getattr(self._file, attr)
+
+  def __iter__(self) -> typing.Iterator[typing.Any]:
+    return iter(self._file)
+
+  def __enter__(self) -> '_CountingFile':
+    return self
+
+  def __exit__(self, *exc: typing.Any) -> None:
+    self._file.__exit__(*exc)
+
+def stats() -> str:
+  '''Render statistics of all :class:`StatsLog` instances that are not closed.'''
+
+  return ''.join(log.totext() for i, log in sorted(_registry.items()))
+
+# vim:sw=2:sts=2:et
@@ -18,14 +18,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import contextlib, logging, sys, typing
+import contextlib, logging, sys, threading, typing
 from . import proto, _io
 
 class ContextLog:
   '''Base class for loggers that keep track of the current list of contexts.
 
   The base class implements :meth:`context` and :meth:`open` which keep the
-  attribute :attr:`currentcontext` up-to-date.
+  attribute :attr:`currentcontext` up-to-date. Context changes and their
+  :meth:`contextchangedhook` are serialized by a reentrant lock, which
+  subclasses should also hold while writing output.
 
   .. attribute:: currentcontext
 
@@ -34,18 +36,22 @@ class ContextLog:
 
   def __init__(self) -> None:
     self.currentcontext = [] # type: typing.List[str]
+    self._lock = threading.RLock()
 
   def pushcontext(self, title: str) -> None:
-    self.currentcontext.append(title)
-    self.contextchangedhook()
+    with self._lock:
+      self.currentcontext.append(title)
+      self.contextchangedhook()
 
   def popcontext(self) -> None:
-    self.currentcontext.pop()
-    self.contextchangedhook()
+    with self._lock:
+      self.currentcontext.pop()
+      self.contextchangedhook()
 
   def recontext(self, title: str) -> None:
-    self.currentcontext[-1] = title
-    self.contextchangedhook()
+    with self._lock:
+      self.currentcontext[-1] = title
+      self.contextchangedhook()
 
   def contextchangedhook(self) -> None:
     pass
@@ -64,7 +70,8 @@ class StdoutLog(ContextLog):
   '''Output plain text to stream.'''
 
   def write(self, text: str, level: proto.Level) -> None:
-    print(' > '.join((*self.currentcontext, text)))
+    with self._lock:
+      print(' > '.join((*self.currentcontext, text)))
 
 class RichOutputLog(ContextLog):
   '''Output rich (colored,unicode) text to stream.'''
@@ -100,7 +107,8 @@ class RichOutputLog(ContextLog):
     self._current = _current
 
   def write(self, text: str, level: proto.Level) -> None:
-    sys.stdout.write(''.join([self._cmap[level.value], text, '\033[0m\n', self._current]))
+    with self._lock:
+      sys.stdout.write(''.join([self._cmap[level.value], text, '\033[0m\n', self._current]))
 
 class LoggingLog(ContextLog):
   '''Log to Python's built-in logging facility.'''
@@ -112,7 +120,9 @@ class LoggingLog(ContextLog):
     super().__init__()
 
   def write(self, text: str, level: proto.Level) -> None:
-    self._logger.log(self._levels[level.value], ' > '.join((*self.currentcontext, text)))
+    with self._lock:
+      line = ' > '.join((*self.currentcontext, text))
+    self._logger.log(self._levels[level.value], line)
 
 def _first(items: typing.Iterable[bool]) -> int:
   'return index of first truthy item, or len(items) of all items are falsy'
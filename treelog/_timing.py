@@ -0,0 +1,354 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import collections, contextlib, html, json, os, re, sys, threading, time, types, typing, warnings
+from . import proto, _io, _fork
+from ._text import ContextLog
+
+def masknumbers(title: str) -> str:
+  '''Replace all numbers in title by ``#``.'''
+
+  return re.sub('[0-9]+', '#', title)
+
+class TimingLog(ContextLog):
+  '''Profile wall and CPU time per context.
+
+  The wall time is measured by :func:`time.perf_counter` and the CPU time of
+  the process by :func:`time.process_time`. Contexts that have the same
+  parent and the same key are aggregated in a single node of the profile tree.
+  The key is obtained by applying ``key`` to the title, which by default
+  replaces all numbers by ``#``, such that for instance all steps of an
+  :func:`treelog.iter.fraction` loop end up in the same node. The profile of
+  all closed contexts can be rendered by :meth:`totext`, :meth:`tohtml` and
+  :meth:`tocollapsed`.'''
+
+  def __init__(self, key: typing.Callable[[str], str] = masknumbers) -> None:
+    super().__init__()
+    self._key = key
+    self.root = TimingNode('')
+    self._stack = [] # type: typing.List[typing.Tuple[TimingNode, float, float]]
+
+  def pushcontext(self, title: str) -> None:
+    with self._lock:
+      parent = self._stack[-1][0] if self._stack else self.root
+      self._stack.append((parent.child(self._key(title)), time.perf_counter(), time.process_time()))
+      super().pushcontext(title)
+
+  def popcontext(self) -> None:
+    with self._lock:
+      node, wall0, cpu0 = self._stack.pop()
+      node.add(time.perf_counter() - wall0, time.process_time() - cpu0)
+      super().popcontext()
+
+  def recontext(self, title: str) -> None:
+    with self._lock:
+      node, wall0, cpu0 = self._stack.pop()
+      wall, cpu = time.perf_counter(), time.process_time()
+      node.add(wall - wall0, cpu - cpu0)
+      parent = self._stack[-1][0] if self._stack else self.root
+      self._stack.append((parent.child(self._key(title)), wall, cpu))
+      super().recontext(title)
+
+  def write(self, text: str, level: proto.Level) -> None:
+    pass
+
+  def totext(self) -> str:
+    '''Render profile as indented plain text table; times are in seconds.'''
+
+    lines = ['{:>10} {:>10} {:>8} {:>10} {:>10}  {}'.format('wall', 'cpu', 'count', 'min', 'max', 'context')]
+    for depth, node in self.root.walk():
+      lines.append('{:10.3f} {:10.3f} {:8d} {:10.3f} {:10.3f}  {}{}'.format(node.wall, node.cpu, node.count, node.wallmin, node.wallmax, '  ' * depth, node.title))
+    return '\n'.join(lines) + '\n'
+
+  def tohtml(self) -> str:
+    '''Render profile as html document; times are in seconds.'''
+
+    rows = ''.join('<tr><td>{:.3f}</td><td>{:.3f}</td><td>{}</td><td>{:.3f}</td><td>{:.3f}</td><td style="padding-left:{}em">{}</td></tr>\n'.format(node.wall, node.cpu, node.count, node.wallmin, node.wallmax, depth*2, html.escape(node.title)) for depth, node in self.root.walk())
+    return HTML.format(rows=rows)
+
+  def tocollapsed(self) -> str:
+    '''Render profile in the collapsed stack format of flame graph tools.
+
+    Every line contains the semicolon separated titles of a node and its
+    parents followed by the node's self time (wall time that is not spent in
+    child nodes) in microseconds.'''
+
+    lines = []
+    path = [] # type: typing.List[str]
+    for depth, node in self.root.walk():
+      del path[depth:]
+      path.append(node.title.replace(';', ','))
+      selftime = round((node.wall - sum(child.wall for child in node.children.values())) * 1e6)
+      if selftime > 0:
+        lines.append('{} {}'.format(';'.join(path), selftime))
+    return ''.join(line + '\n' for line in lines)
+
+class SamplingLog(ContextLog):
+  '''Statistical profile of the Python stack per context.
+
+  Upon enter a background thread is started that samples the stack of the
+  entering thread every ``interval`` seconds, and attributes every sample to
+  the contexts that are active at that moment. As for :class:`TimingLog`,
+  context titles are aggregated by ``key``. Unlike :mod:`cProfile`, the
+  overhead does not depend on the number of function calls. Functions are
+  identified by file name, first line number and name. The profile is stored
+  in :attr:`samples` and can be rendered by :meth:`totext` and
+  :meth:`tocollapsed` after exit.
+
+  .. attribute:: samples
+
+     A :class:`collections.Counter` of samples, keyed by a tuple of contexts
+     and a tuple of functions, both ordered from outermost to innermost.
+  '''
+
+  def __init__(self, interval: float = .01, key: typing.Callable[[str], str] = masknumbers) -> None:
+    super().__init__()
+    self._interval = interval
+    self._key = key
+    self._path = () # type: typing.Tuple[str, ...]
+    self.samples = collections.Counter() # type: typing.Counter[typing.Tuple[typing.Tuple[str, ...], typing.Tuple[str, ...]]]
+    self._stopped = threading.Event()
+    self._sampler = None # type: typing.Optional[threading.Thread]
+
+  def contextchangedhook(self) -> None:
+    self._path = tuple(map(self._key, self.currentcontext))
+
+  def write(self, text: str, level: proto.Level) -> None:
+    pass
+
+  def __enter__(self) -> 'SamplingLog':
+    if self._sampler:
+      raise RuntimeError('sampling is already active')
+    self._stopped.clear()
+    self._sampler = threading.Thread(target=self._run, args=(threading.get_ident(),), name='treelog sampler', daemon=True)
+    self._sampler.start()
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    assert self._sampler
+    self._stopped.set()
+    self._sampler.join()
+    self._sampler = None
+
+  def _run(self, ident: int) -> None:
+    while not self._stopped.wait(self._interval):
+      frame = sys._current_frames().get(ident)
+      stack = []
+      while frame is not None:
+        code = frame.f_code
+        stack.append('{}:{}({})'.format(code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+      stack.reverse()
+      self.samples[self._path, tuple(stack)] += 1
+
+  def totext(self, limit: int = 10) -> str:
+    '''Render the ``limit`` functions with the most samples per context.
+
+    For every function the percentage of samples of the context is listed
+    in which the function was running (self) or on the stack (total).'''
+
+    contexts = collections.OrderedDict() # type: typing.Dict[typing.Tuple[str, ...], typing.Tuple[typing.Counter[str], typing.Counter[str]]]
+    for (path, stack), count in sorted(self.samples.items()):
+      selfcounts, totalcounts = contexts.setdefault(path, (collections.Counter(), collections.Counter()))
+      if stack:
+        selfcounts[stack[-1]] += count
+      for function in set(stack):
+        totalcounts[function] += count
+    lines = []
+    for path, (selfcounts, totalcounts) in contexts.items():
+      nsamples = sum(selfcounts.values())
+      lines.append('{}: {} samples'.format(' > '.join(path) or '(no context)', nsamples))
+      lines.append('    self   total  function')
+      for function, count in sorted(selfcounts.items(), key=lambda item: (-item[1], -totalcounts[item[0]], item[0]))[:limit]:
+        lines.append('  {:5.1f}%  {:5.1f}%  {}'.format(100 * count / nsamples, 100 * totalcounts[function] / nsamples, function))
+    return ''.join(line + '\n' for line in lines)
+
+  def tocollapsed(self) -> str:
+    '''Render profile in the collapsed stack format of flame graph tools.
+
+    Every line contains the semicolon separated contexts and functions of a
+    sample followed by the number of samples.'''
+
+    lines = collections.Counter() # type: typing.Counter[str]
+    for (path, stack), count in self.samples.items():
+      lines[';'.join(item.replace(';', ',') for item in path + stack)] += count
+    return ''.join('{} {}\n'.format(line, count) for line, count in sorted(lines.items()))
+
+class TraceLog:
+  '''Output timeline of contexts in the Chrome trace event format.
+
+  Contexts are written as begin and end events and messages and files as
+  instant events, all tagged with the id of the process and thread that issued
+  them and a timestamp from :func:`time.perf_counter` in microseconds. The
+  events are streamed to disk as they occur. The resulting file can be loaded
+  in ``chrome://tracing`` or Perfetto, which also accept traces that were not
+  properly closed. A process that is forked while the log is open continues in
+  a new file in the same directory, which is created upon the first event of
+  the child and starts with the contexts that are active at the time of the
+  fork.'''
+
+  def __init__(self, dirpath: str, *, filename: str = 'trace.json') -> None:
+    self._dir = _io.directory(dirpath)
+    self._file, self.filename = self._dir.openfirstunused(_io.sequence(filename), 'w', encoding='utf-8')
+    self._file.write('[')
+    self._sep = '\n'
+    self._contexts = [] # type: typing.List[str]
+    self._forked = False # whether the file of a forked child is yet to be opened
+    self._dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    self._lock = threading.Lock()
+    _fork.register(self)
+
+  def _event(self, ph: str, name: str, **args: typing.Any) -> None:
+    # to be called with the lock held
+    if self._forked:
+      self._startchild()
+    event = collections.OrderedDict([('ph', ph), ('name', name), ('ts', round(time.perf_counter() * 1e6, 3)), ('pid', os.getpid()), ('tid', threading.get_ident())]) # type: typing.Dict[str, typing.Any]
+    event.update(args)
+    self._file.write(self._sep + self._dumps(event))
+    self._sep = ',\n'
+
+  def pushcontext(self, title: str) -> None:
+    with self._lock:
+      self._event('B', title)
+      self._contexts.append(title)
+
+  def popcontext(self) -> None:
+    with self._lock:
+      self._event('E', '')
+      self._contexts.pop()
+
+  def recontext(self, title: str) -> None:
+    with self._lock:
+      self._event('E', '')
+      self._event('B', title)
+      self._contexts[-1] = title
+
+  def write(self, text: str, level: proto.Level) -> None:
+    with self._lock:
+      self._event('i', text, cat=level.name, s='t')
+
+  @contextlib.contextmanager
+  def open(self, filename: str, mode: str, level: proto.Level) -> typing.Generator[typing.IO[typing.Any], None, None]:
+    with _io.devnull(mode) as f:
+      yield f
+    with self._lock:
+      self._event('i', filename, cat=level.name, s='t', args={'file': filename})
+
+  def _startchild(self) -> None:
+    # to be called with the lock held
+    self._forked = False
+    self._file, name = self._dir.openfirstunused(_io.sequence(self.filename), 'w', encoding='utf-8')
+    self._file.write('[')
+    self._sep = '\n'
+    for title in self._contexts:
+      self._event('B', title)
+    self._file.flush()
+    _fork.flushatexit(self._file)
+
+  def _beforefork(self) -> None:
+    # the lock is held until after the fork, such that the child does not inherit a half written event
+    self._lock.acquire()
+    if not self._file.closed:
+      self._file.flush()
+
+  def _afterfork(self, child: bool) -> None:
+    if child:
+      self._lock = threading.Lock()
+      if not self._file.closed:
+        self._file.close() # flushed before the fork, so this only releases the descriptor
+        self._forked = True
+    else:
+      self._lock.release()
+
+  def close(self) -> bool:
+    _fork.unregister(self)
+    if hasattr(self, '_file') and not self._file.closed:
+      with self._lock:
+        for i in range(len(self._contexts)):
+          self._event('E', '')
+        self._file.write('\n]\n')
+        self._file.close()
+      return True
+    else:
+      return False
+
+  def __enter__(self) -> 'TraceLog':
+    return self
+
+  def __exit__(self, t: typing.Optional[typing.Type[BaseException]], value: typing.Optional[BaseException], traceback: typing.Optional[types.TracebackType]) -> None:
+    self.close()
+
+  def __del__(self) -> None:
+    if self.close():
+      warnings.warn('unclosed object {!r}'.format(self), ResourceWarning)
+
+class TimingNode:
+  '''Aggregated timings of contexts with the same key.'''
+
+  def __init__(self, title: str) -> None:
+    self.title = title
+    self.children = collections.OrderedDict() # type: typing.Dict[str, TimingNode]
+    self.count = 0
+    self.wall = 0.
+    self.wallmin = 0.
+    self.wallmax = 0.
+    self.cpu = 0.
+
+  def child(self, title: str) -> 'TimingNode':
+    node = self.children.get(title)
+    if node is None:
+      node = self.children[title] = TimingNode(title)
+    return node
+
+  def add(self, wall: float, cpu: float) -> None:
+    self.wallmin = min(self.wallmin, wall) if self.count else wall
+    self.wallmax = max(self.wallmax, wall)
+    self.wall += wall
+    self.cpu += cpu
+    self.count += 1
+
+  def walk(self, depth: int = 0) -> typing.Iterator[typing.Tuple[int, 'TimingNode']]:
+    '''Iterate depth-first over all descendants, paired with their depth.'''
+
+    for child in self.children.values():
+      yield depth, child
+      yield from child.walk(depth+1)
+
+HTML = '''\
+<!DOCTYPE html>
+<html>
+<head>
+<meta charset="UTF-8"/>
+<title>profile</title>
+<style>
+body {{ font-family: monospace; font-size: 12px; }}
+th, td {{ text-align: right; padding: 0px 8px; white-space: pre; }}
+th:last-child, td:last-child {{ text-align: left; }}
+</style>
+</head>
+<body>
+<table>
+<tr><th>wall</th><th>cpu</th><th>count</th><th>min</th><th>max</th><th>context</th></tr>
+{rows}</table>
+</body>
+</html>
+'''
+
+# vim:sw=2:sts=2:et
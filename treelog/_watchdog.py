@@ -0,0 +1,148 @@
+# Copyright (c) 2018 Evalf
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import heapq, itertools, sys, threading, time, typing
+from . import proto
+
+class Watchdog:
+  '''Single background thread that expires budgets at their deadline.
+
+  The thread is started upon the first budget and sleeps until the earliest
+  deadline. Stopped budgets are discarded lazily, either when they come up or
+  when they make up more than half of the heap.'''
+
+  def __init__(self) -> None:
+    self._cond = threading.Condition()
+    self._heap = [] # type: typing.List[typing.Tuple[float, int, Budget]]
+    self._seq = itertools.count()
+    self._nstopped = 0
+    self._worker = None # type: typing.Optional[threading.Thread]
+
+  def schedule(self, budget: 'Budget') -> None:
+    with self._cond:
+      heapq.heappush(self._heap, (budget.deadline, next(self._seq), budget))
+      if self._worker is None or not self._worker.is_alive(): # the thread does not survive a fork
+        self._worker = threading.Thread(target=self._run, name='treelog watchdog', daemon=True)
+        self._worker.start()
+      elif self._heap[0][2] is budget:
+        self._cond.notify()
+
+  def _run(self) -> None:
+    with self._cond:
+      while True:
+        if not self._heap:
+          self._cond.wait()
+          continue
+        deadline, seq, budget = self._heap[0]
+        if budget.stopped:
+          heapq.heappop(self._heap)
+          self._nstopped -= 1
+          continue
+        timeout = deadline - time.perf_counter()
+        if timeout > 0:
+          self._cond.wait(timeout)
+          continue
+        heapq.heappop(self._heap)
+        try:
+          budget.expire()
+        except Exception: # keep the watchdog alive for other budgets
+          pass
+        budget.expired.set()
+
+  def stop(self, budget: 'Budget') -> None:
+    with self._cond: # wait for a concurrent expire to finish
+      budget.stopped = True
+      if not budget.expired.is_set():
+        self._nstopped += 1
+        if self._nstopped > len(self._heap) // 2:
+          self._heap = [item for item in self._heap if not item[2].stopped]
+          heapq.heapify(self._heap)
+          self._nstopped = 0
+
+watchdog = Watchdog()
+
+_local = threading.local()
+_used = False # whether any budget was ever started, to skip the thread-local lookup until then
+
+def report() -> None:
+  '''Write the warnings of the expired budgets of the current thread.
+
+  To be called upon every change of context.'''
+
+  if _used:
+    for budget in getattr(_local, 'budgets', ()):
+      budget.report()
+
+class Budget:
+  '''Time budget of a context.
+
+  If the budget is not stopped within the given number of seconds, the
+  watchdog records a warning containing the stack of the thread that started
+  the budget, which that thread writes to the log upon its next change of
+  context, such that the log is only ever written by its own thread. Upon
+  stop, the actual duration is written to the log as a warning if the budget
+  was exceeded, or as a debug message otherwise.'''
+
+  def __init__(self, log: proto.Log, title: str, seconds: float) -> None:
+    global _used
+    _used = True
+    self._log = log
+    self.title = title
+    self.seconds = seconds
+    self._ident = threading.get_ident()
+    self._start = time.perf_counter()
+    self.deadline = self._start + seconds
+    self.expired = threading.Event()
+    self.stopped = False
+    self._warning = None # type: typing.Optional[str]
+    try:
+      self._active = _local.budgets # type: typing.List[Budget]
+    except AttributeError:
+      self._active = _local.budgets = []
+    self._active.append(self)
+    watchdog.schedule(self)
+
+  def expire(self) -> None:
+    # called by the watchdog thread
+    import traceback
+    frame = sys._current_frames().get(self._ident)
+    stack = ''.join(traceback.format_stack(frame)) if frame is not None else ''
+    self._warning = '{} exceeded budget of {}, currently at:\n{}'.format(self.title, formatseconds(self.seconds), stack.rstrip('\n'))
+
+  def report(self) -> None:
+    warning = self._warning
+    if warning is not None:
+      self._warning = None
+      self._log.write(warning, proto.Level.warning)
+
+  def stop(self) -> None:
+    duration = time.perf_counter() - self._start
+    watchdog.stop(self)
+    self._active.remove(self)
+    self.report()
+    if self.expired.is_set() or duration > self.seconds:
+      self._log.write('{} took {}, exceeding budget of {}'.format(self.title, formatseconds(duration), formatseconds(self.seconds)), proto.Level.warning)
+    else:
+      self._log.write('{} took {} of budget {}'.format(self.title, formatseconds(duration), formatseconds(self.seconds)), proto.Level.debug)
+
+def formatseconds(seconds: float) -> str:
+  return '{:.3f}s'.format(seconds)
+
+# vim:sw=2:sts=2:et
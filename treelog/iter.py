@@ -1,5 +1,8 @@
-import itertools, functools, warnings, inspect, typing, types
-from . import proto
+import itertools, functools, warnings, operator, contextlib, typing, types, time
+if typing.TYPE_CHECKING:
+  import concurrent.futures
+from . import proto, _watchdog
+from ._silent import RecordLog
 
 T = typing.TypeVar('T')
 T0 = typing.TypeVar('T0')
@@ -19,27 +22,40 @@ class wrap(typing.Generic[T]):
   The wrapped iterable is identical to the original, except that prior to every
   next item a new log context is opened taken from the ``titles`` iterable. The
   wrapped object should be entered before use in order to ensure that this
-  context is properly closed in case the iterator is prematurely abandoned.'''
+  context is properly closed in case the iterator is prematurely abandoned.
 
-  def __init__(self, titles: typing.Union[typing.Iterable[str], typing.Generator[str, T, None]], iterable: typing.Iterable[T]) -> None:
+  Asynchronous iterables are wrapped likewise, in which case the object should
+  be entered via ``async with`` and iterated via ``async for``. Contexts are
+  updated only once the next item has been awaited, and are always applied to
+  the logger that was current when the object was entered. A logger has a
+  single stack of contexts, so concurrent tasks that log to the same logger
+  interleave their contexts. Tasks that run concurrently should therefore
+  each log to a logger of their own, via :func:`treelog.set` with ``local``
+  true within the task, which sets the logger for that task only.
+
+  If a ``budget`` in seconds is given, every context is watched as for
+  :func:`treelog.context`, such that a warning is written if a single step
+  exceeds the budget.'''
+
+  def __init__(self, titles: typing.Union[typing.Iterable[str], typing.Generator[str, T, None]], iterable: typing.Union[typing.Iterable[T], typing.AsyncIterable[T]], *, budget: typing.Optional[float] = None) -> None:
     self._titles = iter(titles)
-    self._iterable = iter(iterable)
+    self._cansend = isinstance(self._titles, types.GeneratorType)
+    self._iterable = iterable if isinstance(iterable, typing.AsyncIterable) else iter(iterable) # type: typing.Union[typing.Iterator[T], typing.AsyncIterable[T]]
     self._log = None # type: typing.Optional[proto.Log]
     self._warn = False
+    self._budget = budget
+    self._watched = None # type: typing.Optional[_watchdog.Budget]
 
   def __enter__(self) -> typing.Iterator[T]:
-    if self._log is not None:
-      raise Exception('iter.wrap is not reentrant')
-    from . import current
-    self._log = current
-    self._log.pushcontext(next(self._titles))
+    self._push()
     return iter(self)
 
   def __iter__(self) -> typing.Generator[T, None, None]:
+    if not isinstance(self._iterable, typing.Iterator):
+      raise TypeError('asynchronous iter.wrap requires async for')
     if self._log is not None:
-      cansend = inspect.isgenerator(self._titles)
       for value in self._iterable:
-        self._log.recontext(typing.cast(typing.Generator[str, T, None], self._titles).send(value) if cansend else next(self._titles))
+        self._recontext(value)
         yield value
     else:
       with self:
@@ -51,9 +67,109 @@ class wrap(typing.Generic[T]):
       raise Exception('iter.wrap has not yet been entered')
     if self._warn and exctype is GeneratorExit:
       warnings.warn('unclosed iter.wrap', ResourceWarning)
+    if self._watched:
+      self._watched.stop()
+      self._watched = None
+    _watchdog.report()
     self._log.popcontext()
     self._log = None
 
+  async def __aenter__(self) -> typing.AsyncIterator[T]:
+    self._push()
+    return self.__aiter__()
+
+  def __aiter__(self) -> typing.AsyncIterator[T]:
+    return _asynciterator(self)
+
+  async def __aexit__(self, exctype: typing.Optional[typing.Type[BaseException]], excvalue: typing.Optional[BaseException], tb: typing.Optional[types.TracebackType]) -> None:
+    self.__exit__(exctype, excvalue, tb)
+
+  def _push(self) -> None:
+    if self._log is not None:
+      raise Exception('iter.wrap is not reentrant')
+    from . import _current
+    self._log = _current()
+    _watchdog.report()
+    self._log.pushcontext(self._watch(next(self._titles)))
+
+  def _recontext(self, value: T) -> None:
+    assert self._log is not None
+    title = typing.cast(typing.Generator[str, T, None], self._titles).send(value) if self._cansend else next(self._titles)
+    if self._watched:
+      self._watched.stop()
+    _watchdog.report()
+    self._log.recontext(self._watch(title))
+
+  def _watch(self, title: str) -> str:
+    if self._budget is not None:
+      assert self._log is not None
+      self._watched = _watchdog.Budget(self._log, title, self._budget)
+    return title
+
+class _asynciterator(typing.Generic[T]):
+  '''Asynchronous iterator over a wrap object.
+
+  If the wrap object has not been entered yet, it is entered upon creation of
+  the iterator and exited upon exhaustion.'''
+
+  def __init__(self, wrapped: wrap[T]) -> None:
+    self._wrapped = wrapped
+    iterable = wrapped._iterable
+    self._iterator = iterable.__aiter__() if not isinstance(iterable, typing.Iterator) else _asyncify(iterable) # type: typing.AsyncIterator[T]
+    self._owner = wrapped._log is None
+    if self._owner:
+      wrapped._push()
+
+  def __aiter__(self) -> '_asynciterator[T]':
+    return self
+
+  async def __anext__(self) -> T:
+    try:
+      value = await self._iterator.__anext__()
+    except BaseException as e:
+      if self._owner:
+        self._owner = False
+        self._wrapped.__exit__(type(e), e, e.__traceback__)
+      raise
+    self._wrapped._recontext(value)
+    return value
+
+  def __del__(self) -> None:
+    if self._owner:
+      self._owner = False
+      warnings.warn('unclosed iter.wrap', ResourceWarning)
+      self._wrapped.__exit__(None, None, None)
+
+class _asyncify(typing.Generic[T]):
+  '''Asynchronous iterator over a synchronous iterator.'''
+
+  def __init__(self, iterator: typing.Iterator[T]) -> None:
+    self._iterator = iterator
+
+  def __aiter__(self) -> '_asyncify[T]':
+    return self
+
+  async def __anext__(self) -> T:
+    try:
+      return next(self._iterator)
+    except StopIteration:
+      raise StopAsyncIteration
+
+class _azip:
+  '''Asynchronous zip of synchronous and asynchronous iterators.'''
+
+  def __init__(self, iterators: typing.Sequence[typing.Union[typing.Iterator[typing.Any], typing.AsyncIterator[typing.Any]]]) -> None:
+    self._iterators = [it if not isinstance(it, typing.Iterator) else _asyncify(it) for it in iterators] # type: typing.List[typing.AsyncIterator[typing.Any]]
+
+  def __aiter__(self) -> '_azip':
+    return self
+
+  async def __anext__(self) -> typing.Tuple[typing.Any, ...]:
+    values = []
+    for it in self._iterators:
+      values.append(await it.__anext__())
+    return tuple(values)
+
 @typing.overload
 def plain(title: str, __arg0: typing.Iterable[T0]) -> wrap[T0]: ...
 @typing.overload
@@ -84,78 +200,231 @@ def plain(title: str, *args: typing.Any) -> wrap[typing.Any]:
   '''
 
   titles = map((_escape(title) + ' {}').format, itertools.count())
-  return wrap(titles, zip(*args) if len(args) > 1 else args[0])
+  return wrap(titles, _zip(args))
 
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], *, length: typing.Optional[int] = ...) -> wrap[T0]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[T0]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8]]: ...
 @typing.overload
-def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], __arg9: typing.Iterable[T9], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8, T9]]: ...
+def fraction(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], __arg9: typing.Iterable[T9], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8, T9]]: ...
 @typing.overload
-def fraction(title: str, *args: typing.Any, length: typing.Optional[int] = ...) -> wrap[typing.Any]: ...
+def fraction(title: str, *args: typing.Any, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Any]: ...
 
-def fraction(title: str, *args: typing.Any, length: typing.Optional[int] = None) -> wrap[typing.Any]:
+def fraction(title: str, *args: typing.Any, length: typing.Optional[int] = None, eta: bool = False) -> wrap[typing.Any]:
   '''Wrap arguments in enumerated contexts with length.
 
-  Example: my context 1/5, my context 2/5, etc.
+  Example: my context 1/5, my context 2/5, etc. If ``eta`` is true the titles
+  are extended with the measured throughput and the estimated remaining time,
+  e.g. my context 2/5 (1.5/s, eta 0:02).
+
+  The length defaults to the shortest of the arguments' lengths, or, for
+  arguments without a length, of their :func:`operator.length_hint`, which is
+  evaluated anew at every iteration. An explicitly specified ``length`` is
+  treated as an estimate that is raised if the iteration turns out to be
+  longer. If no length is known at all the contexts degrade to a plain
+  counter: my context 1, my context 2, etc.
   '''
 
-  if length is None:
-    length = min(len(arg) for arg in args)
-  titles = map((_escape(title) + ' {}/' + str(length)).format, itertools.count())
-  return wrap(titles, zip(*args) if len(args) > 1 else args[0])
+  iterable, known, lengths = _measure(args, length)
+  if known is not None:
+    titles = map((_escape(title) + ' {}/' + str(known)).format, itertools.count()) # type: typing.Iterable[str]
+    steps = zip(titles, lengths) # type: typing.Iterable[typing.Tuple[str, typing.Optional[int]]]
+  else:
+    steps = _fractionsteps(title, lengths)
+    titles = map(operator.itemgetter(0), steps)
+  return wrap(_eta(steps) if eta else titles, iterable)
 
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], *, length: typing.Optional[int] = ...) -> wrap[T0]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[T0]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8]]: ...
 @typing.overload
-def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], __arg9: typing.Iterable[T9], *, length: typing.Optional[int]= ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8, T9]]: ...
+def percentage(title: str, __arg0: typing.Iterable[T0], __arg1: typing.Iterable[T1], __arg2: typing.Iterable[T2], __arg3: typing.Iterable[T3], __arg4: typing.Iterable[T4], __arg5: typing.Iterable[T5], __arg6: typing.Iterable[T6], __arg7: typing.Iterable[T7], __arg8: typing.Iterable[T8], __arg9: typing.Iterable[T9], *, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Tuple[T0, T1, T2, T3, T4, T5, T6, T7, T8, T9]]: ...
 @typing.overload
-def percentage(title: str, *args: typing.Any, length: typing.Optional[int] = ...) -> wrap[typing.Any]: ...
+def percentage(title: str, *args: typing.Any, length: typing.Optional[int] = ..., eta: bool = ...) -> wrap[typing.Any]: ...
 
-def percentage(title: str, *args: typing.Any, length: typing.Optional[int] = None) -> wrap[typing.Any]:
+def percentage(title: str, *args: typing.Any, length: typing.Optional[int] = None, eta: bool = False) -> wrap[typing.Any]:
   '''Wrap arguments in contexts with percentage counter.
 
-  Example: my context 5%, my context 10%, etc.
+  Example: my context 5%, my context 10%, etc. If ``eta`` is true the titles
+  are extended with the measured throughput and the estimated remaining time,
+  e.g. my context 40% (1.5/s, eta 0:02). The length is determined as in
+  :func:`fraction`; if it is unknown the contexts degrade to a plain counter.
   '''
 
-  if length is None:
-    length = min(len(arg) for arg in args)
-  if length:
-    titles = map((_escape(title) + ' {:.0f}%').format, itertools.count(step=100/length)) # type: typing.Iterable[str]
+  iterable, known, lengths = _measure(args, length)
+  if known is not None:
+    titles = map((_escape(title) + ' {:.0f}%').format, itertools.count(step=100/known)) if known else itertools.repeat(title + ' 100%') # type: typing.Iterable[str]
+    steps = zip(titles, lengths) # type: typing.Iterable[typing.Tuple[str, typing.Optional[int]]]
   else:
-    titles = title + ' 100%',
-  return wrap(titles, zip(*args) if len(args) > 1 else args[0])
+    steps = _percentagesteps(title, lengths)
+    titles = map(operator.itemgetter(0), steps)
+  return wrap(_eta(steps) if eta else titles, iterable)
+
+def pmap(title: str, func: typing.Callable[[T0], T], iterable: typing.Iterable[T0], *, executor: typing.Optional['concurrent.futures.Executor'] = None) -> typing.Generator[T, None, None]:
+  '''Map function over iterable in a pool of workers.
+
+  The items are submitted to ``executor``, by default a temporary
+  :class:`concurrent.futures.ThreadPoolExecutor`, and the results are
+  generated in input order. Everything ``func`` logs for an item is recorded
+  in the worker and replayed into the current logger, in input order, in the
+  same contexts that :func:`fraction` would have opened: my context 1/5, my
+  context 2/5, etc. For a process pool ``func`` must be picklable. In a thread
+  pool, the record overrides the current logger in the worker thread only, so
+  ``func`` should log via the functions of :mod:`treelog` rather than via
+  ``treelog.current`` directly. Upon exit, including an exception, items that
+  have not started are cancelled and running items are waited for.
+
+  >>> import treelog
+  >>> def square(x):
+  ...   treelog.info('squaring {}'.format(x))
+  ...   return x**2
+  >>> list(treelog.iter.pmap('square', square, [1, 2]))
+  square 1/2 > squaring 1
+  square 2/2 > squaring 2
+  [1, 4]
+  '''
+
+  import concurrent.futures
+  from . import _current
+  log = _current()
+  with contextlib.ExitStack() as stack:
+    if executor is None:
+      executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor())
+    futures = [executor.submit(_record, func, arg) for arg in iterable]
+    # upon exit, cancel what has not started and wait for the workers that have
+    stack.callback(concurrent.futures.wait, futures)
+    stack.callback(lambda: [future.cancel() for future in futures])
+    with fraction(title, futures) as items:
+      for future in items:
+        record, success, result = future.result()
+        record.replay(log)
+        if not success:
+          raise result
+        yield result
+
+def _record(func: typing.Callable[[T0], T], arg: T0) -> typing.Tuple[RecordLog, bool, typing.Any]:
+  '''Call func in a pmap worker, recording its log.'''
+
+  from . import _override
+  record = RecordLog()
+  # the worker thread logs to the record, without touching the logger of other threads
+  token = _override.set(record)
+  try:
+    result = func(arg)
+  except Exception as e:
+    return record, False, e
+  finally:
+    _override.reset(token)
+  return record, True, result
+
+def _zip(args: typing.Sequence[typing.Any]) -> typing.Any:
+  '''Zip arguments, asynchronously if any of them is asynchronous.'''
+
+  if len(args) == 1:
+    return args[0]
+  if any(hasattr(arg, '__aiter__') for arg in args):
+    return _azip([arg.__aiter__() if hasattr(arg, '__aiter__') else iter(arg) for arg in args])
+  return zip(*args)
+
+def _measure(args: typing.Sequence[typing.Any], length: typing.Optional[int]) -> typing.Tuple[typing.Any, typing.Optional[int], typing.Iterator[typing.Optional[int]]]:
+  '''Return the (zipped) iterator, its length if known in advance, and a
+  generator of running length estimates.
+
+  The i-th length estimate is meant to be evaluated after i items have been
+  drawn from the iterator.'''
+
+  iterators = [arg.__aiter__() if hasattr(arg, '__aiter__') else iter(arg) for arg in args]
+  iterable = _zip(iterators)
+  if length is not None:
+    return iterable, None, map(max, itertools.repeat(length), itertools.count())
+  static = [] # type: typing.List[int]
+  dynamic = [] # type: typing.List[typing.Any]
+  for arg, it in zip(args, iterators):
+    n = operator.length_hint(arg, -1) if it is not arg else -1
+    if n >= 0:
+      static.append(n)
+    else:
+      dynamic.append(it)
+  if not dynamic:
+    return iterable, min(static), itertools.repeat(min(static))
+  return iterable, None, _hints(min(static) if static else None, dynamic)
+
+def _hints(upper: typing.Optional[int], iterators: typing.Sequence[typing.Iterator[typing.Any]]) -> typing.Generator[typing.Optional[int], None, None]:
+  for i in itertools.count():
+    lengths = [i + n for n in (operator.length_hint(it, -1) for it in iterators) if n >= 0]
+    if upper is not None:
+      lengths.append(upper)
+    yield min(lengths) if lengths else None
+
+def _fractionsteps(title: str, lengths: typing.Iterable[typing.Optional[int]]) -> typing.Generator[typing.Tuple[str, typing.Optional[int]], None, None]:
+  for i, n in enumerate(lengths):
+    yield title + (' {}/{}'.format(i, n) if n is not None else ' {}'.format(i)), n
+
+def _percentagesteps(title: str, lengths: typing.Iterable[typing.Optional[int]]) -> typing.Generator[typing.Tuple[str, typing.Optional[int]], None, None]:
+  for i, n in enumerate(lengths):
+    yield title + (' {:.0f}%'.format(100*i/n) if n else ' 100%' if n == 0 else ' {}'.format(i)), n
+
+def _eta(steps: typing.Iterable[typing.Tuple[str, typing.Optional[int]]], smoothing: float = .3, interval: float = .1) -> typing.Generator[str, typing.Any, None]:
+  '''Extend titles with throughput and estimated time of arrival.
+
+  The throughput is the number of completed items divided by the time elapsed
+  since the first item was requested; the remaining time is based on an
+  exponential moving average of the duration per item, and is omitted if the
+  length is unknown. Both are recomputed at most once per ``interval``
+  seconds, and repeated in the titles in between.'''
+
+  steps = iter(steps)
+  yield next(steps)[0]
+  t0 = tprev = time.monotonic()
+  nprev = 0
+  avg = None # type: typing.Optional[float]
+  suffix = ''
+  for done, (title, length) in enumerate(steps):
+    if done:
+      now = time.monotonic()
+      if now - tprev >= interval:
+        duration = (now - tprev) / (done - nprev)
+        avg = duration if avg is None else avg + smoothing * (duration - avg)
+        tprev = now
+        nprev = done
+        rate = '{:.3g}/s'.format(done / (now - t0))
+        suffix = ' ({})'.format(rate if length is None else '{}, eta {}'.format(rate, _duration(avg * max(length - done, 0))))
+    yield title + suffix
+
+def _duration(seconds: float) -> str:
+  s = int(round(seconds))
+  minutes = s // 60
+  return '{}:{:02d}:{:02d}'.format(minutes // 60, minutes % 60, s % 60) if minutes >= 60 else '{}:{:02d}'.format(minutes, s % 60)
 
 def _escape(s: str) -> str:
   return s.replace('{', '{{').replace('}', '}}')